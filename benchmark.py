@@ -0,0 +1,196 @@
+"""Contains the benchmark of the history stages, which runs them on a synthetic corpus and reports their throughput and memory usage"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import shlex
+import sys
+import time
+
+import metrics
+import util
+import todo_detector
+from pre_bot_issue_finder import find_pre_bot_issues, generate_diffs_and_testcases, iter_cloned_repos, obtain_cloned_repos
+from synthetic_corpus import DEFAULT_CORPUS_SETTINGS, generate_corpus
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; the peak memory usage is then not reported
+    resource = None
+
+
+# History stages that can be benchmarked, and the counter of the commits each of them handles
+BENCHMARK_STAGES = {
+    "obtain_cloned_repos": (obtain_cloned_repos, "commits_indexed_total"),
+    "find_pre_bot_issues": (find_pre_bot_issues, "commits_scanned_total"),
+    "generate_diffs_and_testcases": (generate_diffs_and_testcases, "commits_scanned_total"),
+}
+
+# Columns of the results of a benchmark
+RESULT_COLUMNS = ["stage", "seconds", "commits", "commits_per_second", "diff_bytes", "detector_invocations", "peak_rss_bytes"]
+
+# Interval at which the benchmark checks whether the process of a stage is still running
+RESULT_POLL_SECONDS = 1
+
+# A stage regressed if its throughput dropped, or its peak memory usage grew, by more than this share of the baseline
+DEFAULT_TOLERANCE = 0.2
+
+
+def _peak_rss_bytes():
+    if resource is None:
+        return None
+    # Linux reports the maximum resident set size in KiB, macOS in bytes
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def benchmark_settings(settings, path, detector_command):
+    """
+        Returns a copy of the settings in which the inputs are those of the corpus in path,
+        and all outputs are placed in path/output
+    """
+    output_path = os.path.join(path, "output")
+    benchmark = dict(settings)
+    benchmark.update({
+        'download-output-path-repo': os.path.join(path, "repos"),
+        'results-repos-output-file': os.path.join(path, "repo-results.json"),
+        'results-todo-comments-pre-bot-output-file': os.path.join(output_path, "issues-pre-bot.csv"),
+        'results-clone-info-output-file': os.path.join(output_path, "clone_info.csv"),
+        'results-commit-index-output-file': os.path.join(output_path, "commit_index.csv"),
+        'results-cost-ledger-file': os.path.join(output_path, "repo_cost_ledger.csv"),
+        'results-timeouts-file': os.path.join(output_path, "timeouts.csv"),
+        'diffs-output-path': os.path.join(output_path, "diffs"),
+        'fake-testcase-path': os.path.join(output_path, "tests"),
+        'todo-bot-command': detector_command,
+    })
+    return benchmark
+
+
+def _run_stage(stage, settings, log_filename, results):
+    # Runs in a fresh process, so that the peak memory usage (and the metrics) are those of this stage only
+    logger = util.create_logger("benchmark", "INFO", log_filename)
+    run, commit_counter = BENCHMARK_STAGES[stage]
+    start_time = time.perf_counter()
+    run(settings, logger)
+    seconds = time.perf_counter() - start_time
+    util.stop_logging()
+
+    commits = metrics.registry.counter_value(commit_counter)
+    results.put({
+        "stage": stage,
+        "seconds": round(seconds, 3),
+        "commits": commits,
+        "commits_per_second": round(commits / seconds, 1) if seconds > 0 else None,
+        "diff_bytes": metrics.registry.counter_value("diff_bytes_written_total"),
+        "detector_invocations": metrics.registry.counter_value("todo_bot_invocations_total"),
+        "peak_rss_bytes": _peak_rss_bytes(),
+    })
+
+
+def run_benchmark(settings, path, stages, detector_command, logger):
+    """
+        Runs each stage on the corpus in path in its own process, and returns the results of each stage
+    """
+    settings = benchmark_settings(settings, path, detector_command)
+    os.makedirs(os.path.join(path, "output"), exist_ok=True)
+    log_filename = os.path.join(path, "output", "benchmark.log")
+
+    context = multiprocessing.get_context("spawn")
+    all_results = []
+    for stage in stages:
+        logger.info(f"Benchmarking <{stage}>...")
+        results = context.Queue()
+        process = context.Process(target=_run_stage, args=(stage, settings, log_filename, results))
+        process.start()
+        stage_results = None
+        while stage_results is None:
+            try:
+                stage_results = results.get(timeout=RESULT_POLL_SECONDS)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+                # The stage failed if its process exited without its results (e.g. because it raised)
+                try:
+                    stage_results = results.get(timeout=RESULT_POLL_SECONDS)
+                except queue.Empty:
+                    process.join()
+                    raise RuntimeError(f"Benchmarking <{stage}> failed: its process exited with code {process.exitcode} "
+                                       f"(see {log_filename})")
+        process.join()
+        all_results.append(stage_results)
+
+        # The testcases are appended to the files next to the repositories; remove them so that each run starts clean
+        for owner, name, repo_path in iter_cloned_repos(settings.get('download-output-path-repo')):
+            if os.path.isfile(repo_path + ".test.js"):
+                os.remove(repo_path + ".test.js")
+    return all_results
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+        Returns a message for every stage of which the throughput or peak memory usage regressed compared to the baseline
+    """
+    baseline = {row["stage"]: row for row in baseline}
+    regressions = []
+    for row in results:
+        base = baseline.get(row["stage"])
+        if base is None:
+            continue
+        if row["commits_per_second"] and base["commits_per_second"] \
+                and row["commits_per_second"] < base["commits_per_second"] * (1 - tolerance):
+            regressions.append(f"<{row['stage']}> handled {row['commits_per_second']} commits per second, "
+                f"compared to {base['commits_per_second']} in the baseline")
+        if row["peak_rss_bytes"] and base["peak_rss_bytes"] and row["peak_rss_bytes"] > base["peak_rss_bytes"] * (1 + tolerance):
+            regressions.append(f"<{row['stage']}> used {row['peak_rss_bytes']} bytes of memory at its peak, "
+                f"compared to {base['peak_rss_bytes']} in the baseline")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the history stages on a synthetic corpus")
+    parser.add_argument('--path', default="benchmark", help="Folder in which the corpus is generated (or reused) and the stages output")
+    parser.add_argument('--stages', nargs='+', default=list(BENCHMARK_STAGES), choices=list(BENCHMARK_STAGES))
+    parser.add_argument('--detector-command',
+        help="Command that is run (followed by the todo[bot] arguments) for every pre-bot commit, "
+             "e.g. 'node <modified-todo-bot-install-path>'. Defaults to the stand-in of todo_detector.py")
+    parser.add_argument('--results', help="File (JSON) in which the results are output")
+    parser.add_argument('--baseline', help="Results (JSON) of an earlier benchmark to compare with")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+        help="Share by which the throughput or memory usage of a stage may regress compared to the baseline")
+    for key, value in DEFAULT_CORPUS_SETTINGS.items():
+        parser.add_argument(f'--{key}', type=type(value), default=value, help="Setting of the synthetic corpus")
+    args = parser.parse_args()
+
+    logger = util.create_logger("benchmark", "INFO")
+    path = os.path.abspath(args.path)
+    corpus_settings = generate_corpus(path, {key: getattr(args, key.replace('-', '_')) for key in DEFAULT_CORPUS_SETTINGS}, logger)
+
+    settings = util.load_settings('settings.json')
+    if args.detector_command:
+        detector_command = shlex.split(args.detector_command)
+    else:
+        detector_command = [sys.executable, os.path.abspath(todo_detector.__file__), os.path.join(path, "output", "diffs")]
+    results = run_benchmark(settings, path, args.stages, detector_command, logger)
+
+    print(" ".join(f"{column:>24}" for column in RESULT_COLUMNS))
+    for row in results:
+        print(" ".join(f"{str(row[column]):>24}" for column in RESULT_COLUMNS))
+
+    if args.results:
+        with open(args.results, 'w', encoding='utf-8') as results_file:
+            json.dump({"corpus": corpus_settings, "stages": results}, results_file, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline["corpus"] != corpus_settings:
+            logger.warning("The baseline was obtained on a different corpus; its results are not comparable!")
+        regressions = find_regressions(results, baseline["stages"], args.tolerance)
+        for regression in regressions:
+            logger.warning(f"Regression: {regression}")
+        if regressions:
+            raise SystemExit(1)
+        logger.info("No regressions compared to the baseline")
@@ -1,9 +1,10 @@
 import csv
+from contextlib import closing
 from datetime import datetime, timedelta
 from math import inf
 
-from github.GithubObject import _NotSetType as NotSet
-
+import metrics
+from issue_body_store import ISSUE_CSV_OPTIONS, IssueBodyStore
 from util import rate_limited_retry_search
 
 
@@ -12,6 +13,12 @@ from util import rate_limited_retry_search
 #   and we need to narrow down. (GitHub only returns 1000 results per search)
 MAX_RESULTS_PER_SEARCH = 1000
 
+# Number of search results that are returned per page
+RESULTS_PER_PAGE = 100
+
+# Columns of the issues file (the bodies of the issues are kept in the issue body store)
+ISSUE_CSV_COLUMNS = ["repo", "number", "title", "state", "type", "created_at", "updated_at", "closed_at", "num_comments"]
+
 # Shorthand notation for converting settings to GitHub search qualifiers
 SETTING_TO_QUALIFIER = {
     'issue_level': {
@@ -33,39 +40,103 @@ def construct_issue_search_query(settings):
 
     return issue_query
 
-def is_issue(issue_or_pr):
-    # PyGithub makes an API request if attempting to obtain PR-data of an issue with the pull_request-field
-    # However, this is the only way to find out whether something is an issue or PR! yikes...
-    #
-    # If the data for the pull_request attribute is not set, we know it must be an issue (as otherwise we'd have
-    # obtained the relevant PR-data for free in our earlier request!)
-    if isinstance(issue_or_pr._pull_request, NotSet):
-        return True
-
-    # If the data is set, then we can just find out what it is
-    return issue_or_pr.pull_request is not None
-
-
-def find_issues(github, settings, logger):
+def _format_timestamp(value):
+    # GitHub returns timestamps as '2018-06-30T04:04:55Z'; the issues file contains them as '2018-06-30 04:04:55'
+    return None if value is None else f"{value[:10]} {value[11:19]}"
+
+
+def issue_row(item):
+    """
+        Returns the row of the issues file of a single search result (in the raw JSON of the search API),
+        which does not contain its body
+    """
+    # The repository URL ends in /repos/<owner>/<name>
+    repo_name = item["repository_url"].rsplit("/", 2)
+    return [repo_name[1] + "/" + repo_name[2], item["number"], item["title"], item["state"],
+        "pr" if "pull_request" in item else "issue",
+        _format_timestamp(item["created_at"]), _format_timestamp(item["updated_at"]),
+        _format_timestamp(item["closed_at"]), item["comments"]]
+
+
+class RawSearchClient:
+    """
+        Pages through the search API as raw JSON, so that no PyGithub objects are created for the results
+        (which could make hidden requests to complete themselves). Search requests that were made by anything else
+        (e.g. by lazy PyGithub objects, or by another process using the same token) are detected from the
+        rate limit usage that GitHub reports, and counted.
+    """
+    def __init__(self, github, logger):
+        # NB: PyGithub does not offer a public way to make raw requests
+        self.requester = github._Github__requester
+        self.logger = logger
+        self.last_usage = None
+        self.num_extra_requests = 0
+
+    def search(self, query, page=1):
+        """
+            Returns the raw JSON of a page of issues (and PRs) that match the query, including its 'total_count'
+        """
+        headers, data = self.requester.requestJsonAndCheck("GET", "/search/issues",
+            parameters={"q": query, "per_page": RESULTS_PER_PAGE, "page": page})
+        metrics.registry.inc("github_api_requests_total", endpoint="search/issues")
+        self._check_usage(headers)
+        return data
+
+    def _check_usage(self, headers):
+        headers = {key.lower(): value for key, value in headers.items()}
+        if headers.get("x-ratelimit-resource", "search") != "search" or "x-ratelimit-used" not in headers:
+            return
+
+        # Within the same rate limit window, the usage should increase by exactly one per request
+        usage = (headers.get("x-ratelimit-reset"), int(headers["x-ratelimit-used"]))
+        if self.last_usage is not None and usage[0] == self.last_usage[0] and usage[1] - self.last_usage[1] > 1:
+            num_extra_requests = usage[1] - self.last_usage[1] - 1
+            self.num_extra_requests += num_extra_requests
+            metrics.registry.inc("github_extra_requests_total", num_extra_requests, endpoint="search/issues")
+            self.logger.warning(f"> Detected {num_extra_requests} search request(s) that were not made by this search!")
+        self.last_usage = usage
+
+
+def find_issues(github, settings, logger, on_issue=None, on_window_done=None, date_range=None, date_field="created",
+        output_filename=None, append_bodies=False):
+    """
+        Finds all issues that match the settings, and outputs them to the issues file (or output_filename).
+        on_issue(row) is called for every issue that is output, and on_window_done() whenever all issues
+        in a window of creation dates were output (windows are processed from the earliest to the latest date).
+        By default, issues created between 'start-date' and 'end-date' are searched. Instead, date_range can contain
+        the (start, end) datetimes between which date_field (e.g. 'updated') should be.
+        The bodies of the issues are stored in the issue body store, which is replaced unless append_bodies is set.
+    """
     issue_query = construct_issue_search_query(settings)
     logger.info(f"Searching using the following query: {issue_query}")
+    search_client = RawSearchClient(github, logger)
 
     @rate_limited_retry_search(github)
-    def run_search_query(query):
-        results = github.search_issues(query)
-        return results, results.totalCount
-
-    @rate_limited_retry_search(github)
-    def process_search_results(search_results, csv_writer, max_results_to_process):
-        # !!! TODO: If the rate limit runs out during this loop, we will re-fetch all the issues of this
-        #   loop, even if they were already processed before. As a result, duplicates can occur in the output !!!
-        for result in search_results[:max_results_to_process]:
-            logger.debug(f"ISSUE PRINTED TO CSV: {'/'.join(result.url.split('/')[-4:-2])} ({result.number})")
-
-            csv_writer.writerow(["/".join(result.url.split("/")[-4:-2]), result.number, result.title, result.state,
-                    "issue" if is_issue(result) else "pr",
-                    result.created_at, result.updated_at,
-                    result.closed_at, result.comments, result.body])
+    def run_search_query(query, page=1):
+        return search_client.search(query, page)
+
+    def process_search_results(first_page, query, csv_writer, body_store, max_results_to_process):
+        # Pages are only written once they were fetched completely, so a page that runs into the rate limit
+        #   is fetched again without outputting its issues twice
+        page_data = first_page
+        page = 1
+        num_processed = 0
+        while True:
+            items = page_data["items"][:max_results_to_process - num_processed]
+            rows = [issue_row(item) for item in items]
+            csv_writer.writerows(rows)
+            for row, item in zip(rows, items):
+                body_store.add(row[0], row[1], item["body"])
+            if on_issue is not None:
+                for row in rows:
+                    on_issue(row)
+            logger.debug(f"> Output {len(rows)} issues of page {page}")
+
+            num_processed += len(rows)
+            if num_processed >= max_results_to_process or len(page_data["items"]) < RESULTS_PER_PAGE:
+                break
+            page += 1
+            page_data = run_search_query(query, page)
 
     max_results = settings.get("max-results")
     num_results_so_far = 0
@@ -77,30 +148,36 @@ def find_issues(github, settings, logger):
     logger.info(f"Search was started at {search_start_time}!")
     logger.info(f"NB: This might take a while, so grab a drink and relax!\n")
 
-    output_filename = settings.get('results-issues-output-file')
-    with open(output_filename, 'w', newline='', encoding='utf-8') as output_file:
-        csv_writer = csv.writer(output_file, quoting=csv.QUOTE_MINIMAL, escapechar="\\")
-        csv_writer.writerow(["repo", "number", "title", "state", "type", "created_at", "updated_at",
-                "closed_at", "num_comments", "body"])
+    if output_filename is None:
+        output_filename = settings.get('results-issues-output-file')
+    with open(output_filename, 'w', newline='', encoding='utf-8') as output_file, \
+            closing(IssueBodyStore(settings, logger, append=append_bodies)) as body_store:
+        csv_writer = csv.writer(output_file, **ISSUE_CSV_OPTIONS)
+        csv_writer.writerow(ISSUE_CSV_COLUMNS)
 
-        current_start_date = datetime.fromisoformat(settings.get("start-date"))
-        final_end_date = datetime.fromisoformat(settings.get("end-date"))
+        if date_range is None:
+            date_range = (datetime.fromisoformat(settings.get("start-date")), datetime.fromisoformat(settings.get("end-date")))
+        current_start_date, final_end_date = date_range
         current_end_date = final_end_date
 
         # Ensure we obtain all repositories from the start to end time
         while num_results_so_far < max_results:
             # Repeatedly halve the search space if we obtain too many results
             while True:
-                date_qualifier = f"created:{current_start_date.isoformat()}..{current_end_date.isoformat()}"
-                logger.info(f"Searching for issues created between {current_start_date} and {current_end_date}")
+                date_qualifier = f"{date_field}:{current_start_date.isoformat()}..{current_end_date.isoformat()}"
+                logger.info(f"Searching for issues {date_field} between {current_start_date} and {current_end_date}")
 
-                lazy_results, num_results = run_search_query(issue_query + date_qualifier)
+                first_page = run_search_query(issue_query + date_qualifier)
+                num_results = first_page["total_count"]
 
                 if num_results < MAX_RESULTS_PER_SEARCH:
                     max_results_to_process = min(num_results, max_results - num_results_so_far)
                     logger.info(f"> Query returned {num_results} search results! Processing {max_results_to_process} of them...")
-                    process_search_results(lazy_results, csv_writer, max_results_to_process)
+                    process_search_results(first_page, issue_query + date_qualifier, csv_writer, body_store,
+                        max_results_to_process)
                     num_results_so_far += max_results_to_process
+                    if on_window_done is not None:
+                        on_window_done()
                     break
 
                 logger.info("> Query returned too many search results... Halving search space...")
@@ -126,4 +203,6 @@ def find_issues(github, settings, logger):
     logger.info(f"====================")
     logger.info(f"Search was ended at {search_end_time}, and took {search_end_time - search_start_time} h:mm:ss!")
     logger.info(f"Obtained {num_results_so_far} results, which were output in {output_filename}!")
+    if search_client.num_extra_requests:
+        logger.warning(f"Detected {search_client.num_extra_requests} search requests that were not made by this search!")
     logger.warning("These results might contain duplicate issues! Please filter these out before continueing.")
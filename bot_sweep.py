@@ -0,0 +1,162 @@
+"""Contains the bot sweep, in which the issues of several bots (or queries) are studied in a single run"""
+
+import json
+import os
+from datetime import datetime
+
+from bot_issue_finder import SETTING_TO_QUALIFIER, find_issues
+from pre_bot_issue_finder import (clone_info_from_commit_index, filter_pre_bot_issues, find_pre_bot_issues,
+    load_earliest_todo_issues, obtain_cloned_repos, obtain_pre_post_data, remove_pre_duplicates)
+from repo_cloner import clone_repos
+from repo_finder import find_repos
+
+
+# Outputs of which each bot gets its own copy, in the same format as those of a single bot
+BOT_OUTPUTS = [
+    'results-issues-output-file',
+    'results-issue-bodies-file',
+    'results-issue-bodies-index-file',
+    'results-repos-output-file',
+    'results-todo-comments-pre-bot-output-file',
+    'results-clone-info-output-file',
+    'results-merged-output-file',
+]
+
+# Outputs that are shared by all bots of a sweep (the clones in 'download-output-path-repo' are shared as well)
+SHARED_OUTPUTS = [
+    'results-repos-output-file',
+    'results-todo-comments-pre-bot-output-file',
+    'results-clone-info-output-file',
+    'results-commit-index-output-file',
+]
+
+# Tag of the outputs that are shared by all bots
+SHARED_TAG = "all"
+
+# Settings that each bot can override (i.e. the settings of its search)
+BOT_SETTING_KEYS = list(SETTING_TO_QUALIFIER['issue_level']) + ['start-date', 'end-date', 'max-results']
+
+
+def bot_filename(filename, tag):
+    root, ext = os.path.splitext(filename)
+    return f"{root}.bot-{tag}{ext}"
+
+
+def apply_bot(settings, bot):
+    """
+        Returns a copy of the settings of a single bot of the sweep, with its own query settings and outputs
+    """
+    bot_settings = dict(settings)
+    for key, value in bot.items():
+        if key != 'name':
+            bot_settings[key] = value
+    for key in BOT_OUTPUTS:
+        bot_settings[key] = bot_filename(settings.get(key), bot['name'])
+    return bot_settings
+
+
+def apply_shared(settings):
+    """
+        Returns a copy of the settings of the outputs that are shared by all bots of the sweep
+    """
+    shared_settings = dict(settings)
+    for key in SHARED_OUTPUTS:
+        shared_settings[key] = bot_filename(settings.get(key), SHARED_TAG)
+    return shared_settings
+
+
+def verify_bots(bots):
+    if not bots:
+        raise ValueError("Setting 'bot-sweep' should contain at least one bot")
+
+    names = set()
+    for bot in bots:
+        name = bot.get('name')
+        if not name or name == SHARED_TAG or name in names:
+            raise ValueError(f"Each bot in 'bot-sweep' should have a unique 'name' (other than '{SHARED_TAG}'), got <{name}>")
+        names.add(name)
+        for key in bot:
+            if key != 'name' and key not in BOT_SETTING_KEYS:
+                raise ValueError(f"Invalid setting <{key}> of bot <{name}>, expected one of <{', '.join(BOT_SETTING_KEYS)}>")
+
+
+def run_bot_sweep(ctx, logger):
+    """
+        Runs the find_issues up to pre_post_data stages for every bot (or query) in 'bot-sweep'.
+        Each bot gets its own search and outputs, but the work for repositories that several bots created issues in
+        is done once: their information is fetched once, and they are cloned, walked and scanned once.
+        The scan covers the commits before the latest earliest todo issue (of all bots) of each repository;
+        the pre-bot issues and clone information of each bot are then obtained from that scan and the shared commit index.
+    """
+    settings = ctx.settings
+    if_logger = ctx.logger('issue_finder')
+    rf_logger = ctx.logger('repo_finder')
+    rc_logger = ctx.logger('repo_cloner')
+    pef_logger = ctx.logger('pre_issue_finder')
+    ctx.logger('general')
+
+    bots = settings.get('bot-sweep')
+    verify_bots(bots)
+    bot_settings = {bot['name']: apply_bot(settings, bot) for bot in bots}
+    shared_settings = apply_shared(settings)
+
+    start_time = datetime.now()
+    logger.info(f"Bot sweep was started at {start_time}! Studying {len(bots)} bots: {', '.join(bot_settings)}")
+
+    # Each bot gets its own search, but repository information is only fetched once
+    repo_cache = {}
+    for name, b_settings in bot_settings.items():
+        logger.info(f"Searching for the issues of bot <{name}>...")
+        find_issues(ctx.github, b_settings, if_logger)
+        if find_repos(ctx.github, b_settings, rf_logger, repo_cache):
+            msg = f"An error occurred while fetching the repositories of bot <{name}>!"
+            logger.error(msg)
+            raise ValueError(msg)
+
+    # All repositories (with the issues of all bots) are cloned into the same folder
+    repos = {}
+    for b_settings in bot_settings.values():
+        with open(b_settings.get('results-repos-output-file'), newline='', encoding='utf-8') as input_file:
+            for repo_name, repo in json.load(input_file).items():
+                if repo_name not in repos:
+                    repos[repo_name] = repo
+                elif not repo['skipped']:
+                    repos[repo_name]['issues'] += repo['issues']
+    with open(shared_settings.get('results-repos-output-file'), 'w', newline='', encoding='utf-8') as output_file:
+        output_file.write(json.dumps(repos))
+    logger.info(f"The bots created issues in {len(repos)} unique repositories, of which {len(repo_cache)} were fetched")
+
+    if settings.get('skip-cloning'):
+        rc_logger.info("Cloning is skipped as per the settings")
+    else:
+        clone_repos(shared_settings, rc_logger)
+
+    # Scan each repository once, up to the latest earliest todo issue of all bots
+    earliest_todo_issues = {name: load_earliest_todo_issues(b_settings.get('results-repos-output-file'))
+        for name, b_settings in bot_settings.items()}
+    latest_earliest_todo_issues = {}
+    for bot_earliest_todo_issues in earliest_todo_issues.values():
+        for repo_name, earliest in bot_earliest_todo_issues.items():
+            latest_earliest_todo_issues[repo_name] = max(latest_earliest_todo_issues.get(repo_name, earliest), earliest)
+    find_pre_bot_issues(shared_settings, pef_logger, latest_earliest_todo_issues)
+    obtain_cloned_repos(shared_settings, logger)
+
+    # Obtain the outputs of each bot from the shared scan and commit index
+    shared_pre_filename = shared_settings.get('results-todo-comments-pre-bot-output-file')
+    for name, b_settings in bot_settings.items():
+        filter_pre_bot_issues(shared_pre_filename, b_settings.get('results-todo-comments-pre-bot-output-file'),
+            earliest_todo_issues[name])
+        remove_pre_duplicates(b_settings, logger)
+
+        df_cloned_repos = clone_info_from_commit_index(shared_settings.get('results-clone-info-output-file'),
+            shared_settings.get('results-commit-index-output-file'), earliest_todo_issues[name])
+        df_cloned_repos.to_csv(b_settings.get('results-clone-info-output-file'), index=False)
+
+        obtain_pre_post_data(b_settings, logger)
+        logger.info(f"Output the results of bot <{name}> in {b_settings.get('results-merged-output-file')}")
+
+    # The shared scan is not deduplicated; only the outputs of the bots are
+    os.remove(shared_pre_filename)
+
+    end_time = datetime.now()
+    logger.info(f"Bot sweep was ended at {end_time}, and took {end_time - start_time} h:mm:ss!")
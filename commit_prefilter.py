@@ -0,0 +1,102 @@
+"""Contains the prefilter that decides which files (and commits) are passed to todo[bot]"""
+
+import os
+from fnmatch import fnmatch
+
+from pygit2 import GIT_DELTA_DELETED
+
+from diff_extractor import new_file_size, DEFAULT_MAX_FILE_SIZE
+
+
+# Files that todo[bot] would never report on, or which swamp it with noise
+DEFAULT_EXCLUDE_GLOBS = [
+    "*.min.*", "*.map", "*.lock", "package-lock.json", "yarn.lock", "go.sum",
+    "vendor/*", "*/vendor/*", "node_modules/*", "*/node_modules/*",
+    "dist/*", "build/*", "*.pb.go", "*_pb2.py", "*.generated.*",
+]
+
+# Maps file extensions to the language they are written in
+EXTENSION_TO_LANGUAGE = {
+    ".c": "c", ".h": "c",
+    ".cc": "c++", ".cpp": "c++", ".cxx": "c++", ".hpp": "c++", ".hh": "c++",
+    ".cs": "c#",
+    ".css": "css", ".scss": "css", ".sass": "css", ".less": "css",
+    ".dart": "dart",
+    ".ex": "elixir", ".exs": "elixir",
+    ".go": "go",
+    ".html": "html", ".htm": "html", ".vue": "vue",
+    ".java": "java",
+    ".js": "javascript", ".jsx": "javascript", ".mjs": "javascript", ".cjs": "javascript",
+    ".kt": "kotlin", ".kts": "kotlin",
+    ".lua": "lua",
+    ".m": "objective-c", ".mm": "objective-c",
+    ".php": "php",
+    ".py": "python",
+    ".r": "r",
+    ".rb": "ruby",
+    ".rs": "rust",
+    ".scala": "scala",
+    ".sh": "shell", ".bash": "shell", ".zsh": "shell",
+    ".sql": "sql",
+    ".swift": "swift",
+    ".ts": "typescript", ".tsx": "typescript",
+    ".yml": "yaml", ".yaml": "yaml",
+}
+
+
+def detect_language(path):
+    return EXTENSION_TO_LANGUAGE.get(os.path.splitext(path)[1].lower())
+
+
+class DeltaPrefilter:
+    """
+        Filters the deltas (changed files) of a commit on their path, language and size.
+        Globs without a '/' are matched against the file name, all others against the full path.
+    """
+    def __init__(self, include_globs=None, exclude_globs=None, languages="any", max_file_size=DEFAULT_MAX_FILE_SIZE):
+        self.include_globs = include_globs or ["*"]
+        self.exclude_globs = DEFAULT_EXCLUDE_GLOBS if exclude_globs is None else exclude_globs
+        self.languages = None if languages in ["any", None] else {language.lower() for language in languages}
+        self.max_file_size = max_file_size
+
+    @classmethod
+    def from_settings(cls, settings):
+        prefilter_settings = settings.get('pre-bot-prefilter') or {}
+        return cls(
+            include_globs=prefilter_settings.get('include-globs'),
+            exclude_globs=prefilter_settings.get('exclude-globs'),
+            languages=prefilter_settings.get('languages', "any"),
+            max_file_size=settings.get('max-diff-file-size', DEFAULT_MAX_FILE_SIZE),
+        )
+
+    @staticmethod
+    def _matches(path, globs):
+        name = os.path.basename(path)
+        return any(fnmatch(path if '/' in glob else name, glob) for glob in globs)
+
+    def accepts_path(self, path):
+        if not self._matches(path, self.include_globs) or self._matches(path, self.exclude_globs):
+            return False
+        return self.languages is None or detect_language(path) in self.languages
+
+    def filter_commit(self, repo, diff):
+        """
+            Returns (is_relevant, num_bytes), where is_relevant indicates whether at least one delta of the diff
+            passed the filter. If none did, num_bytes is the total size of the files that did not need to be diffed
+            (as far as the diff reports it; files are never loaded just to find their size).
+        """
+        num_bytes = 0
+        for delta in diff.deltas:
+            if delta.status == GIT_DELTA_DELETED:
+                continue
+
+            if not delta.is_binary and self.accepts_path(delta.new_file.path):
+                if self.max_file_size is None:
+                    return True, 0
+                size = new_file_size(repo, delta)
+                if size <= self.max_file_size:
+                    return True, 0
+                num_bytes += size
+            else:
+                num_bytes += delta.new_file.size
+        return False, num_bytes
@@ -0,0 +1,153 @@
+"""Contains the per-repository cost ledger, which records how expensive each repository was to process"""
+
+import argparse
+import csv
+import os
+import threading
+from datetime import datetime
+
+import util
+
+
+# Costs that are recorded for each repository
+LEDGER_COLUMNS = [
+    "clone_seconds",
+    "bytes_received",
+    "disk_bytes",
+    "total_commits",
+    "pre_bot_commits_scanned",
+    "scan_seconds",
+    "detector_invocations",
+]
+
+# The ledger is written to disk after this many updates (and at the end of each stage)
+LEDGER_SAVE_INTERVAL = 50
+
+# Ledgers that were opened, by filename; all stages of a run share the same ledger
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+
+def directory_size(path):
+    # Total size (in bytes) of all files in a folder
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+    return size
+
+
+class CostLedger:
+    """
+        One row per repository with its (most recently measured) costs, stored in a CSV file
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.rows = {}
+        self._lock = threading.Lock()
+        self._num_unsaved = 0
+
+        if os.path.isfile(filename):
+            with open(filename, newline='', encoding='utf-8') as ledger_file:
+                for row in csv.DictReader(ledger_file):
+                    self.rows[row['repo']] = {column: float(row[column]) for column in LEDGER_COLUMNS if row.get(column)}
+                    self.rows[row['repo']]['updated_at'] = row.get('updated_at')
+
+    def update(self, repo_name, accumulate=False, **costs):
+        """
+            Records the costs of a repository. If accumulate is set, the costs are added to those recorded before
+            (e.g. for a scan that continues an earlier scan), rather than replacing them.
+        """
+        for column in costs:
+            if column not in LEDGER_COLUMNS:
+                raise ValueError(f"Invalid ledger column <{column}>, expected one of <{', '.join(LEDGER_COLUMNS)}>")
+
+        with self._lock:
+            row = self.rows.setdefault(repo_name, {})
+            if accumulate:
+                costs = {column: row.get(column, 0) + value for column, value in costs.items()}
+            row.update(costs)
+            row['updated_at'] = datetime.now().isoformat(sep=" ", timespec="seconds")
+            self._num_unsaved += 1
+            should_save = self._num_unsaved >= LEDGER_SAVE_INTERVAL
+
+        if should_save:
+            self.save()
+
+    def get(self, repo_name, column, default=None):
+        with self._lock:
+            return self.rows.get(repo_name, {}).get(column, default)
+
+    def values(self, column):
+        """
+            Returns a dict with the recorded value of column for each repository for which it is known
+        """
+        with self._lock:
+            return {repo_name: row[column] for repo_name, row in self.rows.items() if row.get(column) is not None}
+
+    def merge(self, other):
+        """
+            Adds the rows of another ledger, replacing the rows of repositories that are in both
+        """
+        with self._lock, other._lock:
+            self.rows.update(other.rows)
+            self._num_unsaved += len(other.rows)
+
+    def save(self):
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+            tmp_filename = self.filename + ".tmp"
+            with open(tmp_filename, 'w', newline='', encoding='utf-8') as ledger_file:
+                csv_writer = csv.writer(ledger_file)
+                csv_writer.writerow(["repo"] + LEDGER_COLUMNS + ["updated_at"])
+                for repo_name, row in sorted(self.rows.items()):
+                    csv_writer.writerow([repo_name] + [row.get(column, "") for column in LEDGER_COLUMNS] + [row.get('updated_at')])
+            os.replace(tmp_filename, self.filename)
+            self._num_unsaved = 0
+
+    def top(self, num_repos, column):
+        """
+            Returns the num_repos most expensive (repo_name, row) pairs, where column 'total_seconds'
+            is the sum of the clone and scan time
+        """
+        def cost(item):
+            row = item[1]
+            if column == "total_seconds":
+                return row.get("clone_seconds", 0) + row.get("scan_seconds", 0)
+            return row.get(column, 0)
+
+        with self._lock:
+            return sorted(self.rows.items(), key=cost, reverse=True)[:num_repos]
+
+
+def get_ledger(settings):
+    """
+        Returns the ledger of 'results-cost-ledger-file' (shared by all stages), or None if no ledger is kept
+    """
+    filename = settings.get('results-cost-ledger-file')
+    if not filename:
+        return None
+    with _ledgers_lock:
+        if filename not in _ledgers:
+            _ledgers[filename] = CostLedger(filename)
+        return _ledgers[filename]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lists the repositories that were the most expensive to process")
+    parser.add_argument('--top', type=int, default=20, help="Number of repositories to list")
+    parser.add_argument('--by', default="total_seconds", choices=["total_seconds"] + LEDGER_COLUMNS, help="Cost to sort on")
+    parser.add_argument('--ledger', help="Ledger file to read (defaults to the one in settings.json)")
+    args = parser.parse_args()
+
+    filename = args.ledger or util.load_settings('settings.json').get('results-cost-ledger-file')
+    ledger = CostLedger(filename)
+
+    columns = ["total_seconds"] + LEDGER_COLUMNS if args.by == "total_seconds" else LEDGER_COLUMNS
+    print(f"{'repo':<60} " + " ".join(f"{column:>24}" for column in columns))
+    for repo_name, row in ledger.top(args.top, args.by):
+        row = dict(row, total_seconds=row.get("clone_seconds", 0) + row.get("scan_seconds", 0))
+        print(f"{repo_name:<60} " + " ".join(f"{row.get(column, ''):>24}" for column in columns))
@@ -0,0 +1,117 @@
+"""Contains a streaming extractor for the lines that a commit adds"""
+
+import itertools
+import os
+from collections import namedtuple
+
+from pygit2 import GIT_DELTA_DELETED
+
+import metrics
+
+
+# Files larger than this (in bytes) are never diffed. Such files are nearly always generated,
+#   vendored or minified, and todo[bot] would skip the resulting (huge) diff anyway.
+DEFAULT_MAX_FILE_SIZE = 1024 * 1024
+
+# A single line that was added by a commit
+AddedLine = namedtuple('AddedLine', ['path', 'line_number', 'content'])
+
+
+def commit_diff(commit):
+    """
+        Returns the (lazy) diff of a non-merge commit with respect to its first parent.
+        No patch text is generated until the diff's patches are iterated.
+    """
+    return commit.parents[0].tree.diff_to_tree(commit.tree)
+
+
+def new_file_size(repo, delta):
+    # The size of the new file is not always filled in for tree-to-tree diffs
+    size = delta.new_file.size
+    if not size and repo is not None:
+        size = repo[delta.new_file.id].size
+    return size
+
+
+def iter_added_lines(diff, repo=None, max_file_size=DEFAULT_MAX_FILE_SIZE, path_filter=None):
+    """
+        Yields an AddedLine for every line that is added in the given diff.
+        Deleted files, binary files, files larger than max_file_size and files for which
+        path_filter(path) is falsy are skipped before their patch is generated.
+        Deleted and context lines are never yielded.
+    """
+    for idx, delta in enumerate(diff.deltas):
+        if delta.status == GIT_DELTA_DELETED or delta.is_binary:
+            continue
+
+        path = delta.new_file.path
+        if path_filter is not None and not path_filter(path):
+            continue
+
+        if max_file_size is not None and new_file_size(repo, delta) > max_file_size:
+            continue
+
+        # Only now generate the patch of this single file
+        patch = diff[idx]
+        if patch.delta.is_binary:
+            continue
+
+        for hunk in patch.hunks:
+            for line in hunk.lines:
+                if line.origin == '+':
+                    yield AddedLine(path, line.new_lineno, line.content)
+
+
+def write_added_lines_diff(output_file, added_lines):
+    """
+        Writes the added lines as a (minimal) unified diff that todo[bot] can parse.
+        Each run of consecutive added lines becomes its own hunk, so line numbers are preserved.
+        Returns the number of added lines that were written.
+    """
+    num_lines = 0
+    current_path = None
+    hunk = []
+
+    def flush_hunk():
+        if hunk:
+            output_file.write(f"@@ -0,0 +{hunk[0].line_number},{len(hunk)} @@\n")
+            for added_line in hunk:
+                content = added_line.content
+                output_file.write(f"+{content}" if content.endswith('\n') else f"+{content}\n")
+            hunk.clear()
+
+    for added_line in added_lines:
+        if added_line.path != current_path:
+            flush_hunk()
+            current_path = added_line.path
+            output_file.write(f"diff --git a/{current_path} b/{current_path}\n")
+            output_file.write(f"--- a/{current_path}\n+++ b/{current_path}\n")
+        elif hunk and added_line.line_number != hunk[-1].line_number + 1:
+            flush_hunk()
+
+        hunk.append(added_line)
+        num_lines += 1
+
+    flush_hunk()
+    return num_lines
+
+
+def write_commit_diff(repo, commit, filename, max_file_size=DEFAULT_MAX_FILE_SIZE, path_filter=None, diff=None):
+    """
+        Writes the lines added by a non-merge commit to filename (see write_added_lines_diff).
+        The diff of the commit can be passed if it was already obtained.
+        No file is created if the commit does not add any (relevant) lines.
+        Returns the number of added lines that were written.
+    """
+    if diff is None:
+        diff = commit_diff(commit)
+    added_lines = iter_added_lines(diff, repo, max_file_size, path_filter)
+    first_line = next(added_lines, None)
+    if first_line is None:
+        return 0
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "w", encoding="utf-8") as diff_file:
+        num_lines = write_added_lines_diff(diff_file, itertools.chain([first_line], added_lines))
+        metrics.registry.inc("diff_bytes_written_total", diff_file.tell())
+    return num_lines
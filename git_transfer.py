@@ -0,0 +1,63 @@
+"""Contains the transfers (clones and fetches) of git data, which run in a separate process so that they can be killed once they exceed their budget"""
+
+import argparse
+import sys
+import tempfile
+
+from pygit2 import clone_repository, RemoteCallbacks, Repository
+from pygit2.errors import GitError
+
+from timeouts import run_with_timeout
+
+
+class TransferProgress(RemoteCallbacks):
+    """
+        Remembers the number of bytes that were received while cloning or fetching
+    """
+    def __init__(self):
+        super().__init__()
+        self.received_bytes = 0
+
+    def transfer_progress(self, stats):
+        self.received_bytes = stats.received_bytes
+
+
+def run_transfer(transfer_args, budget_seconds):
+    """
+        Runs a transfer (see the arguments below) in its own process, which is killed (by raising JobTimeout)
+        once it runs longer than budget_seconds (if not None); a stalled connection cannot block it any longer than that.
+        Returns the number of bytes that were received, and raises GitError if the transfer failed.
+    """
+    # NB: Only pygit2 (and the standard library) is imported by the process, as it is started for every transfer
+    with tempfile.TemporaryFile() as output_file, tempfile.TemporaryFile() as error_file:
+        return_code = run_with_timeout([sys.executable, __file__] + list(transfer_args), "clone", budget_seconds,
+            stdout=output_file, stderr=error_file)
+        if return_code != 0:
+            error_file.seek(0)
+            raise GitError(error_file.read().decode('utf-8', errors='replace').strip() or f"Transfer exited with code {return_code}")
+        output_file.seek(0)
+        return int(output_file.read() or 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Clones a repository, or fetches into one, and outputs the number of bytes that were received")
+    subparsers = parser.add_subparsers(dest='transfer', required=True)
+    clone_parser = subparsers.add_parser('clone')
+    clone_parser.add_argument('url')
+    clone_parser.add_argument('path')
+    fetch_parser = subparsers.add_parser('fetch')
+    fetch_parser.add_argument('path')
+    fetch_parser.add_argument('remote')
+    fetch_parser.add_argument('refspecs', nargs='*')
+    args = parser.parse_args()
+
+    progress = TransferProgress()
+    try:
+        if args.transfer == 'clone':
+            clone_repository(args.url, args.path, callbacks=progress)
+        else:
+            Repository(args.path).remotes[args.remote].fetch(args.refspecs or None, callbacks=progress)
+    except GitError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    print(progress.received_bytes)
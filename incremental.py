@@ -0,0 +1,230 @@
+"""Contains the incremental mode, in which only the issues, repositories and commits that are new since the last run are handled"""
+
+import csv
+import json
+import os
+from datetime import datetime
+
+from bot_issue_finder import find_issues
+from cost_ledger import get_ledger
+from issue_body_store import ISSUE_CSV_OPTIONS, migrate_issue_bodies
+from object_sharing import get_object_store
+from pre_bot_issue_finder import PreBotIssueScanner, append_pre_bot_issues, count_commits, remove_pre_duplicates
+from records import IssueColumns, RepoRecord, load_repos, parse_timestamp, save_repos
+from repo_cloner import RepoCloner
+from repo_finder import fetch_repo_info
+
+
+# The stages of which the outputs are updated by an incremental run
+INCREMENTAL_STAGES = ["find_issues", "find_repos", "clone_repos", "pre_bot_issues", "cloned_repos"]
+
+# Outputs of an earlier (full) run that an incremental run merges its results into
+INCREMENTAL_OUTPUTS = [
+    'results-issues-output-file',
+    'results-repos-output-file',
+    'results-todo-comments-pre-bot-output-file',
+    'results-clone-info-output-file',
+    'results-commit-index-output-file',
+]
+
+
+def _incremental_filename(filename):
+    root, ext = os.path.splitext(filename)
+    return f"{root}.incremental{ext}"
+
+
+def _parse_timestamp(value):
+    # Timestamps of GitHub are in UTC; older versions of PyGithub output them without a timezone
+    return datetime.fromisoformat(value).replace(tzinfo=None)
+
+
+def load_high_water_mark(settings):
+    """
+        Returns the (UTC) time at which the last successful sweep for issues started, or None if there was none.
+        If no sweep was recorded, the latest update of an issue in the issues file is used instead.
+    """
+    state_filename = settings.get('incremental-state-file')
+    if os.path.isfile(state_filename):
+        with open(state_filename, encoding='utf-8') as state_file:
+            return _parse_timestamp(json.load(state_file)['high_water_mark'])
+
+    high_water_mark = None
+    with open(settings.get('results-issues-output-file'), newline='', encoding='utf-8') as issue_file:
+        for row in csv.DictReader(issue_file, **ISSUE_CSV_OPTIONS):
+            if row['updated_at']:
+                updated_at = _parse_timestamp(row['updated_at'])
+                high_water_mark = updated_at if high_water_mark is None else max(high_water_mark, updated_at)
+    return high_water_mark
+
+
+def save_high_water_mark(settings, high_water_mark):
+    state_filename = settings.get('incremental-state-file')
+    os.makedirs(os.path.dirname(os.path.abspath(state_filename)), exist_ok=True)
+    tmp_filename = state_filename + ".tmp"
+    with open(tmp_filename, 'w', encoding='utf-8') as state_file:
+        json.dump({'high_water_mark': high_water_mark.isoformat()}, state_file)
+    os.replace(tmp_filename, state_filename)
+
+
+def upsert_csv_rows(filename, rows, key_columns, **csv_options):
+    """
+        Replaces the rows of a CSV file that have the same key (the values of key_columns) as one of the given rows (dicts),
+        and appends the other rows. The file is streamed, so only the given rows are kept in memory.
+    """
+    new_rows = {tuple(str(row[column]) for column in key_columns): row for row in rows}
+    tmp_filename = filename + ".tmp"
+    with open(filename, newline='', encoding='utf-8') as input_file, \
+            open(tmp_filename, 'w', newline='', encoding='utf-8') as output_file:
+        csv_reader = csv.DictReader(input_file, **csv_options)
+        csv_writer = csv.DictWriter(output_file, csv_reader.fieldnames, **csv_options)
+        csv_writer.writeheader()
+        for row in csv_reader:
+            if tuple(row[column] for column in key_columns) not in new_rows:
+                csv_writer.writerow(row)
+        csv_writer.writerows(new_rows.values())
+    os.replace(tmp_filename, filename)
+
+
+def load_repo_issues(issues_filename, repo_names):
+    """
+        Returns the issues (as IssueColumns) of the given repositories
+    """
+    issues = {repo_name: IssueColumns() for repo_name in repo_names}
+    with open(issues_filename, newline='', encoding='utf-8') as issue_file:
+        for row in csv.DictReader(issue_file, **ISSUE_CSV_OPTIONS):
+            if row['repo'] in issues:
+                issues[row['repo']].append(row['number'], parse_timestamp(row['created_at']), row['state'])
+    return issues
+
+
+def load_indexed_commits(index_filename, repo_names):
+    """
+        Returns the commits in the commit index of each of the given repositories
+    """
+    indexed_commits = {repo_name: set() for repo_name in repo_names}
+    with open(index_filename, newline='', encoding='utf-8') as index_file:
+        for row in csv.DictReader(index_file):
+            if row['repo'] in indexed_commits:
+                indexed_commits[row['repo']].add(row['commit'])
+    return indexed_commits
+
+
+def run_incremental(ctx, logger):
+    """
+        Updates the outputs of an earlier (full) run with the issues that were created or updated since its last sweep.
+        Only the repositories of those issues are fetched again; those that are new, or of which 'updated_at' changed,
+        are cloned (or fetched), and only their commits that are not in the commit index yet are scanned.
+        The results are merged into the outputs of the find_issues up to cloned_repos stages.
+    """
+    settings = ctx.settings
+    if_logger = ctx.logger('issue_finder')
+    rf_logger = ctx.logger('repo_finder')
+    rc_logger = ctx.logger('repo_cloner')
+    pef_logger = ctx.logger('pre_issue_finder')
+    ctx.logger('general')
+
+    missing_outputs = [settings.get(key) for key in INCREMENTAL_OUTPUTS if not os.path.isfile(settings.get(key))]
+    if missing_outputs:
+        msg = f"An incremental run requires the outputs of a full run; missing {', '.join(missing_outputs)}"
+        logger.error(msg)
+        raise ValueError(msg)
+
+    # The new issues do not contain their bodies, so the bodies of an older issues file are moved into the store first
+    if migrate_issue_bodies(settings, logger):
+        logger.info("Moved the issue bodies of the earlier run into the issue body store")
+
+    high_water_mark = load_high_water_mark(settings)
+    if high_water_mark is None:
+        msg = "The issues file does not contain any issues; perform a full run first!"
+        logger.error(msg)
+        raise ValueError(msg)
+
+    start_time = datetime.now()
+    sweep_start_time = datetime.utcnow().replace(microsecond=0)
+    logger.info(f"Incremental run was started at {start_time}! Handling the issues updated since {high_water_mark} (UTC).")
+
+    # Issues that were created since the last sweep were also updated since then
+    issues_filename = settings.get('results-issues-output-file')
+    new_issues_filename = _incremental_filename(issues_filename)
+    find_issues(ctx.github, settings, if_logger, date_range=(high_water_mark, sweep_start_time), date_field="updated",
+        output_filename=new_issues_filename, append_bodies=True)
+    with open(new_issues_filename, newline='', encoding='utf-8') as new_issue_file:
+        new_issues = list(csv.DictReader(new_issue_file, **ISSUE_CSV_OPTIONS))
+    upsert_csv_rows(issues_filename, new_issues, ["repo", "number"], **ISSUE_CSV_OPTIONS)
+    os.remove(new_issues_filename)
+    logger.info(f"Merged {len(new_issues)} new or updated issues into {issues_filename}")
+
+    # Only the repositories of the new issues are fetched again
+    repos_filename = settings.get('results-repos-output-file')
+    repos = load_repos(repos_filename)
+
+    touched_repo_names = sorted({row['repo'] for row in new_issues})
+    changed_repo_names = []
+    for repo_name in touched_repo_names:
+        old_repo = repos.get(repo_name)
+        repo_info, _ = fetch_repo_info(ctx.github, repo_name, settings, rf_logger)
+        if old_repo is None or old_repo.get('skipped') or old_repo.get('updated_at') != repo_info.get('updated_at'):
+            repos[repo_name] = RepoRecord(repo_name, repo_info)
+            if not repo_info['skipped']:
+                changed_repo_names.append(repo_name)
+
+    repo_issues = load_repo_issues(issues_filename, touched_repo_names)
+    for repo_name in touched_repo_names:
+        if repos[repo_name].issues is not None:
+            repos[repo_name].issues = repo_issues[repo_name]
+
+    save_repos(repos, repos_filename)
+    logger.info(f"Fetched {len(touched_repo_names)} repositories, of which {len(changed_repo_names)} are new or changed")
+
+    # Clone the new repositories, and fetch the new commits of the others
+    output_path = settings.get('download-output-path-repo')
+    updated_repo_names = []
+    if settings.get('skip-cloning'):
+        rc_logger.info("Cloning is skipped as per the settings")
+    else:
+        cloner = RepoCloner(settings, rc_logger, get_object_store(settings, repos))
+        for repo_name in changed_repo_names:
+            # Clones and fetches that are retried (e.g. because they timed out) are scanned once their retry succeeded
+            on_retry_success = lambda name=repo_name: updated_repo_names.append(name)
+            if os.path.isdir(os.path.join(output_path, repo_name)):
+                if cloner.update(repo_name, on_retry_success=on_retry_success):
+                    updated_repo_names.append(repo_name)
+            elif cloner.clone_with_retries(repo_name, repos[repo_name], on_retry_success=on_retry_success) == "success":
+                updated_repo_names.append(repo_name)
+        cloner.wait_for_retries()
+        if cloner.ledger is not None:
+            cloner.ledger.save()
+
+    # Scan only the commits that were not indexed before, and add those to the index
+    ledger = get_ledger(settings)
+    pre_filename = settings.get('results-todo-comments-pre-bot-output-file')
+    new_pre_filename = _incremental_filename(pre_filename)
+    scanner = PreBotIssueScanner(dict(settings, **{'results-todo-comments-pre-bot-output-file': new_pre_filename}), pef_logger)
+    indexed_commits = load_indexed_commits(settings.get('results-commit-index-output-file'), updated_repo_names)
+    earliest_issues = {}
+    clone_info_rows = []
+    with open(settings.get('results-commit-index-output-file'), 'a', newline='', encoding='utf-8') as index_file:
+        commit_index = csv.writer(index_file)
+        for repo_name in sorted(updated_repo_names):
+            owner, name = repo_name.split('/', 1)
+            repo_path = os.path.join(output_path, owner, name)
+            earliest = earliest_issues[repo_name] = repos[repo_name].issues.earliest()
+            try:
+                if earliest is not None:
+                    scanner.scan_repo(owner, name, repo_path, earliest, skip_commits=indexed_commits[repo_name])
+                clone_info_rows.append(count_commits(repo_name, repo_path, earliest, ledger, commit_index, indexed_commits[repo_name]))
+            except Exception as e:
+                pef_logger.error(f"Unexpected {type(e)} (Exception) for <{repo_name}>: {e}")
+    scanner.retry_timeouts(output_path, earliest_issues, skip_commits=indexed_commits)
+    scanner.finish()
+
+    append_pre_bot_issues(new_pre_filename, pre_filename)
+    os.remove(new_pre_filename)
+    remove_pre_duplicates(settings, logger)
+    upsert_csv_rows(settings.get('results-clone-info-output-file'), clone_info_rows, ["repo"])
+
+    save_high_water_mark(settings, sweep_start_time)
+
+    end_time = datetime.now()
+    logger.info(f"Incremental run was ended at {end_time}, and took {end_time - start_time} h:mm:ss! "
+        f"Scanned the new commits of {len(updated_repo_names)} repositories.")
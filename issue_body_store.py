@@ -0,0 +1,190 @@
+"""Contains the issue body store, in which the (highly redundant) bodies of the issues are kept apart from the issues file"""
+
+import argparse
+import csv
+import hashlib
+import os
+import zlib
+
+import metrics
+import util
+
+
+# CSV options of the issues file, of which the titles (and bodies, before they were moved to the store) can contain escaped characters
+ISSUE_CSV_OPTIONS = {"quoting": csv.QUOTE_MINIMAL, "escapechar": "\\"}
+
+# Columns of the index of the store. Records are referenced by the digest of the body, so identical bodies are stored once
+INDEX_COLUMNS = ["repo", "number", "digest", "offset", "length", "encoding"]
+
+# Text that the issues of todo[bot] are generated from (see lib/templates and the snapshots of its tests).
+#   zlib prefers matches near the end of its preset dictionary, so the most common text comes last
+TEMPLATE_DICTIONARY = "".join([
+    "## ",
+    "This issue has been reopened because the **`TODO`** comment still exists in [**",
+    "), as of ",
+    ".\n\n---\n\n###### If this was not intentional, just remove the comment from your code. You can also set the "
+    "[`reopenClosed`](https://github.com/JasonEtco/todo#configuring-for-your-project) config if you don't want this "
+    "to happen at all anymore.",
+    "`FIXME`",
+    " when #",
+    " was merged.",
+    " It&#x27;s been automagically assigned to @",
+    " It&#x27;s been assigned to @",
+    " because they committed the code.",
+    "\n\n---\n\n",
+    "###### This issue was generated by [todo](https://todo.jasonet.co) based on a `TODO` comment in ",
+    "https://github.com/",
+    "/blob/",
+    "#L",
+]).encode("utf-8")
+
+# Preset dictionary of each encoding. Bodies are encoded as raw deflate streams (without a header or checksum)
+ENCODINGS = {
+    "zlib": b"",
+    "template": TEMPLATE_DICTIONARY,
+}
+
+
+def _compress(data, encoding):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=ENCODINGS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+
+def _decompress(data, encoding):
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=ENCODINGS[encoding])
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+def verify_encoding(encoding):
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Invalid setting passed for <issue-body-encoding>. Got <{encoding}>, "
+                         f"but expected one of <{', '.join(ENCODINGS)}>")
+
+
+class IssueBodyStore:
+    """
+        Stores the bodies of issues in a record file of compressed bodies, and an index (CSV) that references the
+        record of each issue by its (repo, number)-key. If an issue is stored more than once (e.g. because it was
+        updated), its last entry in the index is used.
+    """
+    def __init__(self, settings, logger, append=False):
+        self.logger = logger
+        self.encoding = settings.get('issue-body-encoding')
+        verify_encoding(self.encoding)
+        self.records_filename = settings.get('results-issue-bodies-file')
+        self.index_filename = settings.get('results-issue-bodies-index-file')
+
+        # Digest of each stored body -> (offset, length, encoding) of its record
+        self.records = {}
+        append = append and os.path.isfile(self.records_filename) and os.path.isfile(self.index_filename)
+        if append:
+            with open(self.index_filename, newline='', encoding='utf-8') as index_file:
+                for row in csv.DictReader(index_file):
+                    self.records[row['digest']] = (int(row['offset']), int(row['length']), row['encoding'])
+
+        for filename in [self.records_filename, self.index_filename]:
+            os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.record_file = open(self.records_filename, 'ab' if append else 'wb')
+        self.offset = self.record_file.seek(0, os.SEEK_END)
+        self.index_file = open(self.index_filename, 'a' if append else 'w', newline='', encoding='utf-8')
+        self.index_writer = csv.writer(self.index_file)
+        if not append:
+            self.index_writer.writerow(INDEX_COLUMNS)
+
+        self.num_bodies = 0
+        self.num_records = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+
+    def add(self, repo_name, number, body):
+        if not body:
+            # Issues without a body are not stored
+            return
+
+        data = body.encode('utf-8')
+        digest = hashlib.sha1(data).hexdigest()
+        record = self.records.get(digest)
+        if record is None:
+            compressed = _compress(data, self.encoding)
+            self.record_file.write(compressed)
+            record = self.records[digest] = (self.offset, len(compressed), self.encoding)
+            self.offset += len(compressed)
+            self.num_records += 1
+            self.stored_bytes += len(compressed)
+            metrics.registry.inc("issue_body_bytes_total", len(compressed), kind="stored")
+
+        self.index_writer.writerow([repo_name, number, digest, *record])
+        self.num_bodies += 1
+        self.raw_bytes += len(data)
+        metrics.registry.inc("issue_body_bytes_total", len(data), kind="raw")
+
+    def close(self):
+        self.record_file.close()
+        self.index_file.close()
+        if self.num_bodies:
+            self.logger.info(f"Stored {self.num_bodies} issue bodies ({self.raw_bytes} bytes) as {self.num_records} new records "
+                f"({self.stored_bytes} bytes) in {self.records_filename}")
+
+
+def load_issue_bodies(settings, issue_keys=None):
+    """
+        Returns the body of each issue in the store, by (repo, number)-key (of which the number is a string).
+        If issue_keys is given, only the bodies of those issues are read. Issues without a body are left out.
+    """
+    entries = {}
+    with open(settings.get('results-issue-bodies-index-file'), newline='', encoding='utf-8') as index_file:
+        for row in csv.DictReader(index_file):
+            key = (row['repo'], row['number'])
+            if issue_keys is None or key in issue_keys:
+                entries[key] = (int(row['offset']), int(row['length']), row['encoding'])
+
+    # Each record is read (in the order of the file) and decompressed once, even if it is referenced by several issues
+    bodies = {}
+    with open(settings.get('results-issue-bodies-file'), 'rb') as record_file:
+        for offset, length, encoding in sorted(set(entries.values())):
+            record_file.seek(offset)
+            bodies[offset] = _decompress(record_file.read(length), encoding).decode('utf-8')
+    return {key: bodies[entry[0]] for key, entry in entries.items()}
+
+
+def migrate_issue_bodies(settings, logger):
+    """
+        Moves the bodies of an issues file of an older version (which contains a body column) into the store.
+        Returns whether the issues file was migrated.
+    """
+    issues_filename = settings.get('results-issues-output-file')
+    with open(issues_filename, newline='', encoding='utf-8') as issue_file:
+        columns = next(csv.reader(issue_file, **ISSUE_CSV_OPTIONS), [])
+    if "body" not in columns:
+        return False
+
+    logger.info(f"Moving the issue bodies of {issues_filename} into {settings.get('results-issue-bodies-file')}...")
+    store = IssueBodyStore(settings, logger, append=True)
+    tmp_filename = issues_filename + ".tmp"
+    try:
+        with open(issues_filename, newline='', encoding='utf-8') as input_file, \
+                open(tmp_filename, 'w', newline='', encoding='utf-8') as output_file:
+            csv_reader = csv.DictReader(input_file, **ISSUE_CSV_OPTIONS)
+            csv_writer = csv.DictWriter(output_file, [column for column in columns if column != "body"],
+                extrasaction='ignore', **ISSUE_CSV_OPTIONS)
+            csv_writer.writeheader()
+            for row in csv_reader:
+                store.add(row['repo'], row['number'], row['body'])
+                csv_writer.writerow(row)
+    finally:
+        store.close()
+    os.replace(tmp_filename, issues_filename)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Moves the bodies of an issues file of an older version into the issue body store")
+    parser.add_argument('--issues', help="Issues file to migrate (defaults to the one in settings.json)")
+    args = parser.parse_args()
+
+    settings = util.load_settings('settings.json')
+    if args.issues:
+        settings['results-issues-output-file'] = args.issues
+    logger = util.create_logger("issue_body_store", "INFO")
+    if not migrate_issue_bodies(settings, logger):
+        logger.info(f"{settings.get('results-issues-output-file')} does not contain any issue bodies; nothing to migrate")
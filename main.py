@@ -1,24 +1,71 @@
-import logging
-import os
-
-from github import Github, enable_console_debug_logging
+import argparse
 
+import metrics
 import util
-from bot_issue_finder import find_issues
-from repo_finder import find_repos
-from repo_cloner import clone_repos
-import pre_bot_issue_finder
-import repo_analyser_v2
+import stages
+import pipeline
+import sharding
+import incremental
+import bot_sweep
+import sampling
+import planner
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Identifies, clones and analyses the repositories in which a bot created issues")
+    parser.add_argument('--target', default=stages.STAGES[-1].name, choices=list(stages.STAGES_BY_NAME),
+        help="Stage to run; its prerequisites are (re)run only if something upstream of them changed")
+    parser.add_argument('--force', action='store_true', help="Rerun the target stage, even if it is up to date")
+    parser.add_argument('--list-stages', action='store_true', help="List all stages and their prerequisites")
+    parser.add_argument('--dry-run', action='store_true',
+        help="Predict the API calls, rate limit waits, downloads, disk space and scan time of running the target, without running it")
+    mode_group = parser.add_mutually_exclusive_group()
+    mode_group.add_argument('--pipelined', action='store_true',
+        help="Overlap the searching, fetching of metadata, cloning and scanning of repositories")
+    mode_group.add_argument('--rolling', action='store_true',
+        help="Clone, scan and remove repositories, such that the clones never exceed 'disk-budget-mb'")
+    mode_group.add_argument('--incremental', action='store_true',
+        help="Only handle the issues, repositories and commits that are new since the last run")
+    mode_group.add_argument('--bot-sweep', action='store_true',
+        help="Study every bot in 'bot-sweep', sharing the repository information and clones of overlapping repositories")
+    mode_group.add_argument('--sample', action='store_true',
+        help="Estimate the outcomes of the analysis (with confidence intervals) from a stratified sample of the repositories")
+    parser.add_argument('--shard-index', type=int, help="Shard (0 <= index < shard count) of the clone and scan stages to run")
+    parser.add_argument('--shard-count', type=int, help="Number of shards the repositories are partitioned into")
+    parser.add_argument('--merge-shards', action='store_true', help="Merge the outputs of all shards (of --shard-count)")
+    args = parser.parse_args()
+
+    if args.shard_index is not None and args.shard_count is None or args.merge_shards and args.shard_count is None:
+        parser.error("--shard-index and --merge-shards require --shard-count")
+    if args.shard_index is not None and args.pipelined:
+        parser.error("--pipelined cannot be sharded, as every shard would search all issues")
+    if args.shard_index is not None and args.incremental:
+        parser.error("--incremental cannot be sharded, as every shard would search all new issues")
+    if args.shard_index is not None and args.bot_sweep:
+        parser.error("--bot-sweep cannot be sharded, as every shard would search all issues")
+    if args.shard_index is not None and args.sample:
+        parser.error("--sample cannot be sharded")
+    if args.dry_run and (args.pipelined or args.rolling or args.incremental or args.bot_sweep or args.sample
+            or args.merge_shards or args.shard_index is not None):
+        parser.error("--dry-run only plans the stages of a standard run")
+
+    if args.list_stages:
+        for stage in stages.STAGES:
+            prerequisites = [s.name for s in stages.required_stages(stage.name) if s is not stage]
+            print(f"{stage.name}: {', '.join(prerequisites) or '-'}")
+        raise SystemExit
+
     settings = util.load_settings('settings.json')
     util.verify_loglevels(settings.get('loglevels'))
-    loglevels = settings.get('loglevels')
-    logoutputs = settings.get('logoutputs')
+    if args.shard_index is not None:
+        settings = sharding.apply_shard(settings, args.shard_index, args.shard_count)
+
+    # Load GitHub Login information
+    login_settings = util.load_settings('login.json')
+
+    ctx = stages.StageContext(settings, login_settings)
 
     # General logger
-    logger = util.create_logger('bot_issue_finder', loglevels.get('general'), logoutputs.get('general'))
-    util.g_logger = logger
+    logger = ctx.logger('general')
 
     logger.info("======SETTINGS======")
     util.verify_settings(settings)
@@ -26,9 +73,6 @@ if __name__ == "__main__":
     if settings.get('log-pygithub-requests'):
         util.load_gh_logger(settings.get('shorten-pygithub-requests'))
 
-    # Load GitHub Login information
-    login_settings = util.load_settings('login.json')
-
     token_or_username = login_settings.get('login_or_token')
     if token_or_username and login_settings.get('password'):
         # Someone logged in with their username/password combination
@@ -46,97 +90,47 @@ if __name__ == "__main__":
     else:
         logger.info(f"Using the standard API endpoint at {util.STANDARD_API_ENDPOINT}")
 
-    # Initialize PyGithub
-    github = Github(per_page=100, **login_settings)
-
     logger.info("====================\n")
 
-    # Issue finder logger
-    if_logger = util.create_logger('issue_finder', loglevels.get('issue_finder'), logoutputs.get('issue_finder'))
-    util.g_logger = if_logger
-
-    # Find issues
-    has_already_found_repos = os.path.isfile(settings.get('results-repos-output-file'))
-    if has_already_found_repos:
-        # Repositories were already fetched
-        if_logger.info("Repositories were already fetched. Skipping the issue fetching phase!")
-    elif os.path.isfile(settings.get('results-issues-output-file')):
-        # Issues were already fetched
-        if_logger.info("Found an existing issues file; using that instead!")
-    else:
-        # Issues were not yet fetched
-        find_issues(github, settings, if_logger)
-
-    # Repo finder logger
-    rf_logger = util.create_logger('repo_finder', loglevels.get('repo_finder'), logoutputs.get('repo_finder'))
-    util.g_logger = rf_logger
-
-    # Find repositories
-    if has_already_found_repos:
-        rf_logger.info("Found an existing repo file; using that instead!")
-    else:
-        was_error = find_repos(github, settings, rf_logger)
-        if was_error:
-            msg = "An error occurred while fetching repositories!"
-            if_logger.error(msg)
-            raise ValueError(msg)
-
-
-    # Repo cloner logger
-    rc_logger = util.create_logger('repo_cloner', loglevels.get('repo_cloner'), logoutputs.get('repo_cloner'))
-    util.g_logger = rc_logger
-
-    if not settings.get('skip-cloning'):
-        # Clone repositories
-        clone_repos(settings, rc_logger)
-
-
-    # Pre-bot issue logger
-    pef_logger = util.create_logger('pre_issue_finder', loglevels.get('pre_issue_finder'), logoutputs.get('pre_issue_finder'))
-    util.g_logger = pef_logger
-
-    if True:
-        pre_bot_issue_finder.find_pre_bot_issues(settings, pef_logger)
-        pre_bot_issue_finder.remove_pre_duplicates(settings, logger)
-
-    if True:
-        pre_bot_issue_finder.obtain_pre_post_data(settings, logger)
-        pre_bot_issue_finder.obtain_cloned_repos(settings, logger)
-
-
-    # Use the standard logger for all other tasks
-    util.g_logger = logger
-
-    # The following figure generation steps are not in a particular order.
-    if False:
-        repo_analyser_v2.find_usage_numbers(settings, logger)
-
-    if False:
-        repo_analyser_v2.plot_stars_forks_watchers_hist(settings, logger)
-
-    if False:
-        repo_analyser_v2.plot_stars_forks_watchers_scatter(settings, logger)
-
-    if False:
-        repo_analyser_v2.plot_commits(settings, logger)
-
-    if False:
-        repo_analyser_v2.plot_issues(settings, logger)
-
-    if False:
-        repo_analyser_v2.plot_issues_by_date(settings, logger)
-
-    if False:
-        repo_analyser_v2.plot_repo_creation_updated(settings, logger)
-
-    if False:
-        repo_analyser_v2.plot_pre_todo(settings, logger)
-
-    if False:
-        repo_analyser_v2.plot_pre_post_todo(settings, logger)
-
-    if False:
-        repo_analyser_v2.plot_pre_post_conclusion(settings, logger)
-
-    if False:
-        repo_analyser_v2.plot_commits_pre(settings, logger)
+    # Only the clone and scan stages run per shard; their prerequisites should have been run without sharding
+    allowed_stages = sharding.SHARDED_STAGES if args.shard_index is not None else None
+
+    try:
+        if args.dry_run:
+            planner.plan_run(ctx, args.target, logger, force=args.force)
+        elif args.merge_shards:
+            sharding.merge_shards(settings, args.shard_count, logger)
+            stages.mark_stages_up_to_date(settings, sharding.SHARDED_STAGES)
+        else:
+            if args.pipelined:
+                with metrics.registry.timer("stage_duration_seconds", stage="pipelined"):
+                    pipeline.run_pipelined(ctx, logger)
+                stages.mark_stages_up_to_date(settings, pipeline.PIPELINED_STAGES)
+            elif args.rolling:
+                stages.run_stages(ctx, pipeline.ROLLING_PREREQUISITE, logger, allowed_stages=allowed_stages)
+                with metrics.registry.timer("stage_duration_seconds", stage="rolling"):
+                    pipeline.run_rolling(ctx, logger)
+                stages.mark_stages_up_to_date(settings, pipeline.ROLLING_STAGES)
+            elif args.incremental:
+                with metrics.registry.timer("stage_duration_seconds", stage="incremental"):
+                    incremental.run_incremental(ctx, logger)
+                stages.mark_stages_up_to_date(settings, incremental.INCREMENTAL_STAGES)
+
+            if args.bot_sweep:
+                # The results of each bot are output separately, so no stages are run afterwards
+                with metrics.registry.timer("stage_duration_seconds", stage="bot_sweep"):
+                    bot_sweep.run_bot_sweep(ctx, logger)
+            elif args.sample:
+                # The sample only needs the repositories; its estimates are output separately
+                stages.run_stages(ctx, "find_repos", logger)
+                with metrics.registry.timer("stage_duration_seconds", stage="sample"):
+                    sampling.run_sampling(ctx, logger)
+            elif allowed_stages is None:
+                # Run the target stage, and (re)build its prerequisites on demand
+                stages.run_stages(ctx, args.target, logger, force=args.force)
+                planner.compare_with_plan(settings, args.target, logger)
+            else:
+                for target in sharding.SHARDED_STAGES:
+                    stages.run_stages(ctx, target, logger, force=args.force and target == args.target, allowed_stages=allowed_stages)
+    finally:
+        metrics.registry.write(settings, logger)
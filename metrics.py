@@ -0,0 +1,191 @@
+"""Contains the counters, histograms and timers that are collected across all stages, and the (opt-in) stage profiler"""
+
+import cProfile
+import json
+import math
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+# Upper bounds of the histogram buckets. These span both durations (in seconds) and sizes (in bytes)
+HISTOGRAM_BUCKETS = [10.0 ** exponent for exponent in range(-3, 11)] + [math.inf]
+
+# Number of lines with the most allocated memory that are logged when profiling a stage
+TRACEMALLOC_TOP_LINES = 10
+
+
+class _Histogram:
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.bucket_counts = [0] * len(HISTOGRAM_BUCKETS)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        for idx, upper_bound in enumerate(HISTOGRAM_BUCKETS):
+            if value <= upper_bound:
+                self.bucket_counts[idx] += 1
+                break
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(label_key, extra=()):
+    labels = list(label_key) + list(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def _format_bound(upper_bound):
+    return "+Inf" if upper_bound == math.inf else repr(upper_bound)
+
+
+class MetricsRegistry:
+    """
+        Thread-safe collection of (labelled) counters, gauges and histograms
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[(name, _label_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = _Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+            Observes the number of seconds that the code in this context took in histogram <name>
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def counter_value(self, name, **labels):
+        with self._lock:
+            return self.counters.get((name, _label_key(labels)), 0)
+
+    def histogram_sum(self, name, **labels):
+        with self._lock:
+            histogram = self.histograms.get((name, _label_key(labels)))
+            return histogram.sum if histogram is not None else 0.0
+
+    def summary(self):
+        with self._lock:
+            return {
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())],
+                "gauges": [{"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.gauges.items())],
+                "histograms": [{"name": name, "labels": dict(labels), "count": h.count, "sum": h.sum,
+                        "min": h.min if h.count else None, "max": h.max if h.count else None,
+                        "mean": h.sum / h.count if h.count else None}
+                    for (name, labels), h in sorted(self.histograms.items())],
+            }
+
+    def prometheus_text(self):
+        lines = []
+        with self._lock:
+            for metrics, metric_type in [(self.counters, "counter"), (self.gauges, "gauge")]:
+                previous_name = None
+                for (name, labels), value in sorted(metrics.items()):
+                    if name != previous_name:
+                        lines.append(f"# TYPE {name} {metric_type}")
+                        previous_name = name
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+
+            previous_name = None
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name != previous_name:
+                    lines.append(f"# TYPE {name} histogram")
+                    previous_name = name
+                cumulative_count = 0
+                for upper_bound, bucket_count in zip(HISTOGRAM_BUCKETS, h.bucket_counts):
+                    cumulative_count += bucket_count
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', _format_bound(upper_bound))])} {cumulative_count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {h.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, settings, logger):
+        """
+            Writes the summary of all metrics in JSON and in the Prometheus text format
+        """
+        json_filename = settings.get('metrics-output-file')
+        prometheus_filename = settings.get('metrics-prometheus-output-file')
+        if json_filename:
+            os.makedirs(os.path.dirname(os.path.abspath(json_filename)), exist_ok=True)
+            with open(json_filename, 'w', encoding='utf-8') as output_file:
+                json.dump(self.summary(), output_file, indent=4)
+        if prometheus_filename:
+            os.makedirs(os.path.dirname(os.path.abspath(prometheus_filename)), exist_ok=True)
+            with open(prometheus_filename, 'w', encoding='utf-8') as output_file:
+                output_file.write(self.prometheus_text())
+        logger.info(f"Metrics were output in {json_filename} and {prometheus_filename}")
+
+
+# The registry that all stages report to
+registry = MetricsRegistry()
+
+
+@contextmanager
+def profile_stage(stage_name, settings, logger):
+    """
+        Profiles the code in this context with cProfile and tracemalloc, if the stage is listed in 'profile-stages'.
+        The cProfile statistics are output in '<profile-output-path>/<stage>.prof' and the lines that allocated
+        the most memory are logged.
+    """
+    profiled_stages = settings.get('profile-stages') or []
+    if stage_name not in profiled_stages and "*" not in profiled_stages:
+        yield
+        return
+
+    output_path = settings.get('profile-output-path')
+    os.makedirs(output_path, exist_ok=True)
+
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        if not was_tracing:
+            tracemalloc.stop()
+
+        profile_filename = os.path.join(output_path, f"{stage_name}.prof")
+        profiler.dump_stats(profile_filename)
+        logger.info(f"Profile of stage <{stage_name}> was output in {profile_filename} (peak memory: {peak_memory / 2**20:.1f} MiB)")
+        for stat in snapshot.statistics('lineno')[:TRACEMALLOC_TOP_LINES]:
+            logger.info(f"> {stat}")
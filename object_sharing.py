@@ -0,0 +1,167 @@
+"""Contains the shared object stores, which let forks (and near-copies) of the same repository share their git objects"""
+
+import csv
+import os
+import threading
+from collections import defaultdict
+
+from pygit2 import Repository, init_repository, GIT_CHECKOUT_FORCE
+
+from cost_ledger import directory_size
+from git_transfer import run_transfer
+
+
+# Branch that is checked out if the default branch of a repository is unknown
+FALLBACK_BRANCH = "master"
+
+# Columns of the report of the bytes and disk space that were saved per group
+REPORT_COLUMNS = ["group", "members", "estimated_bytes", "received_bytes", "bytes_saved", "disk_bytes", "disk_saved"]
+
+
+def _store_name(name):
+    # Name of a repository (or group) that can be used as a folder or remote name
+    return name.replace('/', '__')
+
+
+def load_root_commits(filename):
+    """
+        Returns a dict with the root commits (commits without parents) of each repository in the commit index
+    """
+    root_commits = defaultdict(set)
+    if filename and os.path.isfile(filename):
+        with open(filename, newline='', encoding='utf-8') as index_file:
+            for row in csv.DictReader(index_file):
+                if row['num_parents'] == "0":
+                    root_commits[row['repo']].add(row['commit'])
+    return root_commits
+
+
+class SharedObjectStore:
+    """
+        Groups repositories that belong to the same fork network (i.e. have the same source repository), or that
+        share a root commit (as found in an earlier commit index). Each group gets a single bare repository in which
+        the default branch of every member is fetched, so objects that members share are only downloaded and stored once.
+        Members are created with git alternates pointing to the objects of their group.
+    """
+    def __init__(self, path, repos, commit_index_filename=None):
+        self.path = path
+        self.group_names = {}
+        self.members = defaultdict(set)
+        self.estimated_bytes = defaultdict(int)
+        self.received_bytes = defaultdict(int)
+        self._group_locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+        # Repositories that share a root commit join the group of the (alphabetically) first of those repositories
+        self._root_group_names = {}
+        groups_by_root_commit = {}
+        root_commits = load_root_commits(commit_index_filename)
+        for repo_name in sorted(root_commits):
+            group_name = self._network_name(repo_name, repos.get(repo_name, {}))
+            for commit in root_commits[repo_name]:
+                group_name = groups_by_root_commit.get(commit, group_name)
+            for commit in root_commits[repo_name]:
+                groups_by_root_commit.setdefault(commit, group_name)
+            self._root_group_names[repo_name] = group_name
+
+        for repo_name, repo in repos.items():
+            if not repo.get('skipped'):
+                self.add_repo(repo_name, repo)
+
+    @staticmethod
+    def _network_name(repo_name, repo):
+        return repo.get('source') or repo_name
+
+    def add_repo(self, repo_name, repo):
+        with self._lock:
+            group_name = self._root_group_names.get(repo_name) or self._network_name(repo_name, repo)
+            self.group_names[repo_name] = group_name
+            self.members[group_name].add(repo_name)
+
+    def is_shared(self, repo_name, repo):
+        """
+            Whether the objects of a repository are shared with other (known) repositories
+        """
+        with self._lock:
+            group_name = self.group_names.get(repo_name)
+            return group_name is not None and (repo.get('is_fork') or len(self.members[group_name]) > 1)
+
+    def _group_repository(self, group_name):
+        group_path = os.path.join(self.path, _store_name(group_name) + ".git")
+        if os.path.isdir(group_path):
+            return Repository(group_path)
+        return init_repository(group_path, bare=True)
+
+    def clone(self, repo_name, repo, repo_path, budget_seconds=None):
+        """
+            Fetches the default branch of a repository into the store of its group, and creates the repository
+            at repo_path with alternates pointing to the objects in that store. The fetch is killed (by raising JobTimeout)
+            once it exceeds budget_seconds. Returns the number of bytes that were received.
+        """
+        group_name = self.group_names[repo_name]
+        branch_name = repo.get('default_branch') or FALLBACK_BRANCH
+        member_ref = f"refs/members/{repo_name}"
+
+        with self._group_locks[group_name]:
+            group_repo = self._group_repository(group_name)
+            remote_name = _store_name(repo_name)
+            if remote_name not in [remote.name for remote in group_repo.remotes]:
+                group_repo.remotes.create(remote_name, repo.get('clone_url'))
+            received_bytes = run_transfer(["fetch", group_repo.path, remote_name, f"+refs/heads/{branch_name}:{member_ref}"],
+                budget_seconds)
+            # The references were updated by the transfer, so the store is opened again
+            group_repo = Repository(group_repo.path)
+            head_oid = group_repo.references[member_ref].target
+            objects_path = os.path.abspath(os.path.join(group_repo.path, "objects"))
+
+        member_repo = init_repository(repo_path)
+        with open(os.path.join(member_repo.path, "objects", "info", "alternates"), 'w', encoding='utf-8') as alternates_file:
+            alternates_file.write(objects_path.replace(os.sep, '/') + "\n")
+
+        # The alternates are only read when a repository is opened
+        member_repo = Repository(repo_path)
+        member_repo.remotes.create("origin", repo.get('clone_url'))
+        branch = member_repo.create_branch(branch_name, member_repo[head_oid], True)
+        member_repo.references.create(f"refs/remotes/origin/{branch_name}", head_oid, force=True)
+        member_repo.set_head(branch.name)
+        member_repo.checkout_head(strategy=GIT_CHECKOUT_FORCE)
+
+        with self._lock:
+            # NB: GitHub reports the estimated size in KB
+            self.estimated_bytes[group_name] += (repo.get('estimated_size') or 0) * 1024
+            self.received_bytes[group_name] += received_bytes
+        return received_bytes
+
+    def report(self, output_path, output_filename, logger):
+        """
+            Outputs the number of bytes and disk space that were saved per group, compared to the sizes that GitHub
+            estimated for the individual members (which is what cloning them separately would have cost)
+        """
+        rows = []
+        with self._lock:
+            for group_name, estimated_bytes in sorted(self.estimated_bytes.items()):
+                members = sorted(repo_name for repo_name in self.members[group_name]
+                    if os.path.isdir(os.path.join(output_path, repo_name)))
+                disk_bytes = directory_size(os.path.join(self.path, _store_name(group_name) + ".git"))
+                disk_bytes += sum(directory_size(os.path.join(output_path, repo_name, ".git")) for repo_name in members)
+                received_bytes = self.received_bytes[group_name]
+                rows.append([group_name, len(members), estimated_bytes, received_bytes, estimated_bytes - received_bytes,
+                    disk_bytes, estimated_bytes - disk_bytes])
+
+        os.makedirs(os.path.dirname(os.path.abspath(output_filename)), exist_ok=True)
+        with open(output_filename, 'w', newline='', encoding='utf-8') as output_file:
+            csv_writer = csv.writer(output_file)
+            csv_writer.writerow(REPORT_COLUMNS)
+            csv_writer.writerows(rows)
+
+        logger.info(f"Shared objects of {len(rows)} groups: saved {sum(row[4] for row in rows)} received bytes "
+            f"and {sum(row[6] for row in rows)} bytes of disk space. The report was output in {output_filename}")
+
+
+def get_object_store(settings, repos):
+    """
+        Returns the shared object store of 'shared-objects-path', or None if objects should not be shared
+    """
+    if not settings.get('share-fork-objects'):
+        return None
+    return SharedObjectStore(settings.get('shared-objects-path'), repos, settings.get('results-commit-index-output-file'))
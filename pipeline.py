@@ -0,0 +1,402 @@
+"""Contains the pipelined mode, in which searching, fetching metadata, cloning and scanning overlap,
+and the rolling mode, in which repositories are cloned, scanned and removed within a disk budget"""
+
+import csv
+import math
+import os
+import queue
+import threading
+from collections import defaultdict
+from datetime import datetime
+
+import pandas as pd
+
+from bot_issue_finder import find_issues
+from cost_ledger import directory_size, get_ledger
+from pre_bot_issue_finder import PreBotIssueScanner, remove_pre_duplicates, count_commits, COMMIT_INDEX_COLUMNS, CLONE_INFO_DTYPES
+from records import IssueColumns, RepoRecord, load_repos, parse_timestamp, save_repos
+from repo_cloner import RepoCloner, remove_clone
+from object_sharing import get_object_store
+from repo_finder import fetch_repo_info
+from scheduler import JobScheduler
+from sharding import select_shard
+
+
+# Marks the end of a queue
+_DONE = object()
+
+# Marks the end of the clone queue, which is a priority queue; it is sorted after all repositories
+_CLONE_DONE = ((math.inf,), "")
+
+# Interval at which the scan worker checks whether the issues of pending (cloned) repositories are final
+PENDING_SCAN_POLL_SECONDS = 1
+
+# The stages whose outputs are produced by a pipelined run
+PIPELINED_STAGES = ["find_issues", "find_repos", "clone_repos", "pre_bot_issues"]
+
+# The stages whose outputs are produced by a rolling run, and the stage it needs the outputs of
+ROLLING_STAGES = ["clone_repos", "pre_bot_issues", "cloned_repos"]
+ROLLING_PREREQUISITE = "find_repos"
+
+
+class _IssueTracker:
+    """
+        Keeps track of the issues found per repository. As the search processes windows of creation dates
+        from the earliest to the latest date, the issues of a repository are final once the window in which
+        its first issue was found has been processed. The issues of each repository are kept as IssueColumns.
+    """
+    def __init__(self):
+        self.issues = defaultdict(IssueColumns)
+        self._issue_keys = set()
+        self._first_window = {}
+        self._num_windows_done = 0
+        self._search_done = False
+        self._condition = threading.Condition()
+
+    def add_issue(self, row):
+        """
+            Returns whether this is the first issue of its repository
+        """
+        repo_name, number, state, created_at = row[0], str(row[1]), row[3], str(row[5])
+        with self._condition:
+            # Issues might be output twice if the rate limit was hit while processing search results
+            if (repo_name, number) in self._issue_keys:
+                return False
+            self._issue_keys.add((repo_name, number))
+            self.issues[repo_name].append(number, parse_timestamp(created_at), state)
+
+            is_new_repo = repo_name not in self._first_window
+            if is_new_repo:
+                self._first_window[repo_name] = self._num_windows_done
+            return is_new_repo
+
+    def window_done(self):
+        with self._condition:
+            self._num_windows_done += 1
+            self._condition.notify_all()
+
+    def search_done(self):
+        with self._condition:
+            self._search_done = True
+            self._condition.notify_all()
+
+    def has_final_issues(self, repo_name):
+        with self._condition:
+            return self._search_done or self._first_window[repo_name] < self._num_windows_done
+
+    def wait_for_earliest_issue(self, repo_name):
+        """
+            Returns the (epoch) creation date of the earliest issue of a repository, once its issues are final
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._search_done or self._first_window[repo_name] < self._num_windows_done)
+            return self.issues[repo_name].earliest()
+
+
+class _DiskBudget:
+    """
+        Keeps track of the disk space that is (expected to be) used by clones. A clone is only admitted if it fits
+        in the budget; a repository that is larger than the budget is admitted once no other clones are on disk.
+    """
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.reserved = {}
+        self._condition = threading.Condition()
+
+    def used_bytes(self):
+        return sum(self.reserved.values())
+
+    def reserve(self, repo_name, num_bytes):
+        with self._condition:
+            self._condition.wait_for(lambda: not self.reserved or self.used_bytes() + num_bytes <= self.budget_bytes)
+            self.reserved[repo_name] = num_bytes
+
+    def resize(self, repo_name, num_bytes):
+        # Replaces the estimated size of a clone by its actual size
+        with self._condition:
+            self.reserved[repo_name] = num_bytes
+            self._condition.notify_all()
+
+    def release(self, repo_name):
+        with self._condition:
+            self.reserved.pop(repo_name, None)
+            self._condition.notify_all()
+
+
+class _Worker(threading.Thread):
+    # Thread that remembers the exception that stopped it (if any)
+    def __init__(self, name, target):
+        super().__init__(name=name, daemon=True)
+        self._target_fn = target
+        self.exception = None
+
+    def run(self):
+        try:
+            self._target_fn()
+        except Exception as e:
+            self.exception = e
+
+
+def run_pipelined(ctx, logger):
+    """
+        Runs the find_issues, find_repos, clone_repos and pre_bot_issues stages at the same time, connected by bounded queues.
+        A repository is looked up as soon as its first issue is found, cloned as soon as it adheres to the settings,
+        and scanned as soon as it is cloned (and all its issues are known).
+        The outputs are the same as those of the individual stages.
+    """
+    settings = ctx.settings
+    github = ctx.github
+    if_logger = ctx.logger('issue_finder')
+    rf_logger = ctx.logger('repo_finder')
+    rc_logger = ctx.logger('repo_cloner')
+    pef_logger = ctx.logger('pre_issue_finder')
+    ctx.logger('general')
+
+    queue_size = settings.get('pipeline-queue-size', 100)
+    num_clone_workers = settings.get('pipeline-clone-workers', 4)
+    output_path = settings.get('download-output-path-repo')
+    scheduler = JobScheduler(settings)
+    object_store = get_object_store(settings, {})
+    cloner = RepoCloner(settings, rc_logger, object_store)
+
+    # Of the repositories waiting to be cloned, the most expensive one is cloned first
+    metadata_queue = queue.Queue(maxsize=queue_size)
+    clone_queue = queue.PriorityQueue(maxsize=queue_size)
+    scan_queue = queue.Queue(maxsize=queue_size)
+    tracker = _IssueTracker()
+    repos = {}
+
+    start_time = datetime.now()
+    logger.info(f"Pipelined run was started at {start_time}!")
+
+    def on_issue(row):
+        if tracker.add_issue(row):
+            metadata_queue.put(row[0])
+
+    def search():
+        try:
+            find_issues(github, settings, if_logger, on_issue=on_issue, on_window_done=tracker.window_done)
+        finally:
+            tracker.search_done()
+            metadata_queue.put(_DONE)
+
+    def fetch_metadata():
+        try:
+            while (repo_name := metadata_queue.get()) is not _DONE:
+                try:
+                    repos[repo_name], _ = fetch_repo_info(github, repo_name, settings, rf_logger)
+                except Exception as e:
+                    rf_logger.error(f"Unexpected {type(e)} (Exception) for <{repo_name}>: {e}")
+                    repos[repo_name] = {'skipped': True, 'error': str(e)}
+
+                if not repos[repo_name]['skipped']:
+                    if object_store is not None:
+                        object_store.add_repo(repo_name, repos[repo_name])
+                    priority = scheduler.sort_key(repo_name, "clone", repos[repo_name].get('estimated_size'))
+                    clone_queue.put((priority, repo_name))
+        finally:
+            for _ in range(num_clone_workers):
+                clone_queue.put(_CLONE_DONE)
+
+    def clone():
+        try:
+            while (item := clone_queue.get()) is not _CLONE_DONE:
+                _, repo_name = item
+                if os.path.isdir(os.path.join(output_path, repo_name)):
+                    rc_logger.debug(f"\t* <{repo_name}> was already cloned")
+                    scan_queue.put(repo_name)
+                elif cloner.clone_with_retries(repo_name, repos[repo_name],
+                        on_retry_success=lambda name=repo_name: scan_queue.put(name)) == "success":
+                    scan_queue.put(repo_name)
+        finally:
+            # Clones that are retried (in the background, or because they timed out) still need to be scanned
+            cloner.wait_for_retries()
+            scan_queue.put(_DONE)
+
+    scanner = PreBotIssueScanner(settings, pef_logger)
+
+    def scan_pending(pending):
+        # Scans the cloned repositories of which all issues are known. The others stay pending, while the scan queue
+        # is drained, as the clone workers (and thereby the search) would otherwise block on the full queues
+        for repo_name in [repo_name for repo_name in pending if tracker.has_final_issues(repo_name)]:
+            pending.remove(repo_name)
+            try:
+                earliest = tracker.wait_for_earliest_issue(repo_name)
+                owner, name = repo_name.split('/', 1)
+                scanner.scan_repo(owner, name, os.path.join(output_path, owner, name), earliest)
+            except Exception as e:
+                pef_logger.error(f"Unexpected {type(e)} (Exception) for <{repo_name}>: {e}")
+
+    def scan():
+        num_done = 0
+        pending = []
+        while num_done < num_clone_workers:
+            try:
+                repo_name = scan_queue.get(timeout=PENDING_SCAN_POLL_SECONDS if pending else None)
+            except queue.Empty:
+                scan_pending(pending)
+                continue
+
+            if repo_name is _DONE:
+                num_done += 1
+            else:
+                pending.append(repo_name)
+            scan_pending(pending)
+
+        # All clone workers are done, so the search is done as well
+        scan_pending(pending)
+        scanner.retry_timeouts(output_path, {repo_name: issues.earliest() for repo_name, issues in tracker.issues.items()})
+        scanner.finish()
+
+    workers = [_Worker("search", search), _Worker("metadata", fetch_metadata)]
+    workers += [_Worker(f"clone-{i}", clone) for i in range(num_clone_workers)]
+    workers += [_Worker("scan", scan)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    for worker in workers:
+        if worker.exception is not None:
+            logger.error(f"The {worker.name} worker failed: {worker.exception}")
+            raise worker.exception
+
+    # Output the repositories in the same format as find_repos
+    save_repos({repo_name: RepoRecord(repo_name, repo_info, tracker.issues[repo_name]) for repo_name, repo_info in repos.items()},
+        settings.get('results-repos-output-file'))
+
+    remove_pre_duplicates(settings, logger)
+    if object_store is not None:
+        object_store.report(output_path, settings.get('results-shared-objects-report-file'), logger)
+
+    end_time = datetime.now()
+    logger.info(f"Pipelined run was ended at {end_time}, and took {end_time - start_time} h:mm:ss!")
+
+
+def run_rolling(ctx, logger):
+    """
+        Clones, scans and removes repositories, such that the clones on disk never exceed 'disk-budget-mb'.
+        Repositories are admitted on their estimated size (from the find_repos stage). Once a repository is scanned,
+        its clone information and commits are saved, after which the clone is removed to make room for the next one.
+        Repositories that were cloned before the run are scanned, but not removed.
+        The outputs are the same as those of the clone_repos, pre_bot_issues and cloned_repos stages
+        (except that the clone folder only contains the repositories that were cloned before).
+    """
+    settings = ctx.settings
+    rc_logger = ctx.logger('repo_cloner')
+    pef_logger = ctx.logger('pre_issue_finder')
+    ctx.logger('general')
+
+    num_clone_workers = settings.get('pipeline-clone-workers', 4)
+    budget = _DiskBudget(settings.get('disk-budget-mb') * 2**20)
+    output_path = settings.get('download-output-path-repo')
+    os.makedirs(output_path, exist_ok=True)
+    ledger = get_ledger(settings)
+    cloner = RepoCloner(settings, rc_logger)
+
+    repos = load_repos(settings.get('results-repos-output-file'))
+    earliest_issues = {repo_name: repo.issues.earliest() for repo_name, repo in repos.items() if repo.issues}
+
+    # Clone the most expensive repositories first
+    clone_queue = queue.Queue()
+    repo_names = select_shard([name for name, repo in repos.items() if not repo.get('skipped')], settings)
+    for repo_name in JobScheduler(settings).schedule(repo_names):
+        clone_queue.put(repo_name)
+    scan_queue = queue.Queue()
+    clone_info_rows = []
+
+    start_time = datetime.now()
+    logger.info(f"Rolling run was started at {start_time}! Handling {clone_queue.qsize()} repos within {settings.get('disk-budget-mb')} MB.")
+
+    def reserve(repo_name):
+        # NB: GitHub reports the estimated size in KB
+        budget.reserve(repo_name, (repos[repo_name].get('estimated_size') or 0) * 1024)
+
+    def on_cloned(repo_name):
+        budget.resize(repo_name, directory_size(os.path.join(output_path, repo_name)))
+        scan_queue.put((repo_name, True))
+
+    def on_failed(repo_name):
+        remove_clone(os.path.join(output_path, repo_name))
+        budget.release(repo_name)
+
+    def clone():
+        try:
+            while True:
+                try:
+                    repo_name = clone_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+                repo_path = os.path.join(output_path, repo_name)
+                if os.path.isdir(repo_path):
+                    rc_logger.debug(f"\t* <{repo_name}> was already cloned")
+                    scan_queue.put((repo_name, False))
+                    continue
+
+                # Clones that are retried in the background keep their reservation until the outcome of the retries is known
+                reserve(repo_name)
+                outcome = cloner.clone_with_retries(repo_name, repos[repo_name],
+                    on_retry_success=lambda name=repo_name: on_cloned(name), on_retry_failure=lambda name=repo_name: on_failed(name))
+                if outcome == "success":
+                    on_cloned(repo_name)
+                elif outcome == "timeout":
+                    # A timed out clone is only retried once all other clones are done, so it is reserved again before
+                    #   its retry (keeping its reservation until then could keep the next clones from ever being admitted)
+                    budget.release(repo_name)
+        finally:
+            cloner.wait_for_retries(before_retry=reserve)
+            scan_queue.put(_DONE)
+
+    scanner = PreBotIssueScanner(settings, pef_logger)
+
+    def scan():
+        num_done = 0
+        with open(settings.get('results-commit-index-output-file'), 'w', newline='', encoding='utf-8') as index_file:
+            commit_index = csv.writer(index_file)
+            commit_index.writerow(COMMIT_INDEX_COLUMNS)
+            while num_done < num_clone_workers:
+                item = scan_queue.get()
+                if item is _DONE:
+                    num_done += 1
+                    continue
+
+                repo_name, is_cloned_by_run = item
+                owner, name = repo_name.split('/', 1)
+                repo_path = os.path.join(output_path, owner, name)
+                try:
+                    earliest = earliest_issues.get(repo_name)
+                    if earliest is not None:
+                        scanner.scan_repo(owner, name, repo_path, earliest)
+                        # The clone might be removed next, so a scan that timed out is retried (once) right away.
+                        #   A retry that times out again is not retried later on, as its clone might be gone by then
+                        scanner.retry_timeouts(output_path, earliest_issues)
+                        scanner.timeouts.take_retries("repo_scan")
+                        scanner.timeouts.take_retries("commit_scan")
+                    clone_info_rows.append(count_commits(repo_name, repo_path, earliest, ledger, commit_index))
+                except Exception as e:
+                    pef_logger.error(f"Unexpected {type(e)} (Exception) for <{repo_name}>: {e}")
+                finally:
+                    if is_cloned_by_run:
+                        remove_clone(repo_path)
+                        budget.release(repo_name)
+                        rc_logger.debug(f"\t* Removed <{repo_name}> ({budget.used_bytes()} bytes of clones left on disk)")
+        scanner.finish()
+
+    workers = [_Worker(f"clone-{i}", clone) for i in range(num_clone_workers)]
+    workers += [_Worker("scan", scan)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    for worker in workers:
+        if worker.exception is not None:
+            logger.error(f"The {worker.name} worker failed: {worker.exception}")
+            raise worker.exception
+
+    pd.DataFrame(clone_info_rows, columns=list(CLONE_INFO_DTYPES)).to_csv(settings.get('results-clone-info-output-file'), index=False)
+    remove_pre_duplicates(settings, logger)
+
+    end_time = datetime.now()
+    logger.info(f"Rolling run was ended at {end_time}, and took {end_time - start_time} h:mm:ss!")
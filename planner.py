@@ -0,0 +1,272 @@
+"""Contains the dry-run planner, which predicts the costs of a run without doing its work, and learns from the actual costs"""
+
+import csv
+import json
+import os
+import statistics
+from datetime import datetime
+from math import ceil
+
+from github import GithubException
+
+import metrics
+import stages
+from bot_issue_finder import MAX_RESULTS_PER_SEARCH, RESULTS_PER_PAGE, RawSearchClient, construct_issue_search_query
+from cost_ledger import get_ledger
+from scheduler import JobScheduler, fit_rate, load_commit_counts, load_estimated_sizes
+
+
+# Length (in seconds) of the window in which the requests of each GitHub rate limit can be made
+RATE_LIMIT_WINDOW_SECONDS = {"search": 60, "core": 3600}
+
+# Requests per window that are assumed if the rate limits cannot be requested (with and without logging in)
+DEFAULT_RATE_LIMITS = {"search": 30, "core": 5000}
+ANONYMOUS_RATE_LIMITS = {"search": 10, "core": 60}
+
+# Seconds that a single request takes, until calibrated
+SECONDS_PER_REQUEST = {"search": 1.0, "core": 0.5}
+
+# Estimates of repositories of which nothing is known yet, until calibrated
+DEFAULT_ESTIMATED_SIZE_KB = 5000
+DEFAULT_COMMITS_PER_KB = 0.05
+
+# Number of most recent comparisons from which the calibration factor of a prediction is determined
+CALIBRATION_WINDOW = 10
+
+# Columns of the file in which predictions are compared with the actual costs of a run
+CALIBRATION_COLUMNS = ["timestamp", "stage", "quantity", "predicted", "calibrated", "actual"]
+
+# Pseudo-stage of the predictions that concern the run as a whole
+RUN_STAGE = "run"
+
+
+def _actual_disk_bytes(settings):
+    # Disk space of the (non-skipped) repositories, as recorded in the ledger when they were cloned
+    ledger = get_ledger(settings)
+    if ledger is None:
+        return None
+    disk_bytes = ledger.values("disk_bytes")
+    return sum(disk_bytes.get(repo_name, 0) for repo_name in load_estimated_sizes(settings.get('results-repos-output-file')))
+
+
+# How the actual value of each prediction is obtained after a run (from its metrics, or the outputs of its stages)
+ACTUALS = {
+    ("find_issues", "api_calls"):       lambda settings: metrics.registry.counter_value("github_api_requests_total", endpoint="search/issues"),
+    ("find_repos", "api_calls"):        lambda settings: metrics.registry.counter_value("github_api_requests_total", endpoint="repos"),
+    ("clone_repos", "download_bytes"):  lambda settings: metrics.registry.counter_value("clone_bytes_total"),
+    ("clone_repos", "disk_bytes"):      _actual_disk_bytes,
+    ("pre_bot_issues", "scanned_commits"):      lambda settings: metrics.registry.counter_value("commits_scanned_total"),
+    ("pre_bot_issues", "detector_invocations"): lambda settings: metrics.registry.counter_value("todo_bot_invocations_total"),
+    (RUN_STAGE, "rate_limit_wait_seconds"):     lambda settings: metrics.registry.histogram_sum("rate_limit_sleep_seconds"),
+}
+
+
+def load_calibration(filename):
+    """
+        Returns the factor by which each (stage, quantity) prediction is multiplied: the median ratio between
+        the actual and predicted values of its most recent comparisons
+    """
+    ratios = {}
+    if filename and os.path.isfile(filename):
+        with open(filename, newline='', encoding='utf-8') as calibration_file:
+            for row in csv.DictReader(calibration_file):
+                predicted, actual = float(row['predicted']), float(row['actual'])
+                if predicted > 0 and actual > 0:
+                    ratios.setdefault((row['stage'], row['quantity']), []).append(actual / predicted)
+    return {key: statistics.median(values[-CALIBRATION_WINDOW:]) for key, values in ratios.items()}
+
+
+def load_rate_limits(ctx, logger):
+    """
+        Returns the (remaining, limit) number of requests of each GitHub rate limit
+    """
+    try:
+        limits = ctx.github.get_rate_limit()
+        metrics.registry.inc("github_api_requests_total", endpoint="rate_limit")
+        return {"search": (limits.search.remaining, limits.search.limit), "core": (limits.core.remaining, limits.core.limit)}
+    except (GithubException, OSError) as e:
+        logger.warning(f"Could not request the rate limits; assuming the default quotas! {e}")
+        defaults = DEFAULT_RATE_LIMITS if ctx.login_settings.get('login_or_token') else ANONYMOUS_RATE_LIMITS
+        return {resource: (limit, limit) for resource, limit in defaults.items()}
+
+
+def rate_limit_wait_seconds(num_requests, remaining, limit, resource):
+    # Every time the remaining requests run out, the run waits (at most) a window until the limit resets
+    if num_requests <= remaining:
+        return 0.0
+    return ceil((num_requests - remaining) / limit) * RATE_LIMIT_WINDOW_SECONDS[resource]
+
+
+def count_issues(ctx, logger):
+    """
+        Returns the number of issues that the search of find_issues will output. This takes a single search request;
+        if that fails, the number of issues of the previous run is used instead.
+    """
+    settings = ctx.settings
+    query = construct_issue_search_query(settings) + f"created:{settings.get('start-date')}..{settings.get('end-date')}"
+    try:
+        num_issues = RawSearchClient(ctx.github, logger).search(query)["total_count"]
+    except (GithubException, OSError) as e:
+        logger.warning(f"Could not count the issues; using those of the previous run instead! {e}")
+        filename = settings.get('results-issues-output-file')
+        if not os.path.isfile(filename):
+            return 0
+        with open(filename, newline='', encoding='utf-8') as issue_file:
+            num_issues = sum(1 for _ in csv.DictReader(issue_file, escapechar="\\"))
+
+    if settings.get('max-results') >= 0:
+        num_issues = min(num_issues, settings.get('max-results'))
+    return num_issues
+
+
+def predict(ctx, logger):
+    """
+        Returns the (uncalibrated) predictions of each stage, from the size of the search, the rate limits and
+        everything that is known of the repositories: their estimated size, clone information and earlier costs (in the ledger)
+    """
+    settings = ctx.settings
+    rate_limits = load_rate_limits(ctx, logger)
+    predictions = {}
+
+    # find_issues: the results are fetched in pages, from windows of creation dates that each have less than the maximum results
+    num_issues = count_issues(ctx, logger)
+    num_windows = 2 * ceil(num_issues / MAX_RESULTS_PER_SEARCH) + 1
+    search_calls = ceil(num_issues / RESULTS_PER_PAGE) + num_windows
+    search_wait = rate_limit_wait_seconds(search_calls, *rate_limits["search"], "search")
+    predictions["find_issues"] = {"issues": num_issues, "api_calls": search_calls,
+        "seconds": search_calls * SECONDS_PER_REQUEST["search"] + search_wait}
+
+    # find_repos: a single request for each unique repository
+    sizes = load_estimated_sizes(settings.get('results-repos-output-file'))
+    repos_per_issue = 1.0
+    issues_filename = settings.get('results-issues-output-file')
+    if os.path.isfile(issues_filename):
+        with open(issues_filename, newline='', encoding='utf-8') as issue_file:
+            repo_names = [row['repo'] for row in csv.DictReader(issue_file, escapechar="\\")]
+        if repo_names:
+            repos_per_issue = len(set(repo_names)) / len(repo_names)
+    num_repos = round(num_issues * repos_per_issue)
+    repo_wait = rate_limit_wait_seconds(num_repos, *rate_limits["core"], "core")
+    predictions["find_repos"] = {"repos": num_repos, "api_calls": num_repos,
+        "seconds": num_repos * SECONDS_PER_REQUEST["core"] + repo_wait}
+    predictions[RUN_STAGE] = {"rate_limit_wait_seconds": search_wait + repo_wait}
+
+    # clone_repos: repositories of which nothing is known yet are assumed to be of average size
+    ledger = get_ledger(settings)
+    disk_bytes = ledger.values("disk_bytes") if ledger is not None else {}
+    disk_bytes_per_kb = fit_rate(disk_bytes, sizes, 1024)
+    mean_size = sum(sizes.values()) / len(sizes) if sizes else DEFAULT_ESTIMATED_SIZE_KB
+    num_unknown_repos = max(num_repos - len(sizes), 0)
+    output_path = settings.get('download-output-path-repo')
+    new_repo_names = [repo_name for repo_name in sizes if not os.path.isdir(os.path.join(output_path, repo_name))]
+    scheduler = JobScheduler(settings)
+    predictions["clone_repos"] = {
+        "repos": len(new_repo_names) + num_unknown_repos,
+        "download_bytes": (sum(sizes[repo_name] for repo_name in new_repo_names) + num_unknown_repos * mean_size) * 1024,
+        "disk_bytes": sum(disk_bytes.get(repo_name, sizes[repo_name] * disk_bytes_per_kb) for repo_name in sizes)
+            + num_unknown_repos * mean_size * disk_bytes_per_kb,
+        "seconds": sum(scheduler.clone_cost(repo_name) for repo_name in new_repo_names)
+            + num_unknown_repos * scheduler.clone_cost(None, mean_size),
+    }
+
+    # pre_bot_issues: the commits before the earliest issue (from the clone information, or estimated from the size)
+    #   of each repository go through todo[bot], unless they are filtered out
+    pre_commits = {}
+    clone_info_filename = settings.get('results-clone-info-output-file')
+    if os.path.isfile(clone_info_filename):
+        with open(clone_info_filename, newline='', encoding='utf-8') as clone_info_file:
+            pre_commits = {row['repo']: int(row['pre_earliest_issue_commits']) for row in csv.DictReader(clone_info_file)
+                if row.get('pre_earliest_issue_commits')}
+    commit_counts = load_commit_counts(clone_info_filename)
+    commits_per_kb = fit_rate(commit_counts, sizes, DEFAULT_COMMITS_PER_KB)
+    pre_fraction = fit_rate(pre_commits, commit_counts, 1.0)
+    invocations_per_commit = 1.0
+    if ledger is not None:
+        invocations_per_commit = fit_rate(ledger.values("detector_invocations"), ledger.values("pre_bot_commits_scanned"), 1.0)
+    scanned_commits = sum(pre_commits.get(repo_name, sizes[repo_name] * commits_per_kb * pre_fraction) for repo_name in sizes)
+    scanned_commits += num_unknown_repos * mean_size * commits_per_kb * pre_fraction
+    predictions["pre_bot_issues"] = {
+        "scanned_commits": scanned_commits,
+        "detector_invocations": scanned_commits * invocations_per_commit,
+        "seconds": sum(scheduler.scan_cost(repo_name) for repo_name in sizes) + num_unknown_repos * scheduler.scan_cost(None, mean_size),
+    }
+    return predictions
+
+
+def plan_run(ctx, target, logger, force=False):
+    """
+        Predicts the costs of running the target stage (and the prerequisites that are not up to date), without
+        doing any of their work. The calibrated predictions are logged and output in 'results-plan-file'.
+    """
+    settings = ctx.settings
+    pending = stages.pending_stages(settings, target, force)
+    calibration = load_calibration(settings.get('results-plan-calibration-file'))
+    predictions = predict(ctx, logger)
+
+    plan = {"created_at": datetime.now().isoformat(sep=" ", timespec="seconds"), "target": target, "compared_at": None, "stages": {}}
+    for stage_name, quantities in predictions.items():
+        runs = stage_name in pending if stage_name != RUN_STAGE else any(name in pending for name in ["find_issues", "find_repos"])
+        plan["stages"][stage_name] = {
+            "runs": runs,
+            "predicted": quantities,
+            "calibrated": {quantity: value * calibration.get((stage_name, quantity), 1.0) for quantity, value in quantities.items()},
+        }
+
+    logger.info(f"Plan of running <{target}> (stages that are up to date are not run):")
+    for stage_name, stage_plan in plan["stages"].items():
+        estimates = ", ".join(f"{quantity}={value:.4g}" for quantity, value in stage_plan["calibrated"].items())
+        logger.info(f"> {stage_name}{'' if stage_plan['runs'] else ' (skipped)'}: {estimates}")
+
+    output_filename = settings.get('results-plan-file')
+    os.makedirs(os.path.dirname(os.path.abspath(output_filename)), exist_ok=True)
+    with open(output_filename, 'w', encoding='utf-8') as output_file:
+        json.dump(plan, output_file, indent=4)
+    logger.info(f"The plan was output in {output_filename}")
+    return plan
+
+
+def compare_with_plan(settings, target, logger):
+    """
+        Compares the predictions of the last plan (of the target) with the actual costs of the stages that just ran,
+        and records them so that later plans are calibrated. Each plan is only compared once.
+    """
+    plan_filename = settings.get('results-plan-file')
+    if not plan_filename or not os.path.isfile(plan_filename):
+        return
+    with open(plan_filename, encoding='utf-8') as plan_file:
+        plan = json.load(plan_file)
+    if plan.get("compared_at") or plan.get("target") != target:
+        return
+
+    timestamp = datetime.now().isoformat(sep=" ", timespec="seconds")
+    rows = []
+    for stage_name, stage_plan in plan["stages"].items():
+        if not stage_plan["runs"]:
+            continue
+        if stage_name != RUN_STAGE and metrics.registry.histogram_sum("stage_duration_seconds", stage=stage_name) == 0:
+            # The stage did not run after all (e.g. it was run in another mode)
+            continue
+        for quantity, predicted in stage_plan["predicted"].items():
+            if quantity == "seconds":
+                actual = metrics.registry.histogram_sum("stage_duration_seconds", stage=stage_name)
+            elif (stage_name, quantity) in ACTUALS:
+                actual = ACTUALS[(stage_name, quantity)](settings)
+            else:
+                continue
+            if actual is not None:
+                rows.append([timestamp, stage_name, quantity, predicted, stage_plan["calibrated"][quantity], actual])
+                logger.info(f"> {stage_name} {quantity}: predicted {stage_plan['calibrated'][quantity]:.4g}, actual {actual:.4g}")
+
+    calibration_filename = settings.get('results-plan-calibration-file')
+    is_new_file = not os.path.isfile(calibration_filename)
+    os.makedirs(os.path.dirname(os.path.abspath(calibration_filename)), exist_ok=True)
+    with open(calibration_filename, 'a', newline='', encoding='utf-8') as calibration_file:
+        csv_writer = csv.writer(calibration_file)
+        if is_new_file:
+            csv_writer.writerow(CALIBRATION_COLUMNS)
+        csv_writer.writerows(rows)
+
+    plan["compared_at"] = timestamp
+    with open(plan_filename, 'w', encoding='utf-8') as plan_file:
+        json.dump(plan, plan_file, indent=4)
+    logger.info(f"Compared {len(rows)} predictions with the actual costs, which were output in {calibration_filename}")
@@ -1,120 +1,286 @@
-import json
+import csv
 import datetime
 import os
-import itertools
+import shlex
+import shutil
+import subprocess
+import time
 
 from string import Template
 
+import numpy as np
 import pandas as pd
-from pygit2 import Repository, Commit, GIT_SORT_TIME, GIT_SORT_REVERSE
-from pygit2.errors import GitError
+from pygit2 import Repository, GIT_SORT_TIME, GIT_SORT_REVERSE
+
+from commit_prefilter import DeltaPrefilter
+import metrics
+from cost_ledger import get_ledger
+from diff_extractor import commit_diff, write_commit_diff, DEFAULT_MAX_FILE_SIZE
+from records import load_repos, parse_timestamp
+from scheduler import JobScheduler
+from sharding import select_shard
+from timeouts import JobTimeout, get_timeouts, run_with_timeout
+from util import LogSampler, log_runtime_and_memory
+
+
+# Number of rows that are read at once when streaming through (large) CSV files
+CSV_CHUNK_SIZE = 100000
+
+# File in which the modified todo[bot] appends the issues it finds (relative to its working directory)
+TODO_BOT_OUTPUT_FILENAME = "issues_pre_bot.csv"
+
+# File to which the output of the modified todo[bot] is appended
+TODO_BOT_LOG_FILENAME = "bot_pre_bot_finder_node.log"
+
+# Columns of the pre-bot issue file. NB: The modified todo[bot] outputs the owner before the repository name
+PRE_BOT_CSV_COLUMNS = ["repo", "owner", "commit_date", "title", "body"]
+
+# Columns of the commit index, which contains a row for every commit of each cloned repository
+COMMIT_INDEX_COLUMNS = ["repo", "commit", "commit_time", "num_parents", "before_earliest_issue"]
+
+# Reads all columns of a CSV file as (unaltered) strings
+STRING_CSV_OPTIONS = {"dtype": str, "keep_default_na": False}
+
+
+# Repository characteristics (and their types) that are merged into the final output
+REPO_INFO_DTYPES = {
+    "stars": "Int64",
+    "forks": "Int64",
+    "watchers": "Int64",
+    "is_fork": "boolean",
+    "is_private": "boolean",
+    "is_archived": "boolean",
+    "estimated_size": "Int64",
+    "created_at": "datetime64[ns]",
+    "updated_at": "datetime64[ns]",
+    "clone_url": "string",
+}
+
+# Columns (and their types) of the clone information file
+CLONE_INFO_DTYPES = {
+    "repo": "string",
+    "cloned": "boolean",
+    "total_commits": "Int64",
+    "earliest_todo_issue": "float64",
+    "pre_earliest_issue_commits": "Int64",
+}
+
+
+def _repo_ids(repo_names, categories):
+    # Integer keys of repository names; repositories that are not in categories obtain -1
+    return pd.Categorical(repo_names, categories=categories).codes
+
+
+def _count_issues_per_repo(filename, chunksize, unique_column=None):
+    """
+        Counts the number of rows per repository, while only ever loading the relevant column(s).
+        If unique_column is given, rows with the same (repo, unique_column)-pair are only counted once.
+    """
+    usecols = ["repo"] if unique_column is None else ["repo", unique_column]
+    counts = None
+    # The unique rows of each chunk, which are combined (and deduplicated across chunks) once all chunks are read
+    chunk_unique_rows = []
+    for chunk in _read_csv_chunks(filename, chunksize, usecols=usecols, dtype={"repo": "category"}):
+        if unique_column is not None:
+            chunk_unique_rows.append(chunk.drop_duplicates())
+            continue
+
+        chunk_counts = chunk["repo"].value_counts()
+        counts = chunk_counts if counts is None else counts.add(chunk_counts, fill_value=0)
+
+    if unique_column is not None and chunk_unique_rows:
+        unique_rows = pd.concat(chunk_unique_rows, ignore_index=True).astype({"repo": "category"}).drop_duplicates()
+        counts = unique_rows["repo"].value_counts()
+    if counts is None:
+        return pd.Series(dtype="int64")
+    counts.index = counts.index.astype(str)
+    return counts[counts > 0].astype("int64")
 
 
 def obtain_pre_post_data(settings, logger):
     """
         Merge repository characteristics and TODO-comment numbers together in a single
-        file for easy usage
+        file for easy usage.
+        All inputs are merged on integer repository keys, and only the columns that are needed
+        are loaded (e.g., issue bodies are never read). Setting 'merge-chunk-size' streams the
+        (large) issue files in chunks of that many rows.
     """
-    # Obtain amount of pre issues per repo
-    pre_filename = settings.get('results-todo-comments-pre-bot-output-file')
-    df_pre = pd.read_csv(pre_filename)
-    df_pre = df_pre.groupby(by=["repo"]).size().reset_index(name='num_pre_issues')
+    chunksize = settings.get('merge-chunk-size')
 
-    # Obtain post issues per repo
-    post_filename = settings.get('results-issues-output-file')
-    df_post = pd.read_csv(post_filename)
-    df_post = df_post.drop_duplicates()
-    df_post = df_post.groupby(by=["repo"]).size().reset_index(name='num_post_issues')
+    with log_runtime_and_memory(logger, "Merging pre/post-bot data"):
+        # Obtain amount of pre issues per repo
+        num_pre_issues = _count_issues_per_repo(settings.get('results-todo-comments-pre-bot-output-file'), chunksize)
 
-    # Merge the pre/post-issue info into a single dataframe
-    df_merged = df_pre.merge(df_post, on="repo", how="right", sort=True)
-    df_merged = df_merged.fillna(0)
+        # Obtain post issues per repo (the issue file might contain the same issue more than once)
+        num_post_issues = _count_issues_per_repo(settings.get('results-issues-output-file'), chunksize, unique_column="number")
 
-    # Obtain star, fork, etc. info from _all_ repositories
-    filename = settings.get('results-repos-output-file')
-    df_data = pd.read_json(filename, orient='index').rename_axis("repo").reset_index()
-    df_data = df_data.drop(["skipped", "error", "issues"], axis="columns")
+        # The output contains exactly the repositories for which the bot created an issue
+        repo_names = pd.Index(sorted(num_post_issues.index))
+        df_merged = pd.DataFrame({"repo": repo_names}, index=pd.RangeIndex(len(repo_names), name="repo_id"))
+        df_merged["num_pre_issues"] = num_pre_issues.reindex(repo_names, fill_value=0).to_numpy()
+        df_merged["num_post_issues"] = num_post_issues.reindex(repo_names).to_numpy()
 
-    # Obtain number of commits, etc. from _cloned_ repositories
-    df_cloned_data = pd.read_csv(settings.get('results-clone-info-output-file'))
-    df_cloned_data["earliest_todo_issue"] = df_cloned_data["earliest_todo_issue"].apply(lambda x: datetime.datetime.utcfromtimestamp(x).isoformat(sep=" "))
+        # Obtain number of commits, etc. from _cloned_ repositories
+        df_cloned_data = pd.read_csv(settings.get('results-clone-info-output-file'),
+            usecols=list(CLONE_INFO_DTYPES), dtype=CLONE_INFO_DTYPES)
+        df_cloned_data["earliest_todo_issue"] = pd.to_datetime(df_cloned_data["earliest_todo_issue"], unit="s")
+        df_cloned_data.index = _repo_ids(df_cloned_data.pop("repo"), repo_names)
+        df_cloned_data = df_cloned_data[df_cloned_data.index >= 0]
 
-    # Merge the two together
-    df_cloned_data = df_cloned_data.merge(df_data, on="repo", how="right", sort=True)
+        # Obtain star, fork, etc. info from _all_ repositories (discard the issues of each repository)
+        repos = load_repos(settings.get('results-repos-output-file'))
+        repo_info = {column: [repo.get(column) for repo in repos.values()] for column in REPO_INFO_DTYPES}
+        df_data = pd.DataFrame(repo_info, index=_repo_ids(list(repos.keys()), repo_names)).astype(REPO_INFO_DTYPES)
+        df_data = df_data[df_data.index >= 0]
+        del repos, repo_info
 
-    # Set correct clone information for uncloned repositories (they have more data missing as well, which is fine)
-    df_cloned_data = df_cloned_data.fillna(value={'cloned': False})
+        # Merge repo info and pre/post-issue info together
+        with metrics.registry.timer("pandas_merge_seconds", stage="pre_post_data"):
+            df_merged = df_merged.join(df_cloned_data).join(df_data)
 
-    # Merge repo info and pre/post-issue info together
-    df_merged = df_merged.merge(df_cloned_data, on="repo", how="left", sort=True)
+        # Set correct clone information for uncloned repositories (they have more data missing as well, which is fine)
+        df_merged["cloned"] = df_merged["cloned"].fillna(False)
 
-    df_merged.to_csv(settings.get('results-merged-output-file'), index=False)
+        df_merged.to_csv(settings.get('results-merged-output-file'), index=False)
 
 
+def _repo_title_hashes(repo, title):
+    # Compact (64-bit) hashes of (repo, title)-pairs
+    return pd.util.hash_pandas_object(pd.DataFrame({"repo": repo, "title": title}), index=False).to_numpy()
 
-def remove_pre_duplicates(settings, logger):
+
+def _read_csv_chunks(filename, chunksize=CSV_CHUNK_SIZE, **kwargs):
+    # Reads a CSV file in chunks of chunksize rows, or all at once if chunksize is None
+    if chunksize is None:
+        yield pd.read_csv(filename, **kwargs)
+    else:
+        yield from pd.read_csv(filename, chunksize=chunksize, **kwargs)
+
+
+def _full_repo_names(chunk):
+    # Issues that were not deduplicated yet contain the owner and repository name in separate columns
+    if "owner" in chunk:
+        return chunk["repo"] + "/" + chunk["owner"]
+    return chunk["repo"]
+
+
+def append_pre_bot_issues(new_filename, pre_filename):
     """
-        Remove duplicates from all TODO-comments that were identified
+        Appends the (not yet deduplicated) issues of new_filename to the (deduplicated) pre-bot issue file,
+        such that remove_pre_duplicates() can deduplicate them together
     """
+    columns = pd.read_csv(pre_filename, nrows=0).columns
+    for chunk in _read_csv_chunks(new_filename, **STRING_CSV_OPTIONS):
+        chunk["repo"] = _full_repo_names(chunk)
+        chunk[columns].to_csv(pre_filename, mode="a", header=False, index=False)
 
-    pre_filename = settings.get('results-todo-comments-pre-bot-output-file')
-    df_pre = pd.read_csv(pre_filename)
 
-    # Remove duplicates for issues from the same repo that have the same title.
-    #   Sort first to keep the earlist commit date
-    #   Issues: 34948 -> 24396
-    df_pre = df_pre.sort_values('commit_date', ascending=True)
-    df_pre = df_pre.drop_duplicates(subset=["repo", "owner", "title"]).sort_index()
+def filter_pre_bot_issues(input_filename, output_filename, earliest_todo_issues):
+    """
+        Copies the (not yet deduplicated) issues of the repositories in earliest_todo_issues that were found
+        in commits before the earliest todo issue of their repository
+    """
+    write_header = True
+    for chunk in _read_csv_chunks(input_filename, **STRING_CSV_OPTIONS):
+        # todo[bot] writes the (ISO) commit date it was passed, whereas the earliest issues are epoch timestamps
+        earliest = pd.to_datetime(_full_repo_names(chunk).map(earliest_todo_issues), unit="s")
+        chunk = chunk[pd.to_datetime(chunk["commit_date"], errors="coerce") < earliest]
+        chunk.to_csv(output_filename, mode="w" if write_header else "a", header=write_header, index=False)
+        write_header = False
 
-    df_pre["repo"] = df_pre["repo"] + "/" + df_pre["owner"]
-    del df_pre["owner"]
+    if write_header:
+        pd.DataFrame(columns=PRE_BOT_CSV_COLUMNS).to_csv(output_filename, index=False)
 
-    # Obtain post-bot issues (i.e., those that are actually crated by the bot on GitHub)
+
+def remove_pre_duplicates(settings, logger):
+    """
+        Remove duplicates from all TODO-comments that were identified.
+        The (potentially huge) files are streamed in chunks, so that only the hashed
+        (repo, title)-keys need to be kept in memory.
+        Issues that were deduplicated before (i.e. of which the owner is part of the repo column) are supported as well.
+    """
+    pre_filename = settings.get('results-todo-comments-pre-bot-output-file')
     post_filename = settings.get('results-issues-output-file')
-    df_post = pd.read_csv(post_filename)
-    df_post = df_post.drop_duplicates()
+    key_columns = [column for column in ["repo", "owner", "title", "commit_date"]
+        if column in pd.read_csv(pre_filename, nrows=0).columns]
 
-    df_post["commit_date"] = df_post["created_at"]
-    df_post = df_post[["repo", "title", "body", "commit_date"]]
+    # Find the earliest commit of each (repo, title)-pair; only that one is kept.
+    #   Ties are broken by keeping the first row in the file
+    #   Each chunk is reduced to its own earliest rows, which are combined once all chunks are read
+    #   Issues: 34948 -> 24396
+    chunk_earliest = []
+    num_pre_rows = 0
+    for chunk in _read_csv_chunks(pre_filename, usecols=key_columns, **STRING_CSV_OPTIONS):
+        keys = pd.DataFrame({
+            "key": _repo_title_hashes(_full_repo_names(chunk), chunk["title"]),
+            "commit_date": pd.to_datetime(chunk["commit_date"], errors="coerce").to_numpy(),
+            "row": np.arange(num_pre_rows, num_pre_rows + len(chunk)),
+        })
+        num_pre_rows += len(chunk)
+        chunk_earliest.append(keys.sort_values(["key", "commit_date", "row"]).drop_duplicates(subset="key"))
+
+    if chunk_earliest:
+        earliest = pd.concat(chunk_earliest, ignore_index=True).sort_values(["key", "commit_date", "row"]).drop_duplicates(subset="key")
+        rows_to_keep = np.sort(earliest["row"].to_numpy())
+        del earliest
+    else:
+        rows_to_keep = np.empty(0, dtype=np.int64)
+    del chunk_earliest
 
-    # Indicate from which dataset the issues originated
-    df_post["pre"] = False
-    df_pre["pre"] = True
+    # Obtain post-bot issues (i.e., those that are actually crated by the bot on GitHub)
+    post_keys = [np.unique(_repo_title_hashes(chunk["repo"], chunk["title"]))
+        for chunk in _read_csv_chunks(post_filename, usecols=["repo", "title"], **STRING_CSV_OPTIONS)]
+    post_keys = np.unique(np.concatenate(post_keys)) if post_keys else np.empty(0, dtype=np.uint64)
 
     # Remove issues that were already in the post-batch (i.e., those with the same title from the same repo)
-        # Issues: 24396 -> 20809
-    df_merged = df_pre.append(df_post)
-    df_merged = df_merged.drop_duplicates(subset=["repo", "title"], keep=False)
+    #   Issues: 24396 -> 20809
+    tmp_filename = pre_filename + ".tmp"
+    num_written = 0
+    row_offset = 0
+    write_header = True
+    for chunk in _read_csv_chunks(pre_filename, **STRING_CSV_OPTIONS):
+        is_earliest = np.zeros(len(chunk), dtype=bool)
+        lo, hi = np.searchsorted(rows_to_keep, [row_offset, row_offset + len(chunk)])
+        is_earliest[rows_to_keep[lo:hi] - row_offset] = True
+        row_offset += len(chunk)
+
+        chunk["repo"] = _full_repo_names(chunk)
+        chunk = chunk.drop(columns="owner", errors="ignore")
+
+        keys = _repo_title_hashes(chunk["repo"], chunk["title"])
+        idx = np.minimum(np.searchsorted(post_keys, keys), max(len(post_keys) - 1, 0))
+        in_post = post_keys[idx] == keys if len(post_keys) else np.zeros(len(chunk), dtype=bool)
+
+        chunk = chunk[is_earliest & ~in_post]
+        chunk.to_csv(tmp_filename, mode="w" if write_header else "a", header=write_header, index=False)
+        write_header = False
+        num_written += len(chunk)
+
+    if write_header:
+        # The file did not contain any issues; only output its header
+        columns = pd.read_csv(pre_filename, nrows=0).columns.drop("owner", errors="ignore")
+        pd.DataFrame(columns=columns).to_csv(tmp_filename, index=False)
+
+    os.replace(tmp_filename, pre_filename)
+    logger.info(f"Removed duplicate pre-bot issues: {num_pre_rows} -> {len(rows_to_keep)} -> {num_written}")
+
+
+def load_earliest_todo_issues(filename):
+    """
+        Returns a dict with the (UTC) timestamp of the earliest todo[bot] issue of each (non-skipped) repository
+    """
+    return {name: repo.issues.earliest() for name, repo in load_repos(filename).items() if repo.issues}
 
-    # Only keep the issues in the pre-batch
-    df_merged = df_merged[df_merged["pre"] == True]
-    del df_merged["pre"]
-    df_merged = df_merged.sort_index()
 
-    df_merged.to_csv(pre_filename, index=False)
+def earliest_todo_issue(issues):
+    # Read dates are in UTC
+    return min(parse_timestamp(issue.get('created_at')) for issue in issues)
 
 
-def obtain_cloned_repos(settings, logger):
+def iter_cloned_repos(path):
     """
-        Obtains information (e.g. number of commits) of the cloned repositories
+        Yields (owner, repo, repo_path) for every repository that was cloned in the given folder
     """
-    input_filename = settings.get('results-repos-output-file')
-    with open(input_filename, newline='', encoding='utf-8') as input_file:
-        repos = json.load(input_file)
-
-    # Obtain earliest todo-issue (discard all other data)
-    repos = map(lambda kv: (kv[0],
-        datetime.datetime.fromisoformat(
-            min(kv[1].get('issues'), key=lambda y: y.get('created_at'), default=None).get('created_at')
-            # Read dates are in UTC
-            ).replace(tzinfo=datetime.timezone.utc).timestamp()
-        ),
-        repos.items())
-    repos = dict(repos)
-
-    cloned_repo_lst = []
-
-    path = settings.get("download-output-path-repo")
     with os.scandir(path) as it:
         for entry in it:
             if entry.is_dir():
@@ -122,76 +288,270 @@ def obtain_cloned_repos(settings, logger):
                 with os.scandir(os.path.join(path, entry.name)) as it2:
                     for repo in it2:
                         if repo.is_dir():
-                            repo_name = entry.name + "/" + repo.name
-                            print("Handling " + repo_name)
-                            repo_path = os.path.join(path, entry.name, repo.name)
-                            r = Repository(repo_path)
-                            earliest_todo_issue = repos.get(repo_name)
-                            total_commits = 0
-                            pre_commits = 0
-                            if earliest_todo_issue is not None:
-                                repos[repo_name] = [0, 0]
-                                for commit in r.walk(r.head.target, GIT_SORT_TIME | GIT_SORT_REVERSE):
-                                    if commit.commit_time < earliest_todo_issue:
-                                        pre_commits += 1
-                                    total_commits += 1
-
-                            cloned_repo_lst.append( {
-                                "repo": repo_name,
-                                "cloned": True,
-                                "total_commits": total_commits,
-                                "earliest_todo_issue": earliest_todo_issue,
-                                "pre_earliest_issue_commits": pre_commits,
-                            })
-    df_cloned_repos = pd.DataFrame(cloned_repo_lst, columns=["repo", "cloned", "total_commits", "earliest_todo_issue", "pre_earliest_issue_commits"])
-    df_cloned_repos.to_csv(settings.get('results-clone-info-output-file'), index=False)
+                            yield entry.name, repo.name, os.path.join(path, entry.name, repo.name)
+
 
+def is_pre_bot_commit(commit, earliest_todo_issue):
+    # Ignore post-bot commits + merge commits
+    # NB: The initial commit is ignored as well
+    return commit.commit_time < earliest_todo_issue and commit.parents and len(commit.parents) <= 1
 
-def find_pre_bot_issues(settings, logger):
+
+def count_commits(repo_name, repo_path, earliest_todo_issue, ledger=None, commit_index=None, indexed_commits=()):
     """
-        For each cloned repo's commits, pass them to a local (modified) copy of todo[bot] so that
-        it can identify TODO-comments in those.
+        Obtains the clone information (e.g. number of commits) of a single cloned repository.
+        The number of commits is recorded in the ledger, and each commit is written to the commit index (a csv writer),
+        if these are given. Commits in indexed_commits are not written to the commit index again.
     """
-    input_filename = settings.get('results-repos-output-file')
-    with open(input_filename, newline='', encoding='utf-8') as input_file:
-        repos = json.load(input_file)
+    total_commits = 0
+    pre_commits = 0
+    if earliest_todo_issue is not None:
+        r = Repository(repo_path)
+        for commit in r.walk(r.head.target, GIT_SORT_TIME | GIT_SORT_REVERSE):
+            is_before_earliest_issue = commit.commit_time < earliest_todo_issue
+            if is_before_earliest_issue:
+                pre_commits += 1
+            total_commits += 1
+            if commit_index is not None and commit.hex not in indexed_commits:
+                commit_index.writerow([repo_name, commit.hex, commit.commit_time, len(commit.parents), int(is_before_earliest_issue)])
+        metrics.registry.inc("commits_indexed_total", total_commits)
+        if ledger is not None:
+            ledger.update(repo_name, total_commits=total_commits)
+
+    return {
+        "repo": repo_name,
+        "cloned": True,
+        "total_commits": total_commits,
+        "earliest_todo_issue": earliest_todo_issue,
+        "pre_earliest_issue_commits": pre_commits,
+    }
 
-    # Obtain (repo, earliest_todo_issue) pairs
-    repos = map(lambda kv: (kv[0],
-        datetime.datetime.fromisoformat(
-            min(kv[1].get('issues'), key=lambda y: y.get('created_at'), default=None).get('created_at')
-            # Read dates are in UTC
-            ).replace(tzinfo=datetime.timezone.utc).timestamp()
-        ),
-        repos.items())
-    repos = dict(repos)
-
-    # Iterate over all cloned repos
-    path = settings.get("download-output-path-repo")
-    with os.scandir(path) as it:
-        for entry in it:
-            if entry.is_dir():
-                # Iterate over repo folders (of a single author)
-                with os.scandir(os.path.join(path, entry.name)) as it2:
-                    for repo in it2:
-                        if repo.is_dir():
-                            repo_name = entry.name + "/" + repo.name
-                            logger.debug("Handling " + repo_name)
-                            repo_path = os.path.join(path, entry.name, repo.name)
 
-                            r = Repository(repo_path)
-                            earliest_todo_issue = repos.get(repo_name)
+def obtain_cloned_repos(settings, logger):
+    """
+        Obtains information (e.g. number of commits) of the cloned repositories
+    """
+    # Obtain earliest todo-issue (discard all other data)
+    repos = load_earliest_todo_issues(settings.get('results-repos-output-file'))
+
+    ledger = get_ledger(settings)
+    cloned_repo_lst = []
+    cloned_repos = select_shard(iter_cloned_repos(settings.get("download-output-path-repo")), settings, key=lambda t: t[0] + "/" + t[1])
+    cloned_repos = JobScheduler(settings).schedule(cloned_repos, "scan", key=lambda t: t[0] + "/" + t[1])
+    with open(settings.get('results-commit-index-output-file'), 'w', newline='', encoding='utf-8') as index_file:
+        commit_index = csv.writer(index_file)
+        commit_index.writerow(COMMIT_INDEX_COLUMNS)
+        for owner, name, repo_path in cloned_repos:
+            repo_name = owner + "/" + name
+            logger.debug("Handling " + repo_name)
+            cloned_repo_lst.append(count_commits(repo_name, repo_path, repos.get(repo_name), ledger, commit_index))
+    if ledger is not None:
+        ledger.save()
+
+    df_cloned_repos = pd.DataFrame(cloned_repo_lst, columns=list(CLONE_INFO_DTYPES))
+    df_cloned_repos.to_csv(settings.get('results-clone-info-output-file'), index=False)
+
+
+def clone_info_from_commit_index(clone_info_filename, index_filename, earliest_todo_issues, chunksize=CSV_CHUNK_SIZE):
+    """
+        Obtains the clone information of the repositories in earliest_todo_issues from the clone information
+        and commit index of (a superset of) those repositories, such that their commits do not have to be walked again.
+        The number of pre-bot commits follows from the commit times in the commit index.
+    """
+    df_cloned = pd.read_csv(clone_info_filename, usecols=list(CLONE_INFO_DTYPES), dtype=CLONE_INFO_DTYPES)
+    df_cloned = df_cloned[df_cloned["repo"].isin(list(earliest_todo_issues))].reset_index(drop=True)
+    df_cloned["earliest_todo_issue"] = df_cloned["repo"].map(earliest_todo_issues).astype("float64")
+
+    pre_commits = pd.Series(dtype="int64")
+    for chunk in _read_csv_chunks(index_filename, chunksize, usecols=["repo", "commit_time"]):
+        chunk = chunk[chunk["commit_time"] < chunk["repo"].map(earliest_todo_issues)]
+        pre_commits = pre_commits.add(chunk["repo"].value_counts(), fill_value=0)
+    df_cloned["pre_earliest_issue_commits"] = df_cloned["repo"].map(pre_commits).fillna(0).astype("Int64")
+    return df_cloned
 
-                            if earliest_todo_issue is not None:
-                                # Iterate over all this repo's commits
-                                for commit in r.walk(r.head.target, GIT_SORT_TIME | GIT_SORT_REVERSE):
-                                    # Ignore post-bot commits + merge commits
-                                    # NB: The initial commit is ignored as well
 
-                                    if commit.commit_time < earliest_todo_issue and commit.parents and len(commit.parents) <= 1:
-                                        commit_dt = datetime.datetime.utcfromtimestamp(commit.commit_time).isoformat()
-                                        logger.debug(f"> Handling commit {str(commit.hex)} ({commit_dt})")
-                                        os.system(f'node {settings.get('modified-todo-bot-install-path')} -o "{entry.name}" -r "{repo.name}" -s {commit.hex} -e "{commit_dt}" >> bot_pre_bot_finder_node.log')
+class PreBotIssueScanner:
+    """
+        Passes the pre-bot commits of cloned repositories to a local (modified) copy of todo[bot],
+        so that it can identify TODO-comments in those.
+        The modified todo[bot] appends its issues to a file in its working directory;
+        finish() moves these (with a header) to the pre-bot issue file.
+    """
+    def __init__(self, settings, logger):
+        self.logger = logger
+        self.max_file_size = settings.get('max-diff-file-size', DEFAULT_MAX_FILE_SIZE)
+        self.diff_output_path = settings.get("diffs-output-path")
+        self.prefilter = DeltaPrefilter.from_settings(settings)
+        # The command is followed by the todo[bot] arguments of the commit (e.g. -s <sha>).
+        #   A string is split like a shell command, e.g. 'node /opt/todo-bot/index.js'
+        self.todo_bot_command = settings.get('todo-bot-command') or ["node", settings.get('modified-todo-bot-install-path')]
+        if isinstance(self.todo_bot_command, str):
+            self.todo_bot_command = shlex.split(self.todo_bot_command)
+        self.ledger = get_ledger(settings)
+        self.timeouts = get_timeouts(settings)
+        self.commit_log = LogSampler.from_settings(logger, settings)
+
+        self.pre_filename = settings.get('results-todo-comments-pre-bot-output-file')
+        self.work_path = os.path.dirname(os.path.abspath(self.pre_filename))
+        if settings.get('shard-count'):
+            # Shards on the same machine should not append to the same todo[bot] output file
+            self.work_path = os.path.join(self.work_path, f"todo-bot-shard-{settings.get('shard-index')}-of-{settings.get('shard-count')}")
+        self.todo_bot_output_filename = os.path.join(self.work_path, TODO_BOT_OUTPUT_FILENAME)
+        os.makedirs(self.work_path, exist_ok=True)
+        if os.path.isfile(self.todo_bot_output_filename):
+            os.remove(self.todo_bot_output_filename)
+
+    def scan_repo(self, owner, name, repo_path, earliest_todo_issue, resume_after=None, only_commits=None, skip_commits=None):
+        """
+            Scans the pre-bot commits of a repository. If resume_after is given, only the commits after that commit
+            are scanned; if only_commits is given, only those commits are scanned. Commits in skip_commits are not scanned.
+        """
+        logger = self.logger
+        repo_name = owner + "/" + name
+        logger.debug("Handling " + repo_name)
+
+        start_time = time.perf_counter()
+        with metrics.registry.timer("repo_scan_seconds"):
+            num_scanned, num_invocations = self._scan_commits(owner, name, repo_path, earliest_todo_issue, resume_after,
+                only_commits, skip_commits)
+
+        if self.ledger is not None:
+            # A partial scan (e.g. a retry that resumes a scan that timed out) adds to the costs of the scan it continues
+            is_partial = resume_after is not None or only_commits is not None or skip_commits is not None
+            self.ledger.update(repo_name, accumulate=is_partial, pre_bot_commits_scanned=num_scanned,
+                scan_seconds=time.perf_counter() - start_time, detector_invocations=num_invocations)
+
+    def _scan_commits(self, owner, name, repo_path, earliest_todo_issue, resume_after=None, only_commits=None, skip_commits=None):
+        """
+            Returns the number of pre-bot commits that were scanned, and the number of times todo[bot] was invoked
+        """
+        logger = self.logger
+        repo_name = owner + "/" + name
+        r = Repository(repo_path)
+        skip_cnt = 0
+        skipped_bytes = 0
+        num_scanned = 0
+        num_invocations = 0
+
+        repo_budget = self.timeouts.budget("repo_scan", repo_name)
+        deadline = None if repo_budget is None else time.monotonic() + repo_budget
+        commit_budget = self.timeouts.budget("commit_scan", repo_name)
+        is_resumed = resume_after is None
+        last_commit = resume_after
+
+        # Iterate over all this repo's commits
+        for commit in r.walk(r.head.target, GIT_SORT_TIME | GIT_SORT_REVERSE):
+            if not is_pre_bot_commit(commit, earliest_todo_issue):
+                continue
+            if not is_resumed:
+                is_resumed = commit.hex == resume_after
+                continue
+            if only_commits is not None and commit.hex not in only_commits:
+                continue
+            if skip_commits is not None and commit.hex in skip_commits:
+                continue
+            if deadline is not None and time.monotonic() > deadline:
+                logger.warning(f"Scanning <{repo_name}> timed out after commit {last_commit}")
+                self.timeouts.record("repo_scan", repo_name, repo_budget, f"repo_scan took longer than {repo_budget} seconds",
+                    commit=last_commit)
+                break
+            last_commit = commit.hex
+            metrics.registry.inc("commits_scanned_total")
+            num_scanned += 1
+
+            commit_dt = datetime.datetime.utcfromtimestamp(commit.commit_time).isoformat()
+            self.commit_log.log("commits handled", "> Handling commit %s (%s)", commit.hex, commit_dt)
+
+            # Skip commits that only touch files that todo[bot] should not look at
+            diff = commit_diff(commit)
+            is_relevant, num_bytes = self.prefilter.filter_commit(r, diff)
+            if not is_relevant:
+                self.commit_log.log("commits filtered out", "> Skipping commit %s; all its files were filtered out", commit.hex)
+                skip_cnt += 1
+                skipped_bytes += num_bytes
+                continue
+
+            # The modified todo[bot] reads the diff of a commit from the diffs folder.
+            #   Only the added lines are written, as todo[bot] ignores all other lines
+            diff_filename = f"{self.diff_output_path}/{owner}/{name}/{commit.hex}.diff"
+            if not write_commit_diff(r, commit, diff_filename, self.max_file_size, self.prefilter.accepts_path, diff):
+                self.commit_log.log("commits without added lines", "> Skipping commit %s; it does not add any lines", commit.hex)
+                continue
+
+            metrics.registry.inc("todo_bot_invocations_total")
+            num_invocations += 1
+            try:
+                with open(TODO_BOT_LOG_FILENAME, "a") as node_log, metrics.registry.timer("todo_bot_duration_seconds"):
+                    run_with_timeout(self.todo_bot_command + ["-o", owner, "-r", name, "-s", commit.hex, "-e", commit_dt],
+                        "commit_scan", commit_budget, cwd=self.work_path, stdout=node_log, stderr=subprocess.STDOUT)
+            except JobTimeout as e:
+                logger.warning(f"> todo[bot] was killed for commit {str(commit.hex)}; {e}")
+                self.timeouts.record("commit_scan", repo_name, commit_budget, str(e), commit=commit.hex)
+
+        metrics.registry.inc("prefilter_skipped_commits_total", skip_cnt)
+        metrics.registry.inc("prefilter_skipped_bytes_total", skipped_bytes)
+        logger.info(f"Prefilter skipped {skip_cnt} commits ({skipped_bytes} bytes) of <{owner}/{name}>")
+        return num_scanned, num_invocations
+
+    def retry_timeouts(self, path, earliest_todo_issues, skip_commits=None):
+        """
+            Scans the remainder of the repositories, and the commits, of which the scan timed out (once), with a larger budget.
+            skip_commits can contain the commits of each repository that should not be scanned (as in scan_repo).
+        """
+        skip_commits = skip_commits or {}
+        for repo_name, last_commit in self.timeouts.take_retries("repo_scan"):
+            owner, name = repo_name.split('/', 1)
+            self.logger.info(f"Retrying <{repo_name}> after commit {last_commit}")
+            self.scan_repo(owner, name, os.path.join(path, owner, name), earliest_todo_issues[repo_name], resume_after=last_commit,
+                skip_commits=skip_commits.get(repo_name))
+
+        commits_per_repo = {}
+        for repo_name, commit in self.timeouts.take_retries("commit_scan"):
+            commits_per_repo.setdefault(repo_name, set()).add(commit)
+        for repo_name, commits in commits_per_repo.items():
+            owner, name = repo_name.split('/', 1)
+            self.logger.info(f"Retrying {len(commits)} commits of <{repo_name}>")
+            self.scan_repo(owner, name, os.path.join(path, owner, name), earliest_todo_issues[repo_name], only_commits=commits)
+
+    def finish(self):
+        self.commit_log.flush()
+        if self.ledger is not None:
+            self.ledger.save()
+
+        scan_seconds = metrics.registry.histogram_sum("repo_scan_seconds")
+        if scan_seconds > 0:
+            metrics.registry.set("commits_scanned_per_second", metrics.registry.counter_value("commits_scanned_total") / scan_seconds)
+
+        # Output the identified issues (with a header) in the pre-bot issue file
+        with open(self.pre_filename, "w", newline='', encoding='utf-8') as output_file:
+            csv.writer(output_file).writerow(PRE_BOT_CSV_COLUMNS)
+            if os.path.isfile(self.todo_bot_output_filename):
+                with open(self.todo_bot_output_filename, newline='', encoding='utf-8') as todo_bot_output_file:
+                    shutil.copyfileobj(todo_bot_output_file, output_file)
+                os.remove(self.todo_bot_output_filename)
+
+
+def find_pre_bot_issues(settings, logger, earliest_todo_issues=None):
+    """
+        For each cloned repo's commits, pass them to a local (modified) copy of todo[bot] so that
+        it can identify TODO-comments in those.
+        earliest_todo_issues can contain the (repo, earliest_todo_issue) pairs to use instead of those in the repos file.
+    """
+    # Obtain (repo, earliest_todo_issue) pairs
+    repos = earliest_todo_issues
+    if repos is None:
+        repos = load_earliest_todo_issues(settings.get('results-repos-output-file'))
+
+    # Iterate over all cloned repos, the most expensive ones first
+    scanner = PreBotIssueScanner(settings, logger)
+    cloned_repos = select_shard(iter_cloned_repos(settings.get("download-output-path-repo")), settings, key=lambda t: t[0] + "/" + t[1])
+    cloned_repos = JobScheduler(settings).schedule(cloned_repos, "scan", key=lambda t: t[0] + "/" + t[1])
+    for owner, name, repo_path in cloned_repos:
+        earliest_todo_issue = repos.get(owner + "/" + name)
+        if earliest_todo_issue is not None:
+            scanner.scan_repo(owner, name, repo_path, earliest_todo_issue)
+    scanner.retry_timeouts(settings.get("download-output-path-repo"), repos)
+    scanner.finish()
 
 
 def generate_diffs_and_testcases(settings, logger):
@@ -204,20 +564,9 @@ def generate_diffs_and_testcases(settings, logger):
         Unfortunately, these testcases run WAY too slow when using a lot of them.
         The generated diffs can still be used elsewhere though.
     """
-
-    input_filename = settings.get('results-repos-output-file')
-    with open(input_filename, newline='', encoding='utf-8') as input_file:
-        repos = json.load(input_file)
-
     # Obtain (repo, earliest_todo_comment) pairs
-    repos = map(lambda kv: (kv[0],
-        datetime.datetime.fromisoformat(
-            min(kv[1].get('issues'), key=lambda y: y.get('created_at'), default=None).get('created_at')
-            # Read dates are in UTC
-            ).replace(tzinfo=datetime.timezone.utc).timestamp()
-        ),
-        repos.items())
-    repos = dict(repos)
+    repos = load_earliest_todo_issues(settings.get('results-repos-output-file'))
+    commit_log = LogSampler.from_settings(logger, settings)
 
     js_template = None
     with open('./templates/testcase.js', 'r', encoding="utf-8") as f:
@@ -230,53 +579,38 @@ def generate_diffs_and_testcases(settings, logger):
     path = settings.get("download-output-path-repo")
     test_output_path = settings.get("download-output-path-repo")
     diff_output_path = settings.get("diffs-output-path")
-    with os.scandir(path) as it:
-        for entry in it:
-            if entry.is_dir():
-                # Iterate over repo folders (of a single author)
-                with os.scandir(os.path.join(path, entry.name)) as it2:
-                    for repo in it2:
-                        if repo.is_dir():
-
-                            # Create "test" file for each repo, containing all that repo's commits
-                            test_js_filename = f"{test_output_path}/{entry.name}/{repo.name}.test.js"
-                            os.makedirs(os.path.dirname(test_js_filename), exist_ok=True)
-                            with open(test_js_filename, "a", encoding="utf-8") as testcase_file:
-                                testcase_file.write(js_template_pre)
-
-                                repo_name = entry.name + "/" + repo.name
-                                logger.debug("Handling " + repo_name)
-                                repo_path = os.path.join(path, entry.name, repo.name)
-                                r = Repository(repo_path)
-                                earliest_todo_issue = repos.get(repo_name)
-
-                                if earliest_todo_issue is not None:
-                                    for commit in r.walk(r.head.target, GIT_SORT_TIME | GIT_SORT_REVERSE):
-                                        # Ignore post-bot commits + merge commits
-                                        # the initial commit is ignored as well
-
-                                        if commit.commit_time < earliest_todo_issue and commit.parents and len(commit.parents) <= 1:
-                                            commit_dt = datetime.datetime.utcfromtimestamp(commit.commit_time).isoformat()
-                                            logger.debug(f"Handling commit {str(commit.hex)} ({commit_dt})")
-
-                                            prev_commit = commit.parents[0]
-                                            diff = prev_commit.tree.diff_to_tree(commit.tree)
-
-                                            if diff.patch:
-                                                # Output the diff
-                                                filename = f"{diff_output_path}/{entry.name}/{repo.name}/{commit.hex}.diff"
-                                                os.makedirs(os.path.dirname(filename), exist_ok=True)
-                                                with open(filename, "w", encoding="utf-8") as diff_file:
-                                                    diff_file.write(diff.patch)
-
-                                                # Add the commit to the fake testcase
-                                                result = js_template.substitute({
-                                                    'HEAD_COMMIT_SHA': commit.hex,
-                                                    'DATE': commit.commit_time,
-                                                    'HEAD_COMMIT_AUTHOR_USERNAME': commit.author.name,
-                                                    'REPO_NAME': repo.name,
-                                                    'OWNER_USERNAME': entry.name,
-                                                    'DIFF_FILENAME': filename,
-                                                })
-                                                testcase_file.write(result)
-                                testcase_file.write(js_template_post)
+    max_file_size = settings.get('max-diff-file-size', DEFAULT_MAX_FILE_SIZE)
+    for owner, name, repo_path in iter_cloned_repos(path):
+        # Create "test" file for each repo, containing all that repo's commits
+        test_js_filename = f"{test_output_path}/{owner}/{name}.test.js"
+        os.makedirs(os.path.dirname(test_js_filename), exist_ok=True)
+        with open(test_js_filename, "a", encoding="utf-8") as testcase_file:
+            testcase_file.write(js_template_pre)
+
+            repo_name = owner + "/" + name
+            logger.debug("Handling " + repo_name)
+            r = Repository(repo_path)
+            earliest_todo_issue = repos.get(repo_name)
+
+            if earliest_todo_issue is not None:
+                for commit in r.walk(r.head.target, GIT_SORT_TIME | GIT_SORT_REVERSE):
+                    if is_pre_bot_commit(commit, earliest_todo_issue):
+                        commit_dt = datetime.datetime.utcfromtimestamp(commit.commit_time).isoformat()
+                        commit_log.log("commits handled", "Handling commit %s (%s)", commit.hex, commit_dt)
+                        metrics.registry.inc("commits_scanned_total")
+
+                        # Output the diff (only the added lines are kept)
+                        filename = f"{diff_output_path}/{owner}/{name}/{commit.hex}.diff"
+                        if write_commit_diff(r, commit, filename, max_file_size):
+                            # Add the commit to the fake testcase
+                            result = js_template.substitute({
+                                'HEAD_COMMIT_SHA': commit.hex,
+                                'DATE': commit.commit_time,
+                                'HEAD_COMMIT_AUTHOR_USERNAME': commit.author.name,
+                                'REPO_NAME': name,
+                                'OWNER_USERNAME': owner,
+                                'DIFF_FILENAME': filename,
+                            })
+                            testcase_file.write(result)
+            testcase_file.write(js_template_post)
+    commit_log.flush()
@@ -0,0 +1,123 @@
+"""Contains the compact in-memory records of the repositories and their issues, and the (de)serialisation of the repository file"""
+
+import json
+import sys
+from array import array
+from datetime import datetime, timezone
+
+
+# States of an issue, which are stored as their index
+ISSUE_STATES = ["open", "closed"]
+
+# Format of the creation dates of issues in the issues and repository files (in UTC)
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def parse_timestamp(value):
+    """
+        Returns the (integer) UTC epoch timestamp of a date in the issues file
+    """
+    return int(datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp())
+
+
+def format_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime(TIMESTAMP_FORMAT)
+
+
+class IssueColumns:
+    """
+        The issues of a single repository, stored as columns: their numbers and creation dates (epoch timestamps)
+        in integer arrays, and their states as a byte each. Iterating yields the issues as in the repository file.
+    """
+    __slots__ = ("numbers", "created_at", "states")
+
+    def __init__(self):
+        self.numbers = array('q')
+        self.created_at = array('q')
+        self.states = bytearray()
+
+    def append(self, number, created_at, state):
+        self.numbers.append(int(number))
+        self.created_at.append(created_at)
+        self.states.append(ISSUE_STATES.index(state))
+
+    def earliest(self):
+        """
+            Returns the (epoch) creation date of the earliest issue, or None if there are no issues
+        """
+        return min(self.created_at) if self.created_at else None
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __iter__(self):
+        for number, created_at, state in zip(self.numbers, self.created_at, self.states):
+            yield {'number': str(number), 'created_at': format_timestamp(created_at), 'state': ISSUE_STATES[state]}
+
+
+class RepoRecord:
+    """
+        A repository in the repository file. Its information (e.g. stars) is kept in the (shared) dict that it was
+        fetched with, and its issues (if it was not skipped) as IssueColumns. Names are interned, as the same names
+        are kept by many stages. Reading works as for the dict of the repository file (e.g. repo.get('clone_url')).
+    """
+    __slots__ = ("name", "info", "issues")
+
+    def __init__(self, name, info, issues=None):
+        self.name = sys.intern(name)
+        self.info = info
+        self.issues = None if info.get('skipped') else (issues if issues is not None else IssueColumns())
+
+    def get(self, key, default=None):
+        if key == 'issues':
+            return self.issues if self.issues is not None else default
+        return self.info.get(key, default)
+
+    def __getitem__(self, key):
+        if key == 'issues' and self.issues is not None:
+            return self.issues
+        return self.info[key]
+
+    def to_json(self):
+        if self.issues is None:
+            return self.info
+        return dict(self.info, issues=list(self.issues))
+
+
+def _object_hook(obj):
+    # Issues are reduced to tuples as soon as they are read, and the issues of a repository to columns
+    if 'number' in obj and 'created_at' in obj and 'state' in obj:
+        return obj['number'], parse_timestamp(obj['created_at']), obj['state']
+    if 'skipped' in obj:
+        issues = None
+        if not obj.get('skipped'):
+            issues = IssueColumns()
+            for issue in obj.pop('issues', []):
+                issues.append(*issue)
+        return RepoRecord("", obj, issues)
+    return obj
+
+
+def load_repos(filename):
+    """
+        Returns a RepoRecord for each repository in the repository file, by name
+    """
+    with open(filename, newline='', encoding='utf-8') as input_file:
+        repos = json.load(input_file, object_hook=_object_hook)
+    for name, repo in repos.items():
+        repo.name = sys.intern(name)
+    return {repo.name: repo for repo in repos.values()}
+
+
+def save_repos(repos, filename):
+    """
+        Outputs the repositories (RepoRecords by name) in the repository file. The repositories are written
+        one at a time, so their issues are never all inflated at once.
+    """
+    with open(filename, 'w', newline='', encoding='utf-8') as output_file:
+        output_file.write("{")
+        for idx, (name, repo) in enumerate(repos.items()):
+            if idx:
+                output_file.write(", ")
+            output_file.write(f"{json.dumps(name)}: {json.dumps(repo.to_json())}")
+        output_file.write("}")
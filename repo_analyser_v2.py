@@ -1,21 +1,60 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import cached_property
+
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
+import plotly.io as pio
 import numpy as np
 
+
+# Folder in which all figures are exported
+IMAGE_OUTPUT_PATH = "output/images"
+
 # Remove uncloned repositories from a dataframe
 def remove_uncloned(df):
     return df[df["cloned"] == True]
 
 
-# Number of commits before todo[bot] histogram
-def plot_commits_pre(settings, logger):
-    input_filename = "output/total_repo_information.csv"
-    df = pd.read_csv(input_filename)
+class AnalysisData:
+    """
+        Loads each input of the analysis once, and caches it for all figures.
+        Figures should copy a cached dataframe before modifying it.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+        self.load_times = {}
+
+    def _read_csv(self, setting, **kwargs):
+        start_time = time.perf_counter()
+        df = pd.read_csv(self.settings.get(setting), **kwargs)
+        self.load_times[setting] = time.perf_counter() - start_time
+        return df
+
+    @cached_property
+    def repos(self):
+        return self._read_csv('results-merged-output-file')
+
+    @cached_property
+    def cloned_repos(self):
+        return remove_uncloned(self.repos)
+
+    @cached_property
+    def issues(self):
+        return self._read_csv('results-issues-output-file', usecols=["repo", "number", "created_at"]).drop_duplicates()
+
+    @cached_property
+    def pre_issues(self):
+        return self._read_csv('results-todo-comments-pre-bot-output-file', usecols=["commit_date"])
+
 
-    df = remove_uncloned(df)
+# Number of commits before todo[bot] histogram
+def plot_commits_pre(data, logger):
+    df = data.cloned_repos
     df = df[(df['pre_earliest_issue_commits'] < 100)]
-    print(df)
+    logger.debug(df)
 
     fig = go.Figure()
     fig.add_trace(go.Histogram(
@@ -30,19 +69,15 @@ def plot_commits_pre(settings, logger):
         xaxis_tick0 = 0,
         xaxis_dtick = 10
     )
-    fig.show()
-    fig.write_image("output/images/pre_commits.svg")
+    return [("pre_commits.svg", fig)]
 
 
 # Number of commits per TODO-comment (pre- and post-bot)
-def plot_pre_post_conclusion(settings, logger):
-    input_filename = "output/total_repo_information.csv"
-    df = pd.read_csv(input_filename)
-    pd.set_option("display.precision", 20)
-    df = remove_uncloned(df)
+def plot_pre_post_conclusion(data, logger):
+    df = data.cloned_repos.copy()
     df["num_pre_per_commits"] = df['pre_earliest_issue_commits'] / df['num_pre_issues']
     df["num_post_per_commits"] = (df['total_commits'] - df['pre_earliest_issue_commits']) /  df['num_post_issues']
-    print(df)
+    logger.debug(df)
 
     fig = go.Figure(data=go.Scattergl(
         x = df['num_pre_per_commits'],
@@ -64,16 +99,12 @@ def plot_pre_post_conclusion(settings, logger):
         yaxis_title_text="Number of commits per 'TODO'-comment (post)",
         xaxis_title_text="Number of commits per 'TODO'-comment (pre)",
     )
-    fig.show()
-    fig.write_image("output/images/scatterplot_pre_post_todos.svg")
+    return [("scatterplot_pre_post_todos.svg", fig)]
 
 
 # Histogram total number of TODO-comments (pre- and post-todo[bot])
-def plot_pre_post_todo(settings, logger):
-    input_filename = "output/total_repo_information.csv"
-    df = pd.read_csv(input_filename)
-
-    df = remove_uncloned(df)
+def plot_pre_post_todo(data, logger):
+    df = data.cloned_repos.copy()
     # df = df[df["num_pre_issues"] <= 350]
     df["num_total_issues"] = df['num_pre_issues'] + df['num_post_issues']
 
@@ -92,21 +123,18 @@ def plot_pre_post_todo(settings, logger):
         xaxis_dtick = 25,
         # barmode = 'stack',
     )
-    fig.show()
-    fig.write_image("output/images/issues_pre_post.svg")
+    return [("issues_pre_post.svg", fig)]
 
 
 # Histogram TODO-comments before todo[bot]
-def plot_pre_todo(settings, logger):
-    input_filename = "output/total_repo_information.csv"
-    df = pd.read_csv(input_filename)
-    df = remove_uncloned(df)
+def plot_pre_todo(data, logger):
+    df = data.cloned_repos
     df = df.sort_values(by=["num_pre_issues"])
 
     df = df[df["num_pre_issues"] <= 350]
-    print(df)
+    logger.debug(df)
     df = df[df["pre_earliest_issue_commits"] > 1]
-    print(df)
+    logger.debug(df)
 
     fig = px.histogram(
         x=df['num_pre_issues'], log_y=True
@@ -124,15 +152,12 @@ def plot_pre_todo(settings, logger):
         # barmode = 'stack',
     )
 
-    fig.show()
-    fig.write_image("output/images/issues_pre.svg")
+    return [("issues_pre.svg", fig)]
 
 
 # Repo earliest todo issue histogram
-def plot_repo_creation_updated(settings, logger):
-    input_filename = "output/total_repo_information.csv"
-    df = pd.read_csv(input_filename)
-    df = df[df["cloned"] == True]
+def plot_repo_creation_updated(data, logger):
+    df = data.cloned_repos
 
     fig = go.Figure()
     fig.add_trace(go.Histogram(x=df["earliest_todo_issue"], name="Created", cumulative_enabled=False))
@@ -150,15 +175,13 @@ def plot_repo_creation_updated(settings, logger):
         xaxis_title_text="Date",
         barmode='overlay',
     )
-    fig.show()
-    fig.write_image("output/images/repo_first_todo.svg")
+    return [("repo_first_todo.svg", fig)]
 
 
 # Issue creation date histogram
-def plot_issues_by_date(settings, logger):
-    input_filename = "output/issue-results_september_09.csv"
-    df = pd.read_csv(input_filename)
-    df = df.drop_duplicates()
+def plot_issues_by_date(data, logger):
+    figures = []
+    df = data.issues
 
     fig = go.Figure()
     fig.add_trace(go.Histogram(x=df["created_at"], name="Amount"))
@@ -176,12 +199,10 @@ def plot_issues_by_date(settings, logger):
         xaxis_title_text="Issue Creation Date",
         barmode='overlay',
     )
-    fig.show()
-    fig.write_image("output/images/issues_by_date_pre.svg")
+    figures.append(("issues_by_date_pre.svg", fig))
 
 
-    input_filename = "output/issues_pre_bot_no_duplicates.csv"
-    df2 = pd.read_csv(input_filename)
+    df2 = data.pre_issues
     fig = go.Figure()
     fig.add_trace(go.Histogram(x=df2["commit_date"], name="Pre todo[bot]"))
 
@@ -197,8 +218,7 @@ def plot_issues_by_date(settings, logger):
         xaxis_title_text="Date",
         barmode='stack',
     )
-    fig.show()
-    fig.write_image("output/images/issues_by_date_post.svg")
+    figures.append(("issues_by_date_post.svg", go.Figure(fig)))
 
     fig.add_trace(go.Histogram(x=df["created_at"], name="Post todo[bot]"))
     fig.update_layout(
@@ -209,16 +229,13 @@ def plot_issues_by_date(settings, logger):
             x=0.01
         )
     )
-    fig.show()
-    fig.write_image("output/images/issues_by_date_both.svg")
+    figures.append(("issues_by_date_both.svg", fig))
+    return figures
 
 
 # Number of TODO-issues per repo
-def plot_issues(settings, logger):
-    input_filename = "output/total_repo_information.csv"
-    df = pd.read_csv(input_filename)
-    df = remove_uncloned(df)
-
+def plot_issues(data, logger):
+    df = data.cloned_repos
 
     fig = px.histogram(
         x=df['num_post_issues'], log_y=True
@@ -236,18 +253,14 @@ def plot_issues(settings, logger):
         # barmode = 'stack',
     )
 
-    fig.show()
-    fig.write_image("output/images/issues_pre.svg")
+    return [("issues_post.svg", fig)]
 
 
 # Commits Histogram
-def plot_commits(settings, logger):
-    input_filename = "output/total_repo_information.csv"
-    df = pd.read_csv(input_filename)
-
-    df = remove_uncloned(df)
+def plot_commits(data, logger):
+    df = data.cloned_repos
     # df = df[(df['total_commits'] < 500)]
-    print(df)
+    logger.debug(df)
 
     fig = go.Figure()
     # fig.add_trace(go.Histogram(
@@ -270,23 +283,19 @@ def plot_commits(settings, logger):
         xaxis_dtick = 5000,
     )
 
-    fig.show()
-    fig.write_image("output/images/total_commits_limited_stacked.svg")
+    return [("total_commits_limited_stacked.svg", fig)]
 
 
 # Usage numbers; how many repositories with todo[bot] does each GitHub user have?
-def find_usage_numbers(settings, logger):
-    input_filename = "output/total_repo_information.csv"
-    df = pd.read_csv(input_filename)
-
-    df = df[["repo"]]
+def find_usage_numbers(data, logger):
+    df = data.repos[["repo"]].copy()
 
     df[['owner', 'repo']] = df['repo'].str.split('/', n=1, expand=True)
-    print(df)
+    logger.debug(df)
 
     df = df.groupby(by=["owner"]).size().reset_index(name='num_repos')
     df = df.sort_values(by=["num_repos"])
-    print(df)
+    logger.debug(df)
 
     fig = px.histogram(df, x="num_repos", log_y=True)
 
@@ -298,16 +307,13 @@ def find_usage_numbers(settings, logger):
         xaxis_tick0 = 0,
         xaxis_dtick = 5,
     )
-    fig.show()
-    fig.write_image("output/images/usage.svg")
+    return [("usage.svg", fig)]
 
 
 # Histogram of stars/forks/watchers
-def plot_stars_forks_watchers_hist(settings, logger):
-    input_filename = "output/total_repo_information.csv"
-    df = pd.read_csv(input_filename)
-
-    df = remove_uncloned(df)
+def plot_stars_forks_watchers_hist(data, logger):
+    figures = []
+    df = data.cloned_repos
 
     fig = go.Figure()
     fig.add_trace(go.Histogram(
@@ -342,14 +348,13 @@ def plot_stars_forks_watchers_hist(settings, logger):
         )
     )
 
-    fig.show()
-    fig.write_image("output/images/hist_stars_forks_watchers_full.svg")
+    figures.append(("hist_stars_forks_watchers_full.svg", fig))
 
-    print(df)
+    logger.debug(df)
     filter_val = 25
     df = df[(df['forks'] < filter_val) & (df['stars'] < filter_val) & (df['watchers'] < filter_val)]
 
-    print(df)
+    logger.debug(df)
 
     fig = go.Figure()
     fig.add_trace(go.Histogram(
@@ -380,16 +385,13 @@ def plot_stars_forks_watchers_hist(settings, logger):
             x=0.99
         )
     )
-    fig.show()
-    fig.write_image("output/images/hist_stars_forks_watchers_small.svg")
+    figures.append(("hist_stars_forks_watchers_small.svg", fig))
+    return figures
 
 
 # Scatterplot of forks, stars, and watchers
-def plot_stars_forks_watchers_scatter(settings, logger):
-    input_filename = "output/total_repo_information.csv"
-    df = pd.read_csv(input_filename)
-
-    df = remove_uncloned(df)
+def plot_stars_forks_watchers_scatter(data, logger):
+    df = data.cloned_repos.copy()
 
     df['stars'] = df['stars'].apply(lambda x: x+1)
     df['forks'] = df['forks'].apply(lambda x: x+1)
@@ -419,11 +421,71 @@ def plot_stars_forks_watchers_scatter(settings, logger):
         yaxis_title_text="Forks (log + 1)",
         xaxis_title_text="Stars (log + 1)",
     )
-    fig.show()
-    fig.write_image("output/images/scatterplot_stars_forks_watchers.svg")
 
     # A density-contour plot did not seem useful for this data
     # fig = px.density_contour(df, x=df["stars"], y=df["forks"])
     # fig.update_traces(contours_coloring="fill", contours_showlabels = True)
-
-
+    return [("scatterplot_stars_forks_watchers.svg", fig)]
+
+
+# All figures that can be generated, in no particular order
+FIGURES = {
+    "usage_numbers":                find_usage_numbers,
+    "stars_forks_watchers_hist":    plot_stars_forks_watchers_hist,
+    "stars_forks_watchers_scatter": plot_stars_forks_watchers_scatter,
+    "commits":                      plot_commits,
+    "issues":                       plot_issues,
+    "issues_by_date":               plot_issues_by_date,
+    "repo_creation_updated":        plot_repo_creation_updated,
+    "pre_todo":                     plot_pre_todo,
+    "pre_post_todo":                plot_pre_post_todo,
+    "pre_post_conclusion":          plot_pre_post_conclusion,
+    "commits_pre":                  plot_commits_pre,
+}
+
+
+def _export_figure(fig_json, filename):
+    # Runs in a worker process; figures are passed as JSON as they are cheap to (de)serialise that way
+    start_time = time.perf_counter()
+    pio.from_json(fig_json).write_image(filename)
+    return time.perf_counter() - start_time
+
+
+def run_analysis(settings, logger, figure_names=None, show=False, max_workers=None):
+    """
+        Generates the given figures (or all of them) from inputs that are loaded only once.
+        The figures are exported in a process pool, as exporting is by far the slowest step.
+        Figures are only shown interactively if show is True.
+    """
+    figure_names = list(FIGURES) if figure_names is None else figure_names
+    for name in figure_names:
+        if name not in FIGURES:
+            raise ValueError(f"Invalid figure <{name}>, expected one of <{', '.join(FIGURES)}>")
+
+    os.makedirs(IMAGE_OUTPUT_PATH, exist_ok=True)
+    data = AnalysisData(settings)
+    build_times = {}
+    export_times = {name: 0.0 for name in figure_names}
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for name in figure_names:
+            start_time = time.perf_counter()
+            figures = FIGURES[name](data, logger)
+            build_times[name] = time.perf_counter() - start_time
+
+            for filename, fig in figures:
+                if show:
+                    fig.show()
+                future = executor.submit(_export_figure, fig.to_json(), os.path.join(IMAGE_OUTPUT_PATH, filename))
+                futures[future] = name
+
+        for future in as_completed(futures):
+            export_times[futures[future]] += future.result()
+
+    logger.info("======ANALYSIS======")
+    for setting, load_time in data.load_times.items():
+        logger.info(f"Loaded <{settings.get(setting)}> in {load_time:.2f}s")
+    for name in figure_names:
+        logger.info(f"{name:<30} build: {build_times[name]:7.2f}s   export: {export_times[name]:7.2f}s")
+    logger.info("====================\n")
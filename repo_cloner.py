@@ -1,10 +1,353 @@
-import json
+import heapq
 import os
+import random
+import shutil
+import stat
+import struct
+import threading
+import time
+from collections import Counter
 from datetime import datetime, timedelta
 
-from pygit2 import clone_repository
+from pygit2 import Commit, Repository, GIT_CHECKOUT_FORCE
 from pygit2.errors import GitError
 
+import metrics
+from cost_ledger import directory_size, get_ledger
+from git_transfer import run_transfer
+from object_sharing import get_object_store
+from records import load_repos
+from scheduler import JobScheduler
+from sharding import select_shard
+from timeouts import JobTimeout, get_timeouts
+
+
+# Defaults of the 'clone-retries' settings
+DEFAULT_MAX_ATTEMPTS = 4
+DEFAULT_BASE_DELAY = 30
+DEFAULT_MAX_DELAY = 900
+
+# Outcomes of a clone after which it is retried
+RETRIED_OUTCOMES = ["transient", "corrupt"]
+
+# Parts of the (lowercase) error messages of failed clones, by which the failures are classified
+PERMANENT_ERROR_PATTERNS = [
+    "cannot checkout to invalid path", "invalid path for filesystem", "filename or extension is too long",
+    "repository not found", "unexpected http status code: 404", "authentication required", "unexpected http status code: 401",
+    "unexpected http status code: 403", "access denied", "unsupported url protocol",
+]
+CORRUPT_ERROR_PATTERNS = [
+    "corrupt", "packfile", "object not found", "invalid object", "bad object", "hash mismatch", "failed to stat",
+]
+
+# A clone should at least contain the commit HEAD points to, and its tree
+MIN_CLONE_OBJECTS = 2
+
+PACK_IDX_V2_MAGIC = b"\xfftOc"
+
+
+class RepoCloner:
+    """
+        Clones repositories into <output_path>/<owner>/<repo>, and verifies the integrity of each clone.
+        The costs of each clone are recorded in the cost ledger, and clones that exceed their budget are recorded as timed out.
+        If an object store is given, repositories that belong to a group of forks fetch their objects into the store of that group.
+        Clones that failed for a transient reason, or that are corrupt, are retried in the background
+        with exponential backoff (see clone_with_retries). Clones and fetches that timed out are retried once with a
+        larger budget, after the background retries are done (see wait_for_retries).
+    """
+    def __init__(self, settings, logger, object_store=None):
+        self.output_path = settings.get('download-output-path-repo')
+        self.logger = logger
+        self.object_store = object_store
+        self.ledger = get_ledger(settings)
+        self.timeouts = get_timeouts(settings)
+
+        retry_settings = settings.get('clone-retries') or {}
+        self.max_attempts = retry_settings.get('max-attempts', DEFAULT_MAX_ATTEMPTS)
+        self.base_delay = retry_settings.get('base-delay-seconds', DEFAULT_BASE_DELAY)
+        self.max_delay = retry_settings.get('max-delay-seconds', DEFAULT_MAX_DELAY)
+
+        self.outcomes = {}
+        # Repositories of which the clone (or fetch, if None) timed out, and the callbacks of their retry.
+        #   Each is only retried once
+        self._timed_out = {}
+        self._timeouts_retried = set()
+        self._retries = []
+        self._num_retrying = 0
+        self._condition = threading.Condition()
+        self._retry_thread = None
+
+    def clone(self, repo_name, repo):
+        """
+            Makes a single attempt at cloning a repository. Returns the outcome: 'success', 'timeout', or
+            the class of failure ('transient', 'permanent' or 'corrupt').
+        """
+        logger = self.logger
+        repo_path = os.path.join(self.output_path, repo_name)
+        budget_seconds = self.timeouts.budget("clone", repo_name)
+        received_bytes = 0
+        start_time = time.perf_counter()
+        try:
+            with metrics.registry.timer("clone_duration_seconds"):
+                is_cloned = False
+                if self.object_store is not None and self.object_store.is_shared(repo_name, repo):
+                    try:
+                        received_bytes = self.object_store.clone(repo_name, repo, repo_path, budget_seconds)
+                        is_cloned = True
+                        metrics.registry.inc("shared_clones_total")
+                    except (GitError, KeyError) as e:
+                        logger.warning(f"\t* Could not share the objects of <{repo_name}>; cloning it separately instead! {e}")
+                        remove_clone(repo_path)
+                if not is_cloned:
+                    received_bytes = run_transfer(["clone", repo.get('clone_url'), repo_path], budget_seconds)
+
+            problem = verify_clone(repo_path)
+            if problem is not None:
+                logger.error(f"\t* Clone of <{repo_name}> is corrupt: {problem}")
+                remove_clone(repo_path)
+                outcome = "corrupt"
+            else:
+                logger.debug(f"\t* Successfully cloned <{repo_name}>")
+                outcome = "success"
+                if self.ledger is not None:
+                    self.ledger.update(repo_name, clone_seconds=time.perf_counter() - start_time,
+                        bytes_received=received_bytes, disk_bytes=directory_size(repo_path))
+        except JobTimeout as e:
+            logger.warning(f"\t* Cloning <{repo_name}> timed out; {e}")
+            remove_clone(repo_path)
+            self.timeouts.record("clone", repo_name, budget_seconds, str(e))
+            with self._condition:
+                self._timed_out.setdefault(repo_name, (repo, None, None))
+            outcome = "timeout"
+        except GitError as e:
+            outcome = classify_clone_error(e)
+            logger.error(f"\t* Unexpected {type(e)} (GitError, {outcome}) for <{repo_name}>! {e}")
+            # Repositories that cannot be checked out (on this file system) still contain all their commits
+            if outcome != "permanent":
+                remove_clone(repo_path)
+        finally:
+            metrics.registry.inc("clone_bytes_total", received_bytes)
+            metrics.registry.observe("clone_bytes", received_bytes)
+
+        metrics.registry.inc("clones_total", outcome=outcome)
+        with self._condition:
+            self.outcomes[repo_name] = outcome
+        return outcome
+
+    def update(self, repo_name, on_retry_success=None):
+        """
+            Fetches the new commits of a repository that was cloned before, and moves its checked out branch to those.
+            Returns whether this succeeded. If the fetch timed out, on_retry_success is called once its retry
+            (see wait_for_retries) succeeds.
+        """
+        logger = self.logger
+        repo_path = os.path.join(self.output_path, repo_name)
+        budget_seconds = self.timeouts.budget("clone", repo_name)
+        received_bytes = 0
+        try:
+            with metrics.registry.timer("fetch_duration_seconds"):
+                received_bytes = run_transfer(["fetch", repo_path, "origin"], budget_seconds)
+                r = Repository(repo_path)
+                new_target = r.references[f"refs/remotes/origin/{r.head.shorthand}"].target
+                if new_target != r.head.target:
+                    r.references[r.head.name].set_target(new_target)
+                    try:
+                        r.checkout_head(strategy=GIT_CHECKOUT_FORCE)
+                    except GitError as e:
+                        # The new commits can still be scanned; only the working tree is outdated
+                        logger.warning(f"\t* Could not check out the new commits of <{repo_name}>! {e}")
+            logger.debug(f"\t* Successfully fetched <{repo_name}>")
+            metrics.registry.inc("fetches_total", outcome="success")
+            return True
+        except JobTimeout as e:
+            logger.warning(f"\t* Fetching <{repo_name}> timed out; {e}")
+            self.timeouts.record("clone", repo_name, budget_seconds, str(e))
+            with self._condition:
+                self._timed_out[repo_name] = (None, on_retry_success, None)
+            metrics.registry.inc("fetches_total", outcome="timeout")
+            return False
+        except (GitError, KeyError) as e:
+            logger.error(f"\t* Unexpected {type(e)} (GitError) while fetching <{repo_name}>! {e}")
+            metrics.registry.inc("fetches_total", outcome="failure")
+            return False
+        finally:
+            metrics.registry.inc("clone_bytes_total", received_bytes)
+
+    def clone_with_retries(self, repo_name, repo, on_retry_success=None, on_retry_failure=None):
+        """
+            Clones a repository, and returns the outcome of the first attempt (see clone). If it failed for a transient
+            reason or the clone was corrupt, it is retried in the background (while other repositories are cloned);
+            if it timed out, it is retried by wait_for_retries. on_retry_success is then called once a retry succeeds,
+            and on_retry_failure once the last retry failed.
+        """
+        outcome = self.clone(repo_name, repo)
+        if outcome in RETRIED_OUTCOMES and self.max_attempts > 1:
+            self._schedule_retry(repo_name, repo, 1, on_retry_success, on_retry_failure)
+        elif outcome == "timeout":
+            with self._condition:
+                self._timed_out[repo_name] = (repo, on_retry_success, on_retry_failure)
+        elif outcome != "success" and on_retry_failure is not None:
+            on_retry_failure()
+        return outcome
+
+    def _retry_delay(self, attempt):
+        # Exponential backoff with (equal) jitter
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _schedule_retry(self, repo_name, repo, attempt, on_retry_success, on_retry_failure):
+        delay = self._retry_delay(attempt)
+        self.logger.info(f"\t* Retrying <{repo_name}> in {delay:.0f} seconds (attempt {attempt + 1}/{self.max_attempts})")
+        with self._condition:
+            heapq.heappush(self._retries, (time.monotonic() + delay, repo_name, repo, attempt, on_retry_success, on_retry_failure))
+            self._num_retrying += 1
+            if self._retry_thread is None:
+                self._retry_thread = threading.Thread(name="clone-retries", target=self._retry_loop, daemon=True)
+                self._retry_thread.start()
+            self._condition.notify_all()
+
+    def _retry_loop(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._retries)
+                due_time = self._retries[0][0]
+                if due_time > time.monotonic():
+                    self._condition.wait(due_time - time.monotonic())
+                    continue
+                _, repo_name, repo, attempt, on_retry_success, on_retry_failure = heapq.heappop(self._retries)
+
+            try:
+                outcome = self.clone(repo_name, repo)
+                metrics.registry.inc("clone_retries_total", outcome=outcome)
+                if outcome == "success":
+                    if on_retry_success is not None:
+                        on_retry_success()
+                elif outcome in RETRIED_OUTCOMES and attempt + 1 < self.max_attempts:
+                    self._schedule_retry(repo_name, repo, attempt + 1, on_retry_success, on_retry_failure)
+                elif outcome == "timeout":
+                    # Retried (once more) by wait_for_retries
+                    with self._condition:
+                        self._timed_out[repo_name] = (repo, on_retry_success, on_retry_failure)
+                elif on_retry_failure is not None:
+                    on_retry_failure()
+            except Exception as e:
+                self.logger.error(f"Unexpected {type(e)} (Exception) while retrying <{repo_name}>! {e}")
+            finally:
+                with self._condition:
+                    self._num_retrying -= 1
+                    self._condition.notify_all()
+
+    def wait_for_retries(self, before_retry=None):
+        """
+            Waits until the clones that are retried in the background are done, after which the clones and fetches
+            that timed out are retried once, with a larger budget. before_retry(repo_name) is called before each of
+            those (e.g. to wait for disk space).
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._num_retrying == 0)
+
+        for repo_name, _ in self.timeouts.take_retries("clone"):
+            with self._condition:
+                if repo_name not in self._timed_out or repo_name in self._timeouts_retried:
+                    continue
+                repo, on_retry_success, on_retry_failure = self._timed_out.pop(repo_name)
+                self._timeouts_retried.add(repo_name)
+
+            self.logger.info(f"Retrying <{repo_name}> with a budget of {self.timeouts.budget('clone', repo_name)} seconds")
+            if before_retry is not None:
+                before_retry(repo_name)
+            succeeded = self.update(repo_name) if repo is None else self.clone(repo_name, repo) == "success"
+            if succeeded and on_retry_success is not None:
+                on_retry_success()
+            elif not succeeded and on_retry_failure is not None:
+                on_retry_failure()
+
+    def outcome_counts(self):
+        with self._condition:
+            return Counter(self.outcomes.values())
+
+
+def classify_clone_error(error):
+    """
+        Classifies why a clone failed: 'permanent' (e.g. the repository is gone, private, or cannot be checked out),
+        'corrupt' (the received data is invalid) or 'transient' (e.g. network failures; everything else)
+    """
+    message = str(error).lower()
+    if any(pattern in message for pattern in PERMANENT_ERROR_PATTERNS):
+        return "permanent"
+    if any(pattern in message for pattern in CORRUPT_ERROR_PATTERNS):
+        return "corrupt"
+    return "transient"
+
+
+def _count_pack_objects(idx_filename):
+    # The last entry of the fan-out table of a pack index contains the number of objects in the pack
+    with open(idx_filename, 'rb') as idx_file:
+        header = idx_file.read(8)
+        fanout_offset = 8 if header[:4] == PACK_IDX_V2_MAGIC else 0
+        idx_file.seek(fanout_offset + 255 * 4)
+        return struct.unpack(">I", idx_file.read(4))[0]
+
+
+def count_objects(objects_path, follow_alternates=True):
+    """
+        Counts the (packed and loose) objects in an object folder, including those of its alternates
+    """
+    num_objects = 0
+    pack_path = os.path.join(objects_path, "pack")
+    if os.path.isdir(pack_path):
+        num_objects += sum(_count_pack_objects(os.path.join(pack_path, filename))
+            for filename in os.listdir(pack_path) if filename.endswith(".idx"))
+    for entry in os.scandir(objects_path):
+        if entry.is_dir() and len(entry.name) == 2:
+            num_objects += len(os.listdir(entry.path))
+
+    alternates_filename = os.path.join(objects_path, "info", "alternates")
+    if follow_alternates and os.path.isfile(alternates_filename):
+        with open(alternates_filename, encoding='utf-8') as alternates_file:
+            for line in alternates_file:
+                if line.strip() and os.path.isdir(line.strip()):
+                    num_objects += count_objects(line.strip(), follow_alternates=False)
+    return num_objects
+
+
+def verify_clone(repo_path):
+    """
+        Quick integrity check of a clone: HEAD should resolve to a commit (with a tree), and the number of objects
+        should be sane. Returns the problem that was found, or None if there is none.
+    """
+    try:
+        r = Repository(repo_path)
+        head_commit = r[r.head.target]
+        if not isinstance(head_commit, Commit):
+            return f"HEAD does not point to a commit, but to a {type(head_commit).__name__}"
+        head_commit.tree
+    except (GitError, KeyError, ValueError) as e:
+        return f"HEAD does not resolve ({e})"
+
+    num_objects = count_objects(os.path.join(r.path, "objects"))
+    if num_objects < MIN_CLONE_OBJECTS:
+        return f"it only contains {num_objects} objects"
+    return None
+
+
+def _make_writable_and_retry(func, path, _):
+    # Git marks its object files as read-only, which prevents them from being removed on Windows
+    os.chmod(path, stat.S_IWRITE)
+    func(path)
+
+
+def remove_clone(repo_path):
+    """
+        Removes a cloned repository, and the folder of its owner if that is now empty
+    """
+    if os.path.isdir(repo_path):
+        shutil.rmtree(repo_path, onerror=_make_writable_and_retry)
+    try:
+        os.rmdir(os.path.dirname(repo_path))
+    except OSError:
+        pass
+
 
 def clone_repos(settings, logger):
     """
@@ -12,20 +355,15 @@ def clone_repos(settings, logger):
     """
     output_path = settings.get('download-output-path-repo')
 
-    input_filename = settings.get('results-repos-output-file')
-    with open(input_filename, newline='', encoding='utf-8') as input_file:
-        repos = json.load(input_file)
+    repos = load_repos(settings.get('results-repos-output-file'))
+
+    object_store = get_object_store(settings, repos)
+    cloner = RepoCloner(settings, logger, object_store)
 
     repo_start_time = datetime.now()
     logger.info(f"Repo cloning started at {repo_start_time}! Attempting to clone {len(repos)} repos.\nThis is the last step and will take the longest!\n")
 
-    skip_until = None # Insert name of the last successfully cloned repo here
-    skip_until = "baskeboler/cljs-karaoke-client"
-    skip_until = "holisticware-xamarin/HolisticWare.DotNetNew.XamarinProjectsStructureTemplate"
-    skip_until = "timvideos/linux-litex"
-    has_seen_skip = (skip_until is None)
-
-    # Sort the repo names (to ensure items are iterated the same way every time)
+    # Sort the repos on their estimated cost, largest first (to ensure huge repos do not end up last)
     logger.info(f"Sorting and filtering {len(repos)} repository names")
     sorted_repos = []
     for name, repo in repos.items():
@@ -34,13 +372,13 @@ def clone_repos(settings, logger):
         else:
             # Do not clone repositories for which we failed to fetch information earlier in the process
             logger.debug(f"Skipping {name} because of earlier error: {repo.get('error')}")
-    sorted_repos.sort(key=lambda t: t[0])
+    sorted_repos = JobScheduler(settings).schedule(select_shard(sorted_repos, settings, key=lambda t: t[0]), "clone", key=lambda t: t[0])
     num_repos = len(sorted_repos)
 
     logger.info(f"Sorting and filtering finished. Left with {num_repos} repositories")
 
     cnt = 0
-    fail_cnt = 0
+    skip_cnt = 0
     msg_cnt = 0
     last_successful_repo = None
     was_error = False
@@ -50,29 +388,37 @@ def clone_repos(settings, logger):
                 msg_cnt = 0
                 logger.info(f"Finished cloning {cnt}/{num_repos} repositories...")
 
-            if not has_seen_skip:
-                if repo_name == skip_until:
-                    logger.info(f"Successfully skipped until {skip_until}")
-                    has_seen_skip = True
+            # Repos that were cloned in an earlier (interrupted) run are not cloned again
+            if os.path.isdir(os.path.join(output_path, repo_name)):
+                logger.debug(f"\t* <{repo_name}> was already cloned")
+                skip_cnt += 1
                 cnt += 1
                 msg_cnt += 1
                 continue
 
-            try:
-                repo = clone_repository(repo_clone_url, os.path.join(output_path, repo_name))
+            if cloner.clone_with_retries(repo_name, repos[repo_name]) == "success":
                 last_successful_repo = repo_name
-                logger.debug(f"\t* Successfully cloned <{repo_name}>")
-            except GitError as e:
-                logger.error(f"\t* Unexpected {type(e)} (GitError) for <{repo_name}>! {e}")
-                fail_cnt += 1
             cnt += 1
             msg_cnt += 1
+
+        logger.info("Waiting for the clones that are being retried...")
+        cloner.wait_for_retries()
     except Exception as e:
         logger.error(f"Unexpected {type(e)} (Exception)! {e}")
         logger.error(f"Last repo that was successfully cloned: {last_successful_repo}")
         was_error = True
 
+    if cloner.ledger is not None:
+        cloner.ledger.save()
+    if object_store is not None:
+        object_store.report(output_path, settings.get('results-shared-objects-report-file'), logger)
+
+    outcome_cnts = cloner.outcome_counts()
+    fail_cnt = sum(outcome_cnts.values()) - outcome_cnts["success"]
     repo_end_time = datetime.now()
     logger.info(f"Cloning was ended at {repo_end_time}, and took {repo_end_time - repo_start_time} h:mm:ss!")
-    logger.info(f"Cloning process failed for {fail_cnt} repositories.")
+    logger.info(f"Skipped {skip_cnt} repositories that were already cloned.")
+    logger.info(f"Cloning process failed for {fail_cnt} repositories "
+        f"({outcome_cnts['transient']} transient, {outcome_cnts['permanent']} permanent, {outcome_cnts['corrupt']} corrupt, "
+        f"{outcome_cnts['timeout']} timed out).")
     logger.info(f"Obtained {cnt - fail_cnt}/{num_repos} unique repositories, which were output in {output_path}!")
@@ -1,9 +1,11 @@
 import csv
-import json
 from datetime import datetime
 
 from github import BadCredentialsException, UnknownObjectException, GithubException
 
+import metrics
+from issue_body_store import ISSUE_CSV_OPTIONS
+from records import RepoRecord, parse_timestamp, save_repos
 from util import rate_limited_retry_search
 
 
@@ -22,18 +24,69 @@ def repo_adheres_to_settings(repo, settings):
             return False
     return True
 
-def find_repos(github, settings, logger):
+def fetch_repo_info(github, repo_name, settings, logger):
+    """
+        Fetches the information of a single repository.
+        Returns (repo_info, outcome), where outcome is one of 'fetched', 'skipped', 'deleted' or 'error'
+    """
     @rate_limited_retry_search(github)
     def run_repo_query(repo_name):
         results = github.get_repo(repo_name)
+        metrics.registry.inc("github_api_requests_total", endpoint="repos")
         return results
 
+    try:
+        repo = run_repo_query(repo_name)
+
+        if repo_adheres_to_settings(repo, settings):
+            logger.debug(f"Fetched Information of <{repo_name}>")
+            return {
+                'issues': [],
+                'stars': repo.stargazers_count,
+                'forks': repo.forks_count,
+                'watchers': repo.subscribers_count,
+                'is_fork': repo.fork,
+                'source': repo.source.full_name if repo.fork and repo.source else None,
+                'default_branch': repo.default_branch,
+                'is_private': repo.private,
+                'is_archived': repo.archived,
+                'estimated_size': repo.size,
+                'created_at': repo.created_at.isoformat(),
+                'updated_at': repo.updated_at.isoformat(),
+                'clone_url': repo.clone_url,
+                'skipped': False,
+                'error': None,
+            }, 'fetched'
+
+        logger.debug(f"Skipped Information of <{repo_name}> as it did not adhere to the settings")
+        return {
+            'skipped': True,
+            'error': None,
+        }, 'skipped'
+    except (BadCredentialsException, UnknownObjectException) as e:
+        logger.warning(f"Could not fetch information of <{repo_name}>; it might have been deleted or made private!")
+        return {
+            'skipped': True,
+            'error': e.status,
+        }, 'deleted'
+    except GithubException as e:
+        logger.warning(f"Could not fetch information of <{repo_name}> for another reason!")
+        return {
+            'skipped': True,
+            'error': {'status': e.status, 'data': e.data},
+        }, 'error'
+
+
+def find_repos(github, settings, logger, repo_cache=None):
+    """
+        Fetches the information of every repository in the issues file.
+        If repo_cache (a dict) is given, the information of repositories that are in it is not fetched again,
+        and the information that is fetched is added to it.
+        The issues of each repository are kept as compact columns (see records), until they are output.
+    """
     repo_start_time = datetime.now()
     was_error = False
-    succ_cnt = 0
-    skip_cnt = 0
-    del_cnt = 0
-    misc_error_cnt = 0
+    outcome_cnts = {'fetched': 0, 'skipped': 0, 'deleted': 0, 'error': 0}
 
     logger.info(f"====================")
     logger.info(f"Repo Filtering was started at {repo_start_time}!")
@@ -42,70 +95,39 @@ def find_repos(github, settings, logger):
     repos = {}
     try:
         with open(settings.get('results-issues-output-file'), newline='', encoding='utf-8') as issue_file:
-            csv_reader = csv.DictReader(issue_file)
+            csv_reader = csv.DictReader(issue_file, **ISSUE_CSV_OPTIONS)
             for row in csv_reader:
                 repo_name = row['repo']
-                if repo_name not in repos:
-                    try:
-                        repo = run_repo_query(repo_name)
-
-                        if repo_adheres_to_settings(repo, settings):
-                            repos[repo_name] = {
-                                'issues': [],
-                                'stars': repo.stargazers_count,
-                                'forks': repo.forks_count,
-                                'watchers': repo.subscribers_count,
-                                'is_fork': repo.fork,
-                                'is_private': repo.private,
-                                'is_archived': repo.archived,
-                                'estimated_size': repo.size,
-                                'created_at': repo.created_at.isoformat(),
-                                'updated_at': repo.updated_at.isoformat(),
-                                'clone_url': repo.clone_url,
-                                'skipped': False,
-                                'error': None,
-                            }
-                            logger.debug(f"Fetched Information of <{repo_name}>")
-                            succ_cnt += 1
-                        else:
-                            repos[repo_name] = {
-                                'skipped': True,
-                                'error': None,
-                            }
-                            logger.debug(f"Skipped Information of <{repo_name}> as it did not adhere to the settings")
-                            skip_cnt += 1
-                    except (BadCredentialsException, UnknownObjectException) as e:
-                        repos[repo_name] = {
-                            'skipped': True,
-                            'error': e.status,
-                        }
-                        logger.warning(f"Could not fetch information of <{repo_name}>; it might have been deleted or made private!")
-                        del_cnt += 1
-                    except GithubException as e:
-                        logger.warning(f"Could not fetch information of <{repo_name}> for another reason!")
-                        repos[repo_name] = {
-                            'skipped': True,
-                            'error': {'status': e.status, 'data': e.data},
-                        }
-                        misc_error_cnt += 1
-
-                if not repos[repo_name]['skipped']:
-                    repos[repo_name]['issues'].append({'number': row['number'], 'created_at': row['created_at'], 'state': row['state']})
+                repo = repos.get(repo_name)
+                if repo is None:
+                    if repo_cache is not None and repo_name in repo_cache:
+                        repo_info, outcome = repo_cache[repo_name]
+                        metrics.registry.inc("repo_metadata_cache_hits_total")
+                    else:
+                        repo_info, outcome = fetch_repo_info(github, repo_name, settings, logger)
+                        if repo_cache is not None:
+                            repo_cache[repo_name] = (repo_info, outcome)
+                    # The issues differ per issues file; the (cached) information is shared
+                    repo = RepoRecord(repo_name, repo_info)
+                    repos[repo.name] = repo
+                    outcome_cnts[outcome] += 1
+
+                if repo.issues is not None:
+                    repo.issues.append(row['number'], parse_timestamp(row['created_at']), row['state'])
     except Exception as e:
         logger.error(f"Unexpected {type(e)} (Exception): {e}")
         was_error = True
 
     output_filename = settings.get('results-repos-output-file')
-    with open(output_filename, 'w', newline='', encoding='utf-8') as output_file:
-        output_file.write(json.dumps(repos))
+    save_repos(repos, output_filename)
 
     repo_end_time = datetime.now()
     logger.info(f"====================")
     logger.info(f"Search was ended at {repo_end_time}, and took {repo_end_time - repo_start_time} h:mm:ss!")
-    logger.info(f"> Identified {succ_cnt} unique repositries")
-    logger.info(f"> Skipped {skip_cnt} unique repositories")
-    logger.info(f"> Failed (deleted/privatised) {del_cnt} unique repositories")
-    logger.info(f"> Failed (other) {misc_error_cnt} unique repositories")
+    logger.info(f"> Identified {outcome_cnts['fetched']} unique repositries")
+    logger.info(f"> Skipped {outcome_cnts['skipped']} unique repositories")
+    logger.info(f"> Failed (deleted/privatised) {outcome_cnts['deleted']} unique repositories")
+    logger.info(f"> Failed (other) {outcome_cnts['error']} unique repositories")
     logger.info(f"Fetched {len(repos)} unique repositories, which were output in {output_filename}!")
 
     return was_error
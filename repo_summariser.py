@@ -1,45 +1,181 @@
+"""Contains the ranking of the repositories, which lists the top repositories by several attributes (e.g. stars or TODO-comments) at once"""
+
+import argparse
 import csv
+import heapq
 import json
-import logging
+import operator
 import os
+import re
 
-from bot_issue_finder import load_settings, verify_settings_values, SETTING_ALLOWED_VALUES
+import util
+from records import load_repos
 
-if __name__ == "__main__":
-    print("======SETTINGS======")
-    settings = load_settings('settings.json')
-    verify_settings_values(settings, SETTING_ALLOWED_VALUES)
-
-    print("====================\n")
-
-    input_filename = settings.get('results-repos-output-file')
-    with open(input_filename, newline='', encoding='utf-8') as input_file:
-        repos = json.load(input_file)
-
-    attribute_fn = lambda repo: repo.get('stars')
-
-    most_stars = [
-        ('<PLACEHOLDER>', -1), ('<PLACEHOLDER>', -1), ('<PLACEHOLDER>', -1),
-        ('<PLACEHOLDER>', -1), ('<PLACEHOLDER>', -1), ('<PLACEHOLDER>', -1),
-        ('<PLACEHOLDER>', -1), ('<PLACEHOLDER>', -1), ('<PLACEHOLDER>', -1),
-        ('<PLACEHOLDER>', -1), ('<PLACEHOLDER>', -1), ('<PLACEHOLDER>', -1),
-        ('<PLACEHOLDER>', -1), ('<PLACEHOLDER>', -1), ('<PLACEHOLDER>', -1),
-        ('<PLACEHOLDER>', -1), ('<PLACEHOLDER>', -1), ('<PLACEHOLDER>', -1),
-        ('<PLACEHOLDER>', -1), ('<PLACEHOLDER>', -1), ('<PLACEHOLDER>', -1),
-        ('<PLACEHOLDER>', -1), ('<PLACEHOLDER>', -1), ('<PLACEHOLDER>', -1),
-        ('<PLACEHOLDER>', -1), ('<PLACEHOLDER>', -1), ('<PLACEHOLDER>', -1),
-        ('<PLACEHOLDER>', -1), ('<PLACEHOLDER>', -1), ('<PLACEHOLDER>', -1),
-    ]
-
-    for name, repo in repos.items():
+
+# Attributes the repositories can be ranked (and filtered) on, and the column of the final output that contains them.
+#   The repository file only contains the stars, forks and watchers
+RANKING_ATTRIBUTES = {
+    "stars": "stars",
+    "forks": "forks",
+    "watchers": "watchers",
+    "commits": "total_commits",
+    "pre_commits": "pre_earliest_issue_commits",
+    "pre_todos": "num_pre_issues",
+    "post_todos": "num_post_issues",
+}
+
+# Operators of the filters, e.g. 'stars>=100'
+FILTER_OPERATORS = {
+    ">=": operator.ge,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+    ">": operator.gt,
+    "<": operator.lt,
+}
+FILTER_PATTERN = re.compile(r"^\s*(\w+)\s*(" + "|".join(re.escape(op) for op in FILTER_OPERATORS) + r")\s*(\S+)\s*$")
+
+DEFAULT_TOP = 30
+
+
+def _number(value):
+    # Values of the final output are strings, of which missing values are empty (e.g. the commits of uncloned repositories)
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def parse_filter(expression):
+    """
+        Returns the (attribute, operator, value) of a filter such as 'stars>=100' or 'pre_todos>0'
+    """
+    match = FILTER_PATTERN.match(expression)
+    if match is None or match.group(1) not in RANKING_ATTRIBUTES:
+        raise ValueError(f"Invalid filter <{expression}>. Expected <attribute><operator><value>, where the attribute is one of "
+                         f"<{', '.join(RANKING_ATTRIBUTES)}> and the operator one of <{', '.join(FILTER_OPERATORS)}>")
+    return match.group(1), FILTER_OPERATORS[match.group(2)], _number(match.group(3))
+
+
+def iter_merged_repos(filename):
+    """
+        Yields the (repo_name, values)-pair of each repository in the final output, one row at a time
+    """
+    with open(filename, newline='', encoding='utf-8') as input_file:
+        for row in csv.DictReader(input_file):
+            yield row['repo'], {attribute: _number(row.get(column)) for attribute, column in RANKING_ATTRIBUTES.items()}
+
+
+def iter_found_repos(filename):
+    """
+        Yields the (repo_name, values)-pair of each repository in the repository file that was not skipped
+    """
+    for repo_name, repo in load_repos(filename).items():
         if not repo.get('skipped'):
-            for i in range(len(most_stars)):
-                star_repo, stars = most_stars[i]
-                if stars < attribute_fn(repo):
-                    most_stars.insert(i, (name, attribute_fn(repo)))
-                    del most_stars[-1]
-                    break
-
-    
-    for (name, stars) in most_stars:
-        print(f'{name}: {stars}')
+            yield repo_name, {attribute: _number(repo.get(column)) for attribute, column in RANKING_ATTRIBUTES.items()}
+
+
+class TopRanking:
+    """
+        Keeps the top repositories of each attribute while the repositories are streamed through it, in a min-heap
+        of at most num_repos entries per attribute (so O(n log k) in total). Repositories without a value for an
+        attribute are not ranked on it, and ties are won by the repository that was added first.
+    """
+    def __init__(self, attributes, num_repos, filters=()):
+        self.num_repos = num_repos
+        self.filters = list(filters)
+        self.heaps = {attribute: [] for attribute in attributes}
+        self.num_added = 0
+        self.num_filtered = 0
+
+    def matches(self, values):
+        for attribute, compare, threshold in self.filters:
+            if values.get(attribute) is None or not compare(values[attribute], threshold):
+                return False
+        return True
+
+    def add(self, repo_name, values):
+        if not self.matches(values):
+            self.num_filtered += 1
+            return
+
+        self.num_added += 1
+        for attribute, heap in self.heaps.items():
+            value = values.get(attribute)
+            if value is None:
+                continue
+            entry = (value, -self.num_added, repo_name, values)
+            if len(heap) < self.num_repos:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+
+    def top(self, attribute):
+        """
+            Returns the (repo_name, values)-pairs of the top repositories of an attribute, from the highest value down
+        """
+        return [(repo_name, values) for _, _, repo_name, values in sorted(self.heaps[attribute], reverse=True)]
+
+
+def export_ranking(ranking, filename):
+    """
+        Outputs the top repositories of each attribute in CSV format, or in JSON format if filename ends with '.json'
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    if filename.endswith(".json"):
+        with open(filename, 'w', encoding='utf-8') as output_file:
+            json.dump({attribute: [dict(rank=rank, repo=repo_name, **values)
+                for rank, (repo_name, values) in enumerate(ranking.top(attribute), start=1)]
+                for attribute in ranking.heaps}, output_file, indent=4)
+        return
+
+    with open(filename, 'w', newline='', encoding='utf-8') as output_file:
+        csv_writer = csv.writer(output_file)
+        csv_writer.writerow(["attribute", "rank", "repo"] + list(RANKING_ATTRIBUTES))
+        for attribute in ranking.heaps:
+            for rank, (repo_name, values) in enumerate(ranking.top(attribute), start=1):
+                csv_writer.writerow([attribute, rank, repo_name] + ["" if values[column] is None else values[column]
+                    for column in RANKING_ATTRIBUTES])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lists the top repositories by one or more attributes")
+    parser.add_argument('--by', nargs='+', default=["stars"], choices=list(RANKING_ATTRIBUTES), help="Attributes to rank on")
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP, help="Number of repositories to list per attribute")
+    parser.add_argument('--filter', action='append', default=[], dest='filters',
+        help="Only rank the repositories for which the filter holds, e.g. 'stars>=100' (can be given more than once)")
+    parser.add_argument('--input', help="Final output or repository file (JSON) to read. Defaults to the final output in "
+                                        "settings.json, or its repository file if there is no final output yet")
+    parser.add_argument('--output', help="File in which the ranking is output (JSON if it ends with '.json', otherwise CSV)")
+    args = parser.parse_args()
+    try:
+        filters = [parse_filter(expression) for expression in args.filters]
+    except ValueError as error:
+        parser.error(str(error))
+
+    settings = util.load_settings('settings.json')
+    logger = util.create_logger("repo_summariser", "INFO")
+    input_filename = args.input
+    if input_filename is None:
+        input_filename = settings.get('results-merged-output-file')
+        if not os.path.isfile(input_filename):
+            input_filename = settings.get('results-repos-output-file')
+    repos = iter_found_repos(input_filename) if input_filename.endswith(".json") else iter_merged_repos(input_filename)
+
+    ranking = TopRanking(args.by, args.top, filters)
+    for repo_name, values in repos:
+        ranking.add(repo_name, values)
+    logger.info(f"Ranked {ranking.num_added} repositories of {input_filename} ({ranking.num_filtered} were filtered out)")
+
+    for attribute in args.by:
+        print(f"\n{'repo':<60} {attribute:>24}")
+        for repo_name, values in ranking.top(attribute):
+            print(f"{repo_name:<60} {values[attribute]:>24}")
+
+    if args.output:
+        export_ranking(ranking, args.output)
+        logger.info(f"Output the ranking in {args.output}")
@@ -0,0 +1,298 @@
+"""Contains the sampling mode, which estimates the outcomes of the analysis from a stratified sample of repositories and commits"""
+
+import hashlib
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from pygit2 import Repository, GIT_SORT_TIME
+from pygit2.errors import GitError
+
+from pre_bot_issue_finder import CSV_CHUNK_SIZE, STRING_CSV_OPTIONS, PreBotIssueScanner, is_pre_bot_commit
+from records import load_repos
+from repo_cloner import RepoCloner
+from scheduler import load_commit_counts
+
+
+# Repository characteristics that the repositories can be stratified by
+STRATIFY_BY = ["stars", "estimated_size", "total_commits"]
+
+# Sampling settings that are used when they are missing from 'sampling'
+DEFAULT_SAMPLING_SETTINGS = {
+    "stratify-by": "stars",
+    "num-strata": 4,
+    "repos-per-stratum": 25,
+    "commits-per-repo": 100,
+    "seed": 0,
+    "bootstrap-resamples": 1000,
+    "confidence": 0.95,
+}
+
+# Sampling settings that determine which repositories and commits are sampled; if one of these changes,
+#   the sample that was taken before cannot be expanded and is taken anew
+SAMPLE_DEFINING_SETTINGS = ["stratify-by", "num-strata", "seed"]
+
+# Columns of the estimates file
+ESTIMATE_COLUMNS = ["metric", "estimate", "ci_low", "ci_high", "sampled_repos", "population_repos"]
+
+
+def sample_rank(seed, key):
+    """
+        Deterministic pseudo-random rank of a repository (or commit). Taking the items with the lowest ranks
+        results in a random sample, that only grows when more items are taken.
+    """
+    return hashlib.sha1(f"{seed}:{key}".encode('utf-8')).hexdigest()
+
+
+def _weighted_mean(values, weights):
+    return np.average(values, weights=weights)
+
+
+def _weighted_median(values, weights):
+    order = np.argsort(values, kind="stable")
+    cumulative_weights = np.cumsum(weights[order])
+    return values[order][np.searchsorted(cumulative_weights, cumulative_weights[-1] / 2)]
+
+
+def _weighted_ratio(numerators, denominators, weights):
+    denominator = np.sum(denominators * weights)
+    return np.sum(numerators * weights) / denominator if denominator > 0 else np.nan
+
+
+# Metrics that are estimated (those of obtain_pre_post_data and the figures of the analysis);
+#   each takes the sampled repositories and their weights (i.e. the number of repositories each of them represents)
+METRICS = {
+    "share_with_pre_issues":        lambda df, w: _weighted_mean(df["num_pre_issues"].to_numpy() > 0, w),
+    "mean_pre_issues":              lambda df, w: _weighted_mean(df["num_pre_issues"].to_numpy(), w),
+    "mean_post_issues":             lambda df, w: _weighted_mean(df["num_post_issues"].to_numpy(), w),
+    "mean_total_commits":           lambda df, w: _weighted_mean(df["total_commits"].to_numpy(), w),
+    "median_total_commits":         lambda df, w: _weighted_median(df["total_commits"].to_numpy(), w),
+    "mean_pre_earliest_issue_commits":   lambda df, w: _weighted_mean(df["pre_earliest_issue_commits"].to_numpy(), w),
+    "median_pre_earliest_issue_commits": lambda df, w: _weighted_median(df["pre_earliest_issue_commits"].to_numpy(), w),
+    "pre_commits_per_pre_issue":    lambda df, w: _weighted_ratio(df["pre_earliest_issue_commits"].to_numpy(),
+                                        df["num_pre_issues"].to_numpy(), w),
+    "post_commits_per_post_issue":  lambda df, w: _weighted_ratio((df["total_commits"] - df["pre_earliest_issue_commits"]).to_numpy(),
+                                        df["num_post_issues"].to_numpy(), w),
+}
+
+
+def load_sampling_settings(settings):
+    sampling_settings = dict(DEFAULT_SAMPLING_SETTINGS, **(settings.get('sampling') or {}))
+    if sampling_settings['stratify-by'] not in STRATIFY_BY:
+        raise ValueError(f"Invalid 'stratify-by' <{sampling_settings['stratify-by']}>, expected one of <{', '.join(STRATIFY_BY)}>")
+    return sampling_settings
+
+
+def load_strata(settings, repos, stratify_by, num_strata):
+    """
+        Returns a dict with the stratum of each (non-skipped) repository, based on the quantiles of stratify_by.
+        Repositories of which stratify_by is unknown form a stratum of their own (-1).
+    """
+    if stratify_by == "total_commits":
+        values = load_commit_counts(settings.get('results-clone-info-output-file'))
+    else:
+        values = {name: repo.get(stratify_by) for name, repo in repos.items()}
+
+    repo_names = sorted(name for name, repo in repos.items() if not repo.get('skipped'))
+    known = pd.Series({name: values[name] for name in repo_names if values.get(name) is not None}, dtype="float64")
+    strata = dict.fromkeys(repo_names, -1)
+    if len(known) > 0:
+        strata.update(pd.qcut(known.rank(method="first"), min(num_strata, len(known)), labels=False).astype(int).to_dict())
+    return strata
+
+
+def rank_commits(repo_path, earliest_todo_issue, seed):
+    """
+        Walks all commits of a repository. Returns the total number of commits, the number of commits before
+        the earliest todo issue, and the pre-bot commits that can be scanned (ordered on their rank)
+    """
+    r = Repository(repo_path)
+    total_commits = 0
+    pre_commits = 0
+    scannable_commits = []
+    for commit in r.walk(r.head.target, GIT_SORT_TIME):
+        total_commits += 1
+        if earliest_todo_issue is not None and commit.commit_time < earliest_todo_issue:
+            pre_commits += 1
+            if is_pre_bot_commit(commit, earliest_todo_issue):
+                scannable_commits.append(commit.hex)
+    scannable_commits.sort(key=lambda commit: sample_rank(seed, commit))
+    return total_commits, pre_commits, scannable_commits
+
+
+def load_state(filename, sampling_settings, logger):
+    if os.path.isfile(filename):
+        with open(filename, encoding='utf-8') as state_file:
+            state = json.load(state_file)
+        if all(state['settings'].get(key) == sampling_settings[key] for key in SAMPLE_DEFINING_SETTINGS):
+            return state
+        logger.info("The sample was taken with other settings; taking a new sample")
+    return {'settings': {key: sampling_settings[key] for key in SAMPLE_DEFINING_SETTINGS}, 'repos': {}}
+
+
+def save_state(filename, state):
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'w', encoding='utf-8') as state_file:
+        json.dump(state, state_file)
+    os.replace(tmp_filename, filename)
+
+
+def load_post_titles(filename, repo_names):
+    """
+        Returns the titles of the issues that the bot created in each of the given repositories
+    """
+    titles = {repo_name: set() for repo_name in repo_names}
+    for chunk in pd.read_csv(filename, usecols=["repo", "title"], chunksize=CSV_CHUNK_SIZE, **STRING_CSV_OPTIONS):
+        chunk = chunk[chunk["repo"].isin(titles)]
+        for repo_name, title in zip(chunk["repo"], chunk["title"]):
+            titles[repo_name].add(title)
+    return titles
+
+
+def bootstrap(df, weights, metric, num_resamples, confidence, rng):
+    """
+        Returns the percentile confidence interval of a metric, where repositories are resampled within their stratum
+    """
+    strata_rows = [np.flatnonzero(df["stratum"].to_numpy() == stratum) for stratum in df["stratum"].unique()]
+    estimates = []
+    for _ in range(num_resamples):
+        rows = np.concatenate([rng.choice(stratum_rows, len(stratum_rows)) for stratum_rows in strata_rows])
+        estimates.append(metric(df.iloc[rows], weights[rows]))
+    alpha = (1 - confidence) / 2
+    return np.nanquantile(estimates, alpha), np.nanquantile(estimates, 1 - alpha)
+
+
+def run_sampling(ctx, logger):
+    """
+        Estimates the outcomes of the analysis from a stratified random sample of the repositories in the repos file.
+        The repositories are stratified on the quantiles of 'stratify-by', after which the same number of repositories
+        is sampled from each stratum; of each sampled repository only a random sample of its pre-bot commits is scanned.
+        The number of pre-bot issues of a repository is estimated by scaling the (unique) issues found in its sampled commits.
+        Each estimate is weighted by the number of repositories a sampled repository represents, and comes with a
+        bootstrap confidence interval.
+        Samples are deterministic (given 'seed'), so that raising 'repos-per-stratum' or 'commits-per-repo' expands the
+        sample of an earlier run: only the repositories and commits that were not sampled before are processed.
+    """
+    settings = ctx.settings
+    rc_logger = ctx.logger('repo_cloner')
+    pef_logger = ctx.logger('pre_issue_finder')
+    ctx.logger('general')
+
+    sampling_settings = load_sampling_settings(settings)
+    seed = sampling_settings['seed']
+    state_filename = settings.get('results-sample-state-file')
+    state = load_state(state_filename, sampling_settings, logger)
+    sampled = state['repos']
+
+    repos = load_repos(settings.get('results-repos-output-file'))
+    earliest_todo_issues = {repo_name: repo.issues.earliest() for repo_name, repo in repos.items() if repo.issues}
+    strata = load_strata(settings, repos, sampling_settings['stratify-by'], sampling_settings['num-strata'])
+    population = pd.Series(strata).value_counts()
+
+    start_time = datetime.now()
+    logger.info(f"Sampling was started at {start_time}! Sampling {sampling_settings['repos-per-stratum']} of "
+        f"{len(strata)} repositories from each of {len(population)} strata (by {sampling_settings['stratify-by']}).")
+
+    output_path = settings.get('download-output-path-repo')
+    cloner = RepoCloner(settings, rc_logger)
+    sample_pre_filename = settings.get('results-sample-pre-bot-output-file')
+    # The sampled commits are not the cost of a full scan, so they are not recorded in the cost ledger
+    scanner = PreBotIssueScanner(dict(settings, **{'results-todo-comments-pre-bot-output-file': sample_pre_filename,
+        'results-cost-ledger-file': None}), pef_logger)
+
+    # Repositories are taken in the order of their rank; those that cannot be cloned are replaced by the next one
+    commits_per_repo = sampling_settings['commits-per-repo']
+    sample_repo_names = []
+    for stratum in sorted(population.index):
+        stratum_repo_names = sorted((name for name in strata if strata[name] == stratum), key=lambda name: sample_rank(seed, name))
+        num_sampled = 0
+        for repo_name in stratum_repo_names:
+            if num_sampled >= sampling_settings['repos-per-stratum']:
+                break
+            repo_state = sampled.get(repo_name)
+            if repo_state is not None and repo_state['status'] == "failed":
+                continue
+
+            # NB: Clones might have been removed since the repository was sampled (e.g. by a rolling run)
+            repo_path = os.path.join(output_path, repo_name)
+            if not os.path.isdir(repo_path):
+                if not settings.get('skip-cloning'):
+                    # The sample is taken in order, so the retries of a clone are waited for before the next repository is taken
+                    cloner.clone_with_retries(repo_name, repos[repo_name])
+                    cloner.wait_for_retries()
+                if cloner.outcomes.get(repo_name) != "success":
+                    sampled[repo_name] = {'status': "failed"}
+                    continue
+
+            # Count all commits, but only scan those of the sampled pre-bot commits that were not scanned before
+            earliest = earliest_todo_issues.get(repo_name)
+            try:
+                total_commits, pre_commits, scannable_commits = rank_commits(repo_path, earliest, seed)
+            except GitError as e:
+                logger.warning(f"Could not walk the commits of <{repo_name}>; replacing it in the sample! {e}")
+                sampled[repo_name] = {'status': "failed"}
+                continue
+
+            if repo_state is None:
+                repo_state = sampled[repo_name] = {'status': "sampled", 'scanned_commits': [], 'titles': []}
+            repo_state['stratum'] = int(stratum)
+            sample_repo_names.append(repo_name)
+            num_sampled += 1
+
+            sampled_commits = set(scannable_commits[:commits_per_repo] if commits_per_repo is not None else scannable_commits)
+            new_commits = sampled_commits - set(repo_state['scanned_commits'])
+
+            repo_state.update(total_commits=total_commits, pre_commits=pre_commits, scannable_commits=len(scannable_commits),
+                num_post_issues=len(set(repos[repo_name].issues.numbers)))
+            if new_commits:
+                owner, name = repo_name.split('/', 1)
+                scanner.scan_repo(owner, name, repo_path, earliest, only_commits=new_commits)
+                repo_state['scanned_commits'] += sorted(new_commits)
+    scanner.finish()
+
+    # Add the issues that were found in this run to those found before
+    df_pre = pd.read_csv(sample_pre_filename, **STRING_CSV_OPTIONS)
+    for repo_name, title in zip(df_pre["repo"] + "/" + df_pre["owner"], df_pre["title"]):
+        if repo_name in sampled and title not in sampled[repo_name]['titles']:
+            sampled[repo_name]['titles'].append(title)
+    save_state(state_filename, state)
+
+    # Estimate the metrics from the repositories in the current sample (which can be smaller than before)
+    post_titles = load_post_titles(settings.get('results-issues-output-file'), sample_repo_names)
+    rows = []
+    for repo_name in sample_repo_names:
+        repo_state = sampled[repo_name]
+        num_found = len(set(repo_state['titles']) - post_titles[repo_name])
+        num_scanned = len(repo_state['scanned_commits'])
+        rows.append({
+            "repo": repo_name,
+            "stratum": repo_state['stratum'],
+            "total_commits": repo_state['total_commits'],
+            "pre_earliest_issue_commits": repo_state['pre_commits'],
+            "num_pre_issues": num_found * repo_state['scannable_commits'] / num_scanned if num_scanned else num_found,
+            "num_post_issues": repo_state['num_post_issues'],
+        })
+    df = pd.DataFrame(rows, columns=["repo", "stratum", "total_commits", "pre_earliest_issue_commits", "num_pre_issues", "num_post_issues"])
+    if df.empty:
+        msg = "None of the sampled repositories could be processed!"
+        logger.error(msg)
+        raise ValueError(msg)
+
+    sample_sizes = df["stratum"].value_counts()
+    weights = (df["stratum"].map(population) / df["stratum"].map(sample_sizes)).to_numpy()
+    rng = np.random.default_rng(seed)
+    estimates = []
+    for name, metric in METRICS.items():
+        ci_low, ci_high = bootstrap(df, weights, metric, sampling_settings['bootstrap-resamples'], sampling_settings['confidence'], rng)
+        estimates.append([name, metric(df, weights), ci_low, ci_high, len(df), len(strata)])
+        logger.info(f"> {name}: {estimates[-1][1]:.4g} ({sampling_settings['confidence']:.0%} CI: {ci_low:.4g} - {ci_high:.4g})")
+
+    output_filename = settings.get('results-sample-estimates-file')
+    pd.DataFrame(estimates, columns=ESTIMATE_COLUMNS).to_csv(output_filename, index=False)
+
+    end_time = datetime.now()
+    logger.info(f"Sampling was ended at {end_time}, and took {end_time - start_time} h:mm:ss! "
+        f"Estimated {len(estimates)} metrics from {len(df)} repositories, which were output in {output_filename}")
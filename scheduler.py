@@ -0,0 +1,109 @@
+"""Contains the scheduler that decides in which order repositories are cloned and scanned"""
+
+import csv
+import os
+
+from cost_ledger import get_ledger
+from records import load_repos
+
+
+# Rates that are used to estimate costs until the ledger contains enough measurements.
+#   NB: GitHub reports the (estimated) size of a repository in KB
+DEFAULT_CLONE_SECONDS_PER_KB = 0.001
+DEFAULT_SCAN_SECONDS_PER_COMMIT = 0.5
+DEFAULT_SCAN_SECONDS_PER_KB = 0.01
+
+# Orders in which repositories can be processed
+SCHEDULE_ORDERS = ["longest-first", "alphabetical"]
+
+
+def load_estimated_sizes(filename):
+    """
+        Returns a dict with the estimated size (in KB) of each (non-skipped) repository in the repository file
+    """
+    if not filename or not os.path.isfile(filename):
+        return {}
+    return {name: repo.get('estimated_size') for name, repo in load_repos(filename).items() if repo.get('estimated_size') is not None}
+
+
+def load_commit_counts(filename):
+    """
+        Returns a dict with the total number of commits of each repository in the clone information file
+    """
+    if not filename or not os.path.isfile(filename):
+        return {}
+    with open(filename, newline='', encoding='utf-8') as input_file:
+        return {row['repo']: int(row['total_commits']) for row in csv.DictReader(input_file) if row.get('total_commits')}
+
+
+def fit_rate(costs, amounts, default):
+    # Seconds per unit (KB, commit) over all repositories for which both were measured
+    common = [repo_name for repo_name in costs if amounts.get(repo_name)]
+    total_amount = sum(amounts[repo_name] for repo_name in common)
+    if total_amount == 0:
+        return default
+    return sum(costs[repo_name] for repo_name in common) / total_amount
+
+
+class JobScheduler:
+    """
+        Orders repositories on their estimated cost (in seconds), largest first, so that a few huge repositories
+        that happen to come last cannot keep a single worker busy long after all others have finished.
+        Costs that were measured before (in the cost ledger) are used as they are; others are estimated from
+        the number of commits (from the clone information) or the estimated size of a repository.
+        Repositories in 'priority-repos' always come first, in the order in which they are listed.
+    """
+    def __init__(self, settings):
+        scheduler_settings = settings.get('scheduler') or {}
+        self.order = scheduler_settings.get('order', "longest-first")
+        if self.order not in SCHEDULE_ORDERS:
+            raise ValueError(f"Invalid schedule order <{self.order}>, expected one of <{', '.join(SCHEDULE_ORDERS)}>")
+        self.priorities = {repo_name: idx for idx, repo_name in enumerate(scheduler_settings.get('priority-repos') or [])}
+
+        self.sizes = load_estimated_sizes(settings.get('results-repos-output-file'))
+        self.commit_counts = load_commit_counts(settings.get('results-clone-info-output-file'))
+        self.clone_seconds = {}
+        self.scan_seconds = {}
+
+        ledger = get_ledger(settings)
+        if ledger is not None:
+            self.commit_counts.update(ledger.values("total_commits"))
+            self.clone_seconds = ledger.values("clone_seconds")
+            self.scan_seconds = ledger.values("scan_seconds")
+
+        self.clone_seconds_per_kb = fit_rate(self.clone_seconds, self.sizes, DEFAULT_CLONE_SECONDS_PER_KB)
+        self.scan_seconds_per_commit = fit_rate(self.scan_seconds, self.commit_counts, DEFAULT_SCAN_SECONDS_PER_COMMIT)
+        self.scan_seconds_per_kb = fit_rate(self.scan_seconds, self.sizes, DEFAULT_SCAN_SECONDS_PER_KB)
+
+    def clone_cost(self, repo_name, estimated_size=None):
+        if repo_name in self.clone_seconds:
+            return self.clone_seconds[repo_name]
+        if estimated_size is None:
+            estimated_size = self.sizes.get(repo_name, 0)
+        return estimated_size * self.clone_seconds_per_kb
+
+    def scan_cost(self, repo_name, estimated_size=None):
+        if repo_name in self.scan_seconds:
+            return self.scan_seconds[repo_name]
+        if repo_name in self.commit_counts:
+            return self.commit_counts[repo_name] * self.scan_seconds_per_commit
+        if estimated_size is None:
+            estimated_size = self.sizes.get(repo_name, 0)
+        return estimated_size * self.scan_seconds_per_kb
+
+    def sort_key(self, repo_name, job="clone", estimated_size=None):
+        """
+            Key on which repositories are sorted; job is either 'clone' or 'scan'
+        """
+        if repo_name in self.priorities:
+            return (0, self.priorities[repo_name], repo_name)
+        if self.order == "alphabetical":
+            return (1, 0, repo_name)
+        cost = self.clone_cost(repo_name, estimated_size) if job == "clone" else self.scan_cost(repo_name, estimated_size)
+        return (1, -cost, repo_name)
+
+    def schedule(self, items, job="clone", key=lambda item: item):
+        """
+            Returns the items in the order in which they should be processed. key returns the repository name of an item.
+        """
+        return sorted(items, key=lambda item: self.sort_key(key(item), job))
@@ -0,0 +1,111 @@
+"""Contains the shard mode, in which the clone and scan stages are split over multiple processes (or machines)"""
+
+import hashlib
+import os
+import shutil
+
+from cost_ledger import CostLedger
+
+
+# The stages that can run per shard. All other stages should be run without sharding
+SHARDED_STAGES = ["clone_repos", "pre_bot_issues", "cloned_repos"]
+
+# Outputs of which each shard writes its own copy
+SHARDED_OUTPUTS = [
+    'results-todo-comments-pre-bot-output-file',
+    'results-clone-info-output-file',
+    'results-commit-index-output-file',
+    'results-cost-ledger-file',
+    'results-timeouts-file',
+    'results-shared-objects-report-file',
+    'stage-state-file',
+    'metrics-output-file',
+    'metrics-prometheus-output-file',
+]
+
+# Shard outputs that are merged by concatenating their rows (and of which the header is kept once)
+CONCATENATED_OUTPUTS = [
+    'results-todo-comments-pre-bot-output-file',
+    'results-clone-info-output-file',
+    'results-commit-index-output-file',
+    'results-timeouts-file',
+]
+
+
+def shard_of(repo_name, shard_count):
+    # NB: Python's hash() differs between processes, so it cannot be used to partition repositories
+    digest = hashlib.sha1(repo_name.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count
+
+
+def shard_filename(filename, shard_index, shard_count):
+    root, ext = os.path.splitext(filename)
+    return f"{root}.shard-{shard_index}-of-{shard_count}{ext}"
+
+
+def apply_shard(settings, shard_index, shard_count):
+    """
+        Returns a copy of the settings of a single shard, in which each sharded output has its own filename
+    """
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"Invalid shard index {shard_index}, expected 0 <= index < {shard_count}")
+
+    shard_settings = dict(settings)
+    shard_settings['shard-index'] = shard_index
+    shard_settings['shard-count'] = shard_count
+    for key in SHARDED_OUTPUTS:
+        if settings.get(key):
+            shard_settings[key] = shard_filename(settings.get(key), shard_index, shard_count)
+    return shard_settings
+
+
+def select_shard(items, settings, key=lambda item: item):
+    """
+        Returns the items (of which key returns the repository name) that belong to the shard of the settings.
+        All items are returned if the settings are not sharded.
+    """
+    shard_count = settings.get('shard-count')
+    if not shard_count:
+        return list(items)
+    shard_index = settings.get('shard-index')
+    return [item for item in items if shard_of(key(item), shard_count) == shard_index]
+
+
+def merge_shards(settings, shard_count, logger):
+    """
+        Combines the outputs of all shards into the standard outputs
+    """
+    shard_filenames = {key: [shard_filename(settings.get(key), shard_index, shard_count) for shard_index in range(shard_count)]
+        for key in CONCATENATED_OUTPUTS + ['results-cost-ledger-file'] if settings.get(key)}
+
+    missing_filenames = [filename for key in ['results-todo-comments-pre-bot-output-file', 'results-clone-info-output-file']
+        for filename in shard_filenames[key] if not os.path.isfile(filename)]
+    if missing_filenames:
+        raise ValueError(f"Not all shards have finished; missing {', '.join(missing_filenames)}")
+
+    for key in CONCATENATED_OUTPUTS:
+        if key not in shard_filenames:
+            continue
+        output_filename = settings.get(key)
+        with open(output_filename, 'w', newline='', encoding='utf-8') as output_file:
+            has_header = False
+            for filename in shard_filenames[key]:
+                if not os.path.isfile(filename):
+                    continue
+                with open(filename, newline='', encoding='utf-8') as shard_file:
+                    header = shard_file.readline()
+                    if not has_header:
+                        output_file.write(header)
+                        has_header = True
+                    # NB: Rows are copied as they are, as the bodies of pre-bot issues can span multiple lines
+                    shutil.copyfileobj(shard_file, output_file)
+        logger.info(f"Merged the outputs of all shards into {output_filename}")
+
+    if 'results-cost-ledger-file' in shard_filenames:
+        ledger = CostLedger(settings.get('results-cost-ledger-file'))
+        for filename in shard_filenames['results-cost-ledger-file']:
+            if os.path.isfile(filename):
+                ledger.merge(CostLedger(filename))
+        ledger.save()
+        logger.info(f"Merged the cost ledgers of all shards into {ledger.filename}")
+
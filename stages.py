@@ -0,0 +1,264 @@
+"""Contains the stage graph of the pipeline, which only reruns stages of which something upstream changed"""
+
+import hashlib
+import json
+import os
+from functools import cached_property
+
+from github import Github
+
+import metrics
+import util
+import pre_bot_issue_finder
+import repo_analyser_v2
+from bot_issue_finder import find_issues
+from repo_finder import find_repos
+from repo_cloner import clone_repos
+
+
+# Maps the names of the loggers (as used in the settings) to the names they are created with
+LOGGER_NAMES = {
+    "general":          "bot_issue_finder",
+    "issue_finder":     "issue_finder",
+    "repo_finder":      "repo_finder",
+    "repo_cloner":      "repo_cloner",
+    "pre_issue_finder": "pre_issue_finder",
+}
+
+# Size of the blocks in which files are hashed
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class Stage:
+    """
+        A single stage of the pipeline.
+        inputs and outputs are the settings that contain the paths of the files/folders that the stage reads and writes.
+        setting_keys are the (other) settings that affect the outputs of the stage.
+    """
+    def __init__(self, name, run, inputs=(), outputs=(), setting_keys=()):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.setting_keys = list(setting_keys)
+
+
+class StageContext:
+    """
+        Everything a stage might need to run. The GitHub connection and loggers are only created when needed.
+    """
+    def __init__(self, settings, login_settings):
+        self.settings = settings
+        self.login_settings = login_settings
+        self._loggers = {}
+
+    @cached_property
+    def github(self):
+        return Github(per_page=100, **self.login_settings)
+
+    def logger(self, name):
+        if name not in self._loggers:
+            self._loggers[name] = util.create_logger(LOGGER_NAMES[name],
+                self.settings.get('loglevels').get(name), self.settings.get('logoutputs').get(name))
+        util.g_logger = self._loggers[name]
+        return self._loggers[name]
+
+
+def _run_find_issues(ctx):
+    find_issues(ctx.github, ctx.settings, ctx.logger('issue_finder'))
+
+def _run_find_repos(ctx):
+    logger = ctx.logger('repo_finder')
+    was_error = find_repos(ctx.github, ctx.settings, logger)
+    if was_error:
+        msg = "An error occurred while fetching repositories!"
+        logger.error(msg)
+        raise ValueError(msg)
+
+def _run_clone_repos(ctx):
+    logger = ctx.logger('repo_cloner')
+    if ctx.settings.get('skip-cloning'):
+        logger.info("Cloning is skipped as per the settings")
+    else:
+        clone_repos(ctx.settings, logger)
+
+def _run_pre_bot_issues(ctx):
+    pre_bot_issue_finder.find_pre_bot_issues(ctx.settings, ctx.logger('pre_issue_finder'))
+    pre_bot_issue_finder.remove_pre_duplicates(ctx.settings, ctx.logger('general'))
+
+def _run_cloned_repos(ctx):
+    pre_bot_issue_finder.obtain_cloned_repos(ctx.settings, ctx.logger('general'))
+
+def _run_pre_post_data(ctx):
+    pre_bot_issue_finder.obtain_pre_post_data(ctx.settings, ctx.logger('general'))
+
+def _run_analysis(ctx):
+    if ctx.settings.get('analysis-figures'):
+        repo_analyser_v2.run_analysis(ctx.settings, ctx.logger('general'), ctx.settings.get('analysis-figures'),
+            max_workers=ctx.settings.get('analysis-workers'))
+
+
+# All stages of the pipeline, in the order in which they should run
+STAGES = [
+    Stage("find_issues", _run_find_issues,
+        outputs=['results-issues-output-file', 'results-issue-bodies-file', 'results-issue-bodies-index-file'],
+        setting_keys=['issue-body-encoding', 'bot-name', 'ignore-private-repos', 'ignore-archived-repos', 'type', 'state', 'language',
+            'start-date', 'end-date', 'additional-issue-query', 'max-results']),
+    Stage("find_repos", _run_find_repos,
+        inputs=['results-issues-output-file'],
+        outputs=['results-repos-output-file'],
+        setting_keys=['min-stars', 'min-forks', 'min-watchers', 'ignore-forks', 'ignore-private-repos', 'ignore-archived-repos']),
+    Stage("clone_repos", _run_clone_repos,
+        inputs=['results-repos-output-file'],
+        outputs=['download-output-path-repo'],
+        setting_keys=['skip-cloning', 'share-fork-objects']),
+    Stage("pre_bot_issues", _run_pre_bot_issues,
+        inputs=['results-repos-output-file', 'results-issues-output-file', 'download-output-path-repo'],
+        outputs=['results-todo-comments-pre-bot-output-file'],
+        setting_keys=['modified-todo-bot-install-path', 'todo-bot-command', 'max-diff-file-size', 'pre-bot-prefilter']),
+    Stage("cloned_repos", _run_cloned_repos,
+        inputs=['results-repos-output-file', 'download-output-path-repo'],
+        outputs=['results-clone-info-output-file', 'results-commit-index-output-file']),
+    Stage("pre_post_data", _run_pre_post_data,
+        inputs=['results-todo-comments-pre-bot-output-file', 'results-issues-output-file',
+            'results-repos-output-file', 'results-clone-info-output-file'],
+        outputs=['results-merged-output-file']),
+    Stage("analysis", _run_analysis,
+        inputs=['results-merged-output-file', 'results-issues-output-file', 'results-todo-comments-pre-bot-output-file'],
+        setting_keys=['analysis-figures']),
+]
+
+STAGES_BY_NAME = {stage.name: stage for stage in STAGES}
+
+
+def _hash_path(path):
+    """
+        Returns a hash of a file's contents, or of the (owner/repo) folders of a clone folder.
+        Hashing every clone would take hours, so the modification times of the repositories are used instead.
+    """
+    h = hashlib.sha256()
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                h.update(block)
+    elif os.path.isdir(path):
+        for owner in sorted(entry.name for entry in os.scandir(path) if entry.is_dir()):
+            for repo in sorted(entry.name for entry in os.scandir(os.path.join(path, owner)) if entry.is_dir()):
+                repo_path = os.path.join(path, owner, repo)
+                git_path = os.path.join(repo_path, '.git')
+                mtime = os.stat(git_path if os.path.isdir(git_path) else repo_path).st_mtime_ns
+                h.update(f"{owner}/{repo}:{mtime}\n".encode('utf-8'))
+    else:
+        return None
+    return h.hexdigest()
+
+
+def _outputs_exist(stage, settings):
+    return all(os.path.exists(settings.get(output)) for output in stage.outputs)
+
+
+def stage_fingerprint(stage, settings):
+    """
+        Fingerprint of everything that affects the outputs of a stage: its settings and the contents of its inputs
+    """
+    fingerprint = {
+        "settings": {key: settings.get(key) for key in stage.setting_keys + stage.inputs + stage.outputs},
+        "inputs": {key: _hash_path(settings.get(key)) for key in stage.inputs},
+    }
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def required_stages(target):
+    """
+        Returns the target stage and all stages it (indirectly) depends on, in the order in which they should run
+    """
+    producers = {output: stage for stage in STAGES for output in stage.outputs}
+    required = set()
+    to_visit = [STAGES_BY_NAME[target]]
+    while to_visit:
+        stage = to_visit.pop()
+        if stage.name not in required:
+            required.add(stage.name)
+            to_visit.extend(producers[i] for i in stage.inputs if i in producers and producers[i] is not stage)
+    return [stage for stage in STAGES if stage.name in required]
+
+
+def pending_stages(settings, target, force=False):
+    """
+        Returns the names of the stages that run_stages would run for the target.
+        The stages that depend on a stage that runs are assumed to run as well, as their inputs will change.
+    """
+    state = load_stage_state(settings.get('stage-state-file'))
+    producers = {output: stage.name for stage in STAGES for output in stage.outputs}
+    pending = []
+    for stage in required_stages(target):
+        recorded_fingerprint = state.get(stage.name)
+        if (force and stage.name == target) or not _outputs_exist(stage, settings) \
+                or any(producers.get(i) in pending for i in stage.inputs) \
+                or (recorded_fingerprint is not None and recorded_fingerprint != stage_fingerprint(stage, settings)) \
+                or (recorded_fingerprint is None and not stage.outputs):
+            pending.append(stage.name)
+    return pending
+
+
+def load_stage_state(filename):
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, encoding='utf-8') as state_file:
+        return json.load(state_file)
+
+
+def save_stage_state(filename, state):
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    with open(filename, 'w', encoding='utf-8') as state_file:
+        json.dump(state, state_file, indent=4)
+
+
+def mark_stages_up_to_date(settings, stage_names):
+    """
+        Records the current fingerprints of stages whose outputs were produced outside of run_stages
+    """
+    state_filename = settings.get('stage-state-file')
+    state = load_stage_state(state_filename)
+    for name in stage_names:
+        state[name] = stage_fingerprint(STAGES_BY_NAME[name], settings)
+    save_stage_state(state_filename, state)
+
+
+def run_stages(ctx, target, logger, force=False, allowed_stages=None):
+    """
+        Runs the target stage and its prerequisites, skipping all stages that are up to date.
+        A stage is up to date if its outputs exist, and neither its settings nor its inputs changed since it last ran.
+        Outputs that were created before stage fingerprints were recorded are adopted as being up to date.
+        If allowed_stages is given, other stages are never run; their outputs should already exist.
+    """
+    settings = ctx.settings
+    state_filename = settings.get('stage-state-file')
+    state = load_stage_state(state_filename)
+
+    for stage in required_stages(target):
+        fingerprint = stage_fingerprint(stage, settings)
+        recorded_fingerprint = state.get(stage.name)
+        is_forced = force and stage.name == target
+
+        if not is_forced and _outputs_exist(stage, settings):
+            if recorded_fingerprint == fingerprint:
+                logger.info(f"Stage <{stage.name}> is up to date; skipping it!")
+                continue
+            if recorded_fingerprint is None and stage.outputs:
+                logger.info(f"Found existing outputs of stage <{stage.name}>; using those instead!")
+                state[stage.name] = fingerprint
+                save_stage_state(state_filename, state)
+                continue
+
+        if allowed_stages is not None and stage.name not in allowed_stages:
+            msg = f"Stage <{stage.name}> is not up to date, and should be run first (without sharding)!"
+            logger.error(msg)
+            raise ValueError(msg)
+
+        logger.info(f"Running stage <{stage.name}>...")
+        with metrics.registry.timer("stage_duration_seconds", stage=stage.name), metrics.profile_stage(stage.name, settings, logger):
+            stage.run(ctx)
+
+        state[stage.name] = fingerprint
+        save_stage_state(state_filename, state)
@@ -0,0 +1,252 @@
+"""Contains the generator of synthetic corpora: local repositories (with a matching repository file) to benchmark the history stages on"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+from datetime import datetime, timedelta, timezone
+
+from pygit2 import GIT_FILEMODE_BLOB, GIT_FILEMODE_TREE, Signature, clone_repository, init_repository
+
+
+# Settings of a corpus; the corpus is determined by these completely
+DEFAULT_CORPUS_SETTINGS = {
+    # Number of repositories (including the forks)
+    "num-repos": 10,
+    # Number of commits of each repository (including merges)
+    "commits-per-repo": 200,
+    # Probability that a branch (of 'branch-length' commits) is started, and later merged, at a commit
+    "branch-probability": 0.1,
+    "branch-length": 5,
+    # Number of files that each commit changes, and the (approximate) size in bytes of each file
+    "files-per-commit": 2,
+    "file-size": 4096,
+    # Number of lines that each change of a file adds
+    "lines-per-change": 10,
+    # Share of the added lines that are TODO-comments
+    "todo-density": 0.05,
+    # Share of the repositories that are forks of another repository, and the share of its history that a fork shares
+    "fork-share": 0.2,
+    "fork-overlap": 0.5,
+    # Share of the commits of a repository that were made before the first todo[bot] issue
+    "pre-bot-share": 0.8,
+    "seed": 0,
+}
+
+# File in the corpus folder that contains the settings it was generated with
+MANIFEST_FILENAME = "corpus.json"
+
+# Time of the first commit of each repository, and the time between its commits
+START_TIME = datetime(2016, 1, 1, tzinfo=timezone.utc)
+COMMIT_INTERVAL = timedelta(hours=6)
+
+# Number of folders the files of a repository are spread over
+NUM_FOLDERS = 4
+
+# Words the (JavaScript) lines of the files are made of
+WORDS = ["value", "result", "count", "items", "config", "handler", "request", "cache", "index", "offset", "buffer", "state"]
+
+
+def _signature(rng, commit_time):
+    author = f"dev-{rng.randrange(5)}"
+    return Signature(author, f"{author}@example.com", int(commit_time.timestamp()), 0)
+
+
+def _line(rng, todo_density):
+    if rng.random() < todo_density:
+        return f"  // TODO: {rng.choice(WORDS)} {rng.choice(WORDS)} should be handled ({rng.randrange(10 ** 6)})\n"
+    return f"  const {rng.choice(WORDS)}{rng.randrange(1000)} = {rng.choice(WORDS)}({rng.randrange(10 ** 6)});\n"
+
+
+def _write_tree(repo, files):
+    """
+        Returns the id of the tree that contains the given files (a dict of path -> lines), of which the paths
+        contain a single folder
+    """
+    folders = {}
+    for path, lines in files.items():
+        folder, filename = path.split("/")
+        folders.setdefault(folder, {})[filename] = repo.create_blob("".join(lines).encode("utf-8"))
+
+    root = repo.TreeBuilder()
+    for folder, blobs in sorted(folders.items()):
+        tree = repo.TreeBuilder()
+        for filename, blob_id in sorted(blobs.items()):
+            tree.insert(filename, blob_id, GIT_FILEMODE_BLOB)
+        root.insert(folder, tree.write(), GIT_FILEMODE_TREE)
+    return root.write()
+
+
+def _is_branch_file(path, prefix):
+    return path.split("/")[1].startswith(prefix + "-")
+
+
+def _change_files(rng, files, corpus_settings, prefix):
+    """
+        Changes 'files-per-commit' (new or existing) files in place: lines are added to each, and old lines are
+        dropped once a file exceeds 'file-size'. New files of a branch are named after the branch (prefix),
+        so that branches never change the same file as the main line they are merged into.
+    """
+    for _ in range(corpus_settings["files-per-commit"]):
+        paths = list(files) if prefix == "main" else [path for path in files if _is_branch_file(path, prefix)]
+        if not paths or rng.random() < 0.1:
+            path = f"src{rng.randrange(NUM_FOLDERS)}/{prefix}-{rng.randrange(10 ** 6)}.js"
+            files.setdefault(path, [])
+        else:
+            path = rng.choice(paths)
+        lines = files[path]
+        position = rng.randint(0, len(lines))
+        lines[position:position] = [_line(rng, corpus_settings["todo-density"]) for _ in range(corpus_settings["lines-per-change"])]
+        while sum(len(line) for line in lines) > corpus_settings["file-size"] and len(lines) > corpus_settings["lines-per-change"]:
+            del lines[rng.randrange(len(lines))]
+
+
+def _generate_history(repo, rng, corpus_settings, files, head, commit_time, num_commits):
+    """
+        Adds (about) num_commits commits to the main line of the repository, after commit head (or as its first commits)
+        at commit_time. Returns the times of the commits of the main line.
+    """
+    main_line_times = []
+    while num_commits > 0:
+        if head is not None and num_commits > corpus_settings["branch-length"] + 1 \
+                and rng.random() < corpus_settings["branch-probability"]:
+            # Branch off, commit to both the branch and the main line, and merge the branch
+            branch_files = {path: list(lines) for path, lines in files.items()}
+            branch_head = head
+            prefix = f"branch{rng.randrange(10 ** 6)}"
+            for _ in range(corpus_settings["branch-length"]):
+                commit_time += COMMIT_INTERVAL
+                _change_files(rng, branch_files, corpus_settings, prefix)
+                signature = _signature(rng, commit_time)
+                branch_head = repo.create_commit(None, signature, signature, f"Work on {prefix}",
+                    _write_tree(repo, branch_files), [branch_head])
+
+            commit_time += COMMIT_INTERVAL
+            _change_files(rng, files, corpus_settings, "main")
+            signature = _signature(rng, commit_time)
+            head = repo.create_commit("HEAD", signature, signature, "Work on main", _write_tree(repo, files), [head])
+
+            commit_time += COMMIT_INTERVAL
+            files.update({path: lines for path, lines in branch_files.items() if _is_branch_file(path, prefix)})
+            signature = _signature(rng, commit_time)
+            head = repo.create_commit("HEAD", signature, signature, f"Merge {prefix}", _write_tree(repo, files), [head, branch_head])
+            main_line_times += [commit_time - COMMIT_INTERVAL, commit_time]
+            num_commits -= corpus_settings["branch-length"] + 2
+        else:
+            commit_time += COMMIT_INTERVAL
+            _change_files(rng, files, corpus_settings, "main")
+            signature = _signature(rng, commit_time)
+            head = repo.create_commit("HEAD", signature, signature, "Work on main", _write_tree(repo, files),
+                [] if head is None else [head])
+            main_line_times.append(commit_time)
+            num_commits -= 1
+    return main_line_times
+
+
+def _main_line(commit):
+    # The commits of the main line (following the first parent of each merge), from the first commit to the given one
+    line = [commit]
+    while line[-1].parents:
+        line.append(line[-1].parents[0])
+    return line[::-1]
+
+
+def _load_files(repo, commit):
+    files = {}
+    for folder in commit.tree:
+        for blob in repo[folder.id]:
+            files[f"{folder.name}/{blob.name}"] = repo[blob.id].data.decode("utf-8").splitlines(keepends=True)
+    return files
+
+
+def _repo_info(main_line_times, corpus_settings, rng, source=None):
+    # The first todo[bot] issues are created after 'pre-bot-share' of the commits of the main line
+    earliest = main_line_times[min(int(len(main_line_times) * corpus_settings["pre-bot-share"]), len(main_line_times) - 1)]
+    issues = [{
+        'number': number + 1,
+        'created_at': (earliest + timedelta(days=number)).strftime("%Y-%m-%d %H:%M:%S"),
+        'state': rng.choice(["open", "closed"]),
+    } for number in range(rng.randint(1, 3))]
+    return {
+        'issues': issues,
+        'stars': rng.randrange(1000),
+        'forks': rng.randrange(100),
+        'watchers': rng.randrange(100),
+        'is_fork': source is not None,
+        'source': source,
+        'default_branch': "master",
+        'is_private': False,
+        'is_archived': False,
+        'estimated_size': None,
+        'created_at': START_TIME.replace(tzinfo=None).isoformat(),
+        'updated_at': main_line_times[-1].replace(tzinfo=None).isoformat(),
+        'clone_url': None,
+        'skipped': False,
+        'error': None,
+    }
+
+
+def generate_corpus(path, corpus_settings, logger):
+    """
+        Generates the repositories of a corpus in path/repos (in the same layout as 'download-output-path-repo'),
+        and their repository file in path/repo-results.json. A corpus that was generated with the same settings
+        before is reused. Returns the (full) settings of the corpus.
+    """
+    corpus_settings = dict(DEFAULT_CORPUS_SETTINGS, **corpus_settings)
+    repos_path = os.path.join(path, "repos")
+    manifest_filename = os.path.join(path, MANIFEST_FILENAME)
+    if os.path.isfile(manifest_filename):
+        with open(manifest_filename, encoding='utf-8') as manifest_file:
+            if json.load(manifest_file) == corpus_settings:
+                logger.info(f"Reusing the corpus in {path}")
+                return corpus_settings
+    shutil.rmtree(repos_path, ignore_errors=True)
+
+    repos = {}
+    rng = random.Random(corpus_settings["seed"])
+    num_forks = int(corpus_settings["num-repos"] * corpus_settings["fork-share"])
+    num_sources = corpus_settings["num-repos"] - num_forks
+    for idx in range(corpus_settings["num-repos"]):
+        repo_rng = random.Random(f"{corpus_settings['seed']}:{idx}")
+        if idx < num_sources:
+            repo_name = f"owner{idx}/repo{idx}"
+            repo = init_repository(os.path.join(repos_path, repo_name))
+            main_line_times = _generate_history(repo, repo_rng, corpus_settings, {}, None, START_TIME,
+                corpus_settings["commits-per-repo"])
+            repos[repo_name] = _repo_info(main_line_times, corpus_settings, repo_rng)
+        else:
+            # A fork shares the first part of the history of its source (so the same commits), and then diverges
+            source_name = list(repos)[rng.randrange(num_sources)]
+            repo_name = f"owner{idx}/{source_name.split('/')[1]}"
+            repo = clone_repository(os.path.join(repos_path, source_name), os.path.join(repos_path, repo_name))
+            source_line = _main_line(repo[repo.head.target])
+            shared_line = source_line[:max(int(len(source_line) * corpus_settings["fork-overlap"]), 1)]
+            fork_point = shared_line[-1]
+            repo.head.set_target(fork_point.id)
+
+            shared_times = [datetime.fromtimestamp(commit.commit_time, timezone.utc) for commit in shared_line]
+            main_line_times = shared_times + _generate_history(repo, repo_rng, corpus_settings, _load_files(repo, fork_point),
+                fork_point.id, shared_times[-1], corpus_settings["commits-per-repo"] - len(shared_times))
+            repos[repo_name] = _repo_info(main_line_times, corpus_settings, repo_rng, source=source_name)
+        logger.debug(f"Generated <{repo_name}>")
+
+    with open(os.path.join(path, "repo-results.json"), 'w', encoding='utf-8') as output_file:
+        output_file.write(json.dumps(repos))
+    with open(manifest_filename, 'w', encoding='utf-8') as manifest_file:
+        json.dump(corpus_settings, manifest_file)
+    logger.info(f"Generated a corpus of {len(repos)} repositories ({num_forks} forks) in {path}")
+    return corpus_settings
+
+
+if __name__ == "__main__":
+    import util
+
+    parser = argparse.ArgumentParser(description="Generates a synthetic corpus of local repositories, and their repository file")
+    parser.add_argument('path', help="Folder in which the corpus is generated")
+    for key, value in DEFAULT_CORPUS_SETTINGS.items():
+        parser.add_argument(f'--{key}', type=type(value), default=value)
+    args = parser.parse_args()
+
+    generate_corpus(args.path, {key: getattr(args, key.replace('-', '_')) for key in DEFAULT_CORPUS_SETTINGS},
+        util.create_logger("synthetic_corpus", "INFO"))
@@ -0,0 +1,19 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cost_ledger import CostLedger
+
+
+def test_update_accumulates_the_costs_of_partial_scans(tmp_path):
+    ledger = CostLedger(str(tmp_path / "ledger.csv"))
+    ledger.update("owner/repo", pre_bot_commits_scanned=100, scan_seconds=60.0, detector_invocations=80)
+    ledger.update("owner/repo", accumulate=True, pre_bot_commits_scanned=20, scan_seconds=15.0, detector_invocations=10)
+    assert ledger.get("owner/repo", "pre_bot_commits_scanned") == 120
+    assert ledger.get("owner/repo", "scan_seconds") == 75.0
+    assert ledger.get("owner/repo", "detector_invocations") == 90
+
+    # A full scan replaces the costs recorded before
+    ledger.update("owner/repo", pre_bot_commits_scanned=110, scan_seconds=70.0, detector_invocations=85)
+    assert ledger.get("owner/repo", "pre_bot_commits_scanned") == 110
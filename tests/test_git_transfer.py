@@ -0,0 +1,34 @@
+import os
+import socket
+import sys
+import time
+
+import pytest
+from pygit2 import Signature, init_repository
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from git_transfer import run_transfer
+from timeouts import JobTimeout
+
+
+def test_run_transfer_clones_a_repository(tmp_path):
+    source = init_repository(str(tmp_path / "source"))
+    signature = Signature("dev", "dev@example.com")
+    source.create_commit("HEAD", signature, signature, "Initial commit", source.TreeBuilder().write(), [])
+
+    run_transfer(["clone", str(tmp_path / "source"), str(tmp_path / "clone")], 60)
+    assert os.path.isdir(tmp_path / "clone" / ".git")
+
+
+def test_run_transfer_kills_a_stalled_clone(tmp_path):
+    # A server that accepts the connection, but never responds
+    with socket.socket() as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        url = f"http://127.0.0.1:{server.getsockname()[1]}/owner/repo.git"
+
+        start_time = time.monotonic()
+        with pytest.raises(JobTimeout):
+            run_transfer(["clone", url, str(tmp_path / "clone")], 2)
+        assert time.monotonic() - start_time < 30
@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pipeline
+
+
+class _Context:
+    def __init__(self, settings):
+        self.settings = settings
+        self.github = None
+
+    def logger(self, name):
+        return logging.getLogger(name)
+
+
+class _Cloner:
+    def __init__(self, settings, logger, object_store=None):
+        pass
+
+    def clone_with_retries(self, repo_name, repo, on_retry_success=None, on_retry_failure=None):
+        return "success"
+
+    def wait_for_retries(self, before_retry=None):
+        pass
+
+
+class _Scanner:
+    scanned = []
+
+    def __init__(self, settings, logger):
+        pass
+
+    def scan_repo(self, owner, name, repo_path, earliest):
+        _Scanner.scanned.append(f"{owner}/{name}")
+
+    def retry_timeouts(self, output_path, earliest_todo_issues):
+        pass
+
+    def finish(self):
+        pass
+
+
+def test_pipelined_run_with_small_queues_does_not_deadlock(tmp_path, monkeypatch):
+    # A single creation window yields many more new repositories than the queues can hold
+    repo_names = [f"owner{idx}/repo{idx}" for idx in range(30)]
+
+    def find_issues(github, settings, logger, on_issue=None, on_window_done=None):
+        for number, repo_name in enumerate(repo_names, start=1):
+            on_issue([repo_name, number, "Handle the offset", "open", "issue", "2018-06-30 04:04:55",
+                "2018-06-30 04:04:55", None, 0])
+        on_window_done()
+
+    monkeypatch.setattr(pipeline, "find_issues", find_issues)
+    monkeypatch.setattr(pipeline, "fetch_repo_info", lambda github, repo_name, settings, logger: ({'skipped': False}, "fetched"))
+    monkeypatch.setattr(pipeline, "RepoCloner", _Cloner)
+    monkeypatch.setattr(pipeline, "PreBotIssueScanner", _Scanner)
+    monkeypatch.setattr(pipeline, "remove_pre_duplicates", lambda settings, logger: None)
+    _Scanner.scanned = []
+
+    settings = {
+        'pipeline-queue-size': 2,
+        'pipeline-clone-workers': 1,
+        'download-output-path-repo': str(tmp_path / "repos"),
+        'results-repos-output-file': str(tmp_path / "repo-results.json"),
+        'results-clone-info-output-file': str(tmp_path / "clone_info.csv"),
+        'results-cost-ledger-file': None,
+        'share-fork-objects': False,
+    }
+    run = threading.Thread(target=pipeline.run_pipelined, args=(_Context(settings), logging.getLogger("general")), daemon=True)
+    run.start()
+    run.join(timeout=30)
+
+    assert not run.is_alive(), "the pipelined run deadlocked"
+    assert sorted(_Scanner.scanned) == sorted(repo_names)
+
+
+class _RetryTimeouts:
+    def __init__(self):
+        self.retries = {}
+
+    def take_retries(self, job):
+        return self.retries.pop(job, [])
+
+
+class _TimingOutScanner:
+    events = []
+
+    def __init__(self, settings, logger):
+        self.timeouts = _RetryTimeouts()
+
+    def scan_repo(self, owner, name, repo_path, earliest, resume_after=None):
+        _TimingOutScanner.events.append(("scan", f"{owner}/{name}", os.path.isdir(repo_path), resume_after))
+        if resume_after is None:
+            self.timeouts.retries["repo_scan"] = [(f"{owner}/{name}", "abc123")]
+
+    def retry_timeouts(self, output_path, earliest_todo_issues):
+        for repo_name, last_commit in self.timeouts.take_retries("repo_scan"):
+            owner, name = repo_name.split('/', 1)
+            self.scan_repo(owner, name, os.path.join(output_path, owner, name), earliest_todo_issues[repo_name],
+                resume_after=last_commit)
+
+    def finish(self):
+        pass
+
+
+class _RollingCloner:
+    # The first attempt of owner1/repo1 fails for a transient reason, after which its retry succeeds
+    def __init__(self, settings, logger, object_store=None):
+        self.output_path = settings.get('download-output-path-repo')
+        self.retries = []
+
+    def clone_with_retries(self, repo_name, repo, on_retry_success=None, on_retry_failure=None):
+        if repo_name == "owner1/repo1":
+            self.retries.append((repo_name, on_retry_success))
+            return "transient"
+        os.makedirs(os.path.join(self.output_path, repo_name, ".git"))
+        return "success"
+
+    def wait_for_retries(self, before_retry=None):
+        for repo_name, on_retry_success in self.retries:
+            os.makedirs(os.path.join(self.output_path, repo_name, ".git"))
+            on_retry_success()
+
+
+def test_rolling_run_retries_timed_out_scans_before_removing_clones(tmp_path, monkeypatch):
+    repos = {f"owner{idx}/repo{idx}": {'skipped': False, 'estimated_size': 1, 'error': None,
+        'issues': [{'number': "1", 'created_at': "2018-06-30 04:04:55", 'state': "open"}]} for idx in range(3)}
+    with open(tmp_path / "repo-results.json", "w", encoding="utf-8") as repos_file:
+        json.dump(repos, repos_file)
+
+    monkeypatch.setattr(pipeline, "RepoCloner", _RollingCloner)
+    monkeypatch.setattr(pipeline, "PreBotIssueScanner", _TimingOutScanner)
+    monkeypatch.setattr(pipeline, "count_commits", lambda repo_name, repo_path, earliest, ledger, commit_index: [repo_name, True, 1, earliest, 1])
+    monkeypatch.setattr(pipeline, "remove_pre_duplicates", lambda settings, logger: None)
+    _TimingOutScanner.events = []
+
+    settings = {
+        'pipeline-clone-workers': 1,
+        'disk-budget-mb': 1,
+        'download-output-path-repo': str(tmp_path / "repos"),
+        'results-repos-output-file': str(tmp_path / "repo-results.json"),
+        'results-clone-info-output-file': str(tmp_path / "clone_info.csv"),
+        'results-commit-index-output-file': str(tmp_path / "commit_index.csv"),
+        'results-cost-ledger-file': None,
+    }
+    pipeline.run_rolling(_Context(settings), logging.getLogger("general"))
+
+    for repo_name in repos:
+        assert ("scan", repo_name, True, None) in _TimingOutScanner.events
+        assert ("scan", repo_name, True, "abc123") in _TimingOutScanner.events
+    assert not os.path.isdir(tmp_path / "repos" / "owner0" / "repo0")
@@ -0,0 +1,86 @@
+import csv
+import logging
+import os
+import sys
+from datetime import datetime, timezone
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pre_bot_issue_finder
+from pre_bot_issue_finder import (PRE_BOT_CSV_COLUMNS, PreBotIssueScanner, _count_issues_per_repo, filter_pre_bot_issues,
+    remove_pre_duplicates)
+
+
+def _epoch(value):
+    return int(datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp())
+
+
+def test_filter_pre_bot_issues_compares_iso_commit_dates(tmp_path):
+    # Rows as the modified todo[bot] appends them: owner, repository, the commit date it was passed (-e), title and body
+    input_filename = tmp_path / "issues_pre_bot.csv"
+    with open(input_filename, "w", newline="", encoding="utf-8") as input_file:
+        csv_writer = csv.writer(input_file)
+        csv_writer.writerow(PRE_BOT_CSV_COLUMNS)
+        csv_writer.writerow(["owner", "repo", "2016-01-01T18:00:00", "Handle the offset", "## Handle the offset\n\nIn src/a.js"])
+        csv_writer.writerow(["owner", "repo", "2016-03-01T18:00:00", "Handle the cache", "## Handle the cache\n\nIn src/b.js"])
+        csv_writer.writerow(["other", "repo", "2016-01-01T18:00:00", "Handle the index", "## Handle the index\n\nIn src/c.js"])
+
+    output_filename = tmp_path / "issues_pre_bot.filtered.csv"
+    filter_pre_bot_issues(input_filename, output_filename, {"owner/repo": _epoch("2016-02-01 00:00:00")})
+
+    df = pd.read_csv(output_filename, dtype=str, keep_default_na=False)
+    assert list(df.columns) == PRE_BOT_CSV_COLUMNS
+    assert df["title"].tolist() == ["Handle the offset"]
+
+
+def test_remove_pre_duplicates_keeps_the_earliest_issue_across_chunks(tmp_path, monkeypatch):
+    pre_filename = tmp_path / "issues-pre-bot.csv"
+    post_filename = tmp_path / "issues.csv"
+    rows = [
+        ["owner", "repo", "2016-03-01T18:00:00", "Handle the cache", "Later duplicate"],
+        ["owner", "repo", "2016-01-01T18:00:00", "Handle the offset", "Only issue"],
+        ["owner", "repo", "2016-02-01T18:00:00", "Handle the cache", "Earliest"],
+        ["owner", "repo", "2016-02-01T18:00:00", "Handle the cache", "Tie"],
+        ["owner", "repo", "2016-01-01T18:00:00", "Created by the bot", "In the post-bot issues"],
+    ]
+    with open(pre_filename, "w", newline="", encoding="utf-8") as pre_file:
+        csv_writer = csv.writer(pre_file)
+        csv_writer.writerow(PRE_BOT_CSV_COLUMNS)
+        csv_writer.writerows(rows)
+    with open(post_filename, "w", newline="", encoding="utf-8") as post_file:
+        csv_writer = csv.writer(post_file)
+        csv_writer.writerow(["repo", "number", "title"])
+        csv_writer.writerow(["owner/repo", "1", "Created by the bot"])
+
+    # Every chunk contains a single row, so duplicates are always in different chunks
+    monkeypatch.setattr(pre_bot_issue_finder, "CSV_CHUNK_SIZE", 1)
+    monkeypatch.setattr(pre_bot_issue_finder._read_csv_chunks, "__defaults__", (1,))
+    remove_pre_duplicates({'results-todo-comments-pre-bot-output-file': str(pre_filename),
+        'results-issues-output-file': str(post_filename)}, logging.getLogger("pre_issue_finder"))
+
+    df = pd.read_csv(pre_filename, dtype=str, keep_default_na=False)
+    assert df["body"].tolist() == ["Only issue", "Earliest"]
+
+
+def test_count_issues_per_repo_counts_unique_issues_across_chunks(tmp_path):
+    filename = tmp_path / "issues.csv"
+    with open(filename, "w", newline="", encoding="utf-8") as issue_file:
+        csv_writer = csv.writer(issue_file)
+        csv_writer.writerow(["repo", "number"])
+        csv_writer.writerows([["a/b", "1"], ["c/d", "1"], ["a/b", "1"], ["a/b", "2"], ["c/d", "1"]])
+
+    counts = _count_issues_per_repo(str(filename), 1, unique_column="number")
+    assert counts.to_dict() == {"a/b": 2, "c/d": 1}
+    assert _count_issues_per_repo(str(filename), 2).to_dict() == {"a/b": 3, "c/d": 2}
+
+
+def test_scanner_splits_a_todo_bot_command_string(tmp_path):
+    settings = {'results-todo-comments-pre-bot-output-file': str(tmp_path / "pre.csv")}
+    logger = logging.getLogger("pre_issue_finder")
+
+    scanner = PreBotIssueScanner(dict(settings, **{'todo-bot-command': "node '/opt/todo bot/index.js'"}), logger)
+    assert scanner.todo_bot_command == ["node", "/opt/todo bot/index.js"]
+    scanner = PreBotIssueScanner(dict(settings, **{'todo-bot-command': ["node", "index.js"]}), logger)
+    assert scanner.todo_bot_command == ["node", "index.js"]
@@ -0,0 +1,54 @@
+import logging
+import os
+import sys
+
+from pygit2 import GIT_FILEMODE_BLOB, Signature, init_repository
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import git_transfer
+import repo_cloner
+from repo_cloner import classify_clone_error
+from timeouts import JobTimeout
+
+
+def test_classify_clone_error():
+    assert classify_clone_error(Exception("object not found - no match for id (3f2a9c0d)")) == "corrupt"
+    assert classify_clone_error(Exception("failed to resolve path '/x/.git/objects/pack': packfile is corrupt")) == "corrupt"
+    assert classify_clone_error(Exception("remote error: Repository not found.")) == "permanent"
+    assert classify_clone_error(Exception("unexpected http status code: 404")) == "permanent"
+    assert classify_clone_error(Exception("failed to send request: Connection reset by peer")) == "transient"
+
+
+def test_wait_for_retries_retries_timed_out_clones_with_a_larger_budget(tmp_path, monkeypatch):
+    source = init_repository(str(tmp_path / "source"))
+    signature = Signature("dev", "dev@example.com")
+    tree = source.TreeBuilder()
+    tree.insert("README.md", source.create_blob(b"# Source\n"), GIT_FILEMODE_BLOB)
+    source.create_commit("HEAD", signature, signature, "Initial commit", tree.write(), [])
+
+    budgets = []
+
+    def run_transfer(transfer_args, budget_seconds):
+        budgets.append(budget_seconds)
+        if len(budgets) == 1:
+            raise JobTimeout("clone", budget_seconds)
+        return git_transfer.run_transfer(transfer_args, budget_seconds)
+
+    monkeypatch.setattr(repo_cloner, "run_transfer", run_transfer)
+    settings = {
+        'download-output-path-repo': str(tmp_path / "repos"),
+        'results-cost-ledger-file': None,
+        'results-timeouts-file': str(tmp_path / "timeouts.csv"),
+        'timeouts': {'clone-seconds': 60, 'retry-factor': 4},
+    }
+    cloner = repo_cloner.RepoCloner(settings, logging.getLogger("repo_cloner"))
+    retried = []
+    outcome = cloner.clone_with_retries("owner/repo", {'clone_url': str(tmp_path / "source")},
+        on_retry_success=lambda: retried.append("owner/repo"))
+    cloner.wait_for_retries()
+
+    assert outcome == "timeout"
+    assert budgets == [60, 240]
+    assert retried == ["owner/repo"]
+    assert cloner.outcomes["owner/repo"] == "success"
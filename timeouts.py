@@ -0,0 +1,128 @@
+"""Contains the wall-clock budgets of clones and todo[bot] invocations, and the record of jobs that ran out of them"""
+
+import csv
+import os
+import signal
+import subprocess
+import threading
+from collections import defaultdict
+from datetime import datetime
+
+import metrics
+
+
+# Maps the jobs that can time out to the setting (in 'timeouts') that contains their budget in seconds
+JOB_BUDGET_SETTINGS = {
+    "clone":        "clone-seconds",
+    "commit_scan":  "commit-scan-seconds",
+    "repo_scan":    "repo-scan-seconds",
+}
+
+# Columns of the file in which timed out jobs are recorded
+TIMEOUT_COLUMNS = ["timestamp", "job", "repo", "commit", "budget_seconds", "reason"]
+
+# The budget of a job is multiplied by this factor every time it timed out before (unless set in 'timeouts')
+DEFAULT_RETRY_FACTOR = 4
+
+_job_timeouts = {}
+_job_timeouts_lock = threading.Lock()
+
+
+class JobTimeout(Exception):
+    def __init__(self, job, budget_seconds):
+        super().__init__(f"{job} took longer than {budget_seconds} seconds")
+        self.job = job
+        self.budget_seconds = budget_seconds
+
+
+def _kill_process_group(process):
+    if os.name == 'nt':
+        subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def run_with_timeout(args, job, budget_seconds, **kwargs):
+    """
+        Runs a command in its own process group. If it runs longer than budget_seconds (if not None),
+        it is killed together with all processes it started, and JobTimeout is raised.
+    """
+    if os.name == 'nt':
+        kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs['start_new_session'] = True
+
+    with subprocess.Popen(args, **kwargs) as process:
+        try:
+            return process.wait(timeout=budget_seconds)
+        except subprocess.TimeoutExpired:
+            _kill_process_group(process)
+            process.wait()
+            raise JobTimeout(job, budget_seconds)
+
+
+class JobTimeouts:
+    """
+        Determines the budgets of jobs, and records the jobs that timed out so that they can be retried later.
+        A job that timed out before gets a larger budget: its budget is multiplied by 'retry-factor' for each earlier timeout.
+    """
+    def __init__(self, settings):
+        timeout_settings = settings.get('timeouts') or {}
+        self.budgets = {job: timeout_settings.get(key) for job, key in JOB_BUDGET_SETTINGS.items()}
+        self.retry_factor = timeout_settings.get('retry-factor', DEFAULT_RETRY_FACTOR)
+        self.filename = settings.get('results-timeouts-file')
+        self.num_timeouts = defaultdict(int)
+        self.retries = defaultdict(list)
+        self._lock = threading.Lock()
+
+        if self.filename and os.path.isfile(self.filename):
+            with open(self.filename, newline='', encoding='utf-8') as timeout_file:
+                for row in csv.DictReader(timeout_file):
+                    self.num_timeouts[(row['job'], row['repo'])] += 1
+
+    def budget(self, job, repo_name):
+        """
+            Returns the budget (in seconds) of a job for a repository, or None if it has no budget
+        """
+        if self.budgets[job] is None:
+            return None
+        with self._lock:
+            return self.budgets[job] * self.retry_factor ** self.num_timeouts[(job, repo_name)]
+
+    def record(self, job, repo_name, budget_seconds, reason, commit=None):
+        with self._lock:
+            self.num_timeouts[(job, repo_name)] += 1
+            self.retries[job].append((repo_name, commit))
+            metrics.registry.inc("jobs_timed_out_total", job=job)
+
+            if self.filename:
+                is_new_file = not os.path.isfile(self.filename)
+                os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+                with open(self.filename, 'a', newline='', encoding='utf-8') as timeout_file:
+                    csv_writer = csv.writer(timeout_file)
+                    if is_new_file:
+                        csv_writer.writerow(TIMEOUT_COLUMNS)
+                    csv_writer.writerow([datetime.now().isoformat(sep=" ", timespec="seconds"), job, repo_name, commit,
+                        budget_seconds, reason])
+
+    def take_retries(self, job):
+        """
+            Returns the (repo_name, commit) pairs of the jobs that timed out (during this run) since the last call
+        """
+        with self._lock:
+            retries = self.retries.pop(job, [])
+        return retries
+
+
+def get_timeouts(settings):
+    """
+        Returns the job timeouts of 'results-timeouts-file' (shared by all stages)
+    """
+    filename = settings.get('results-timeouts-file')
+    with _job_timeouts_lock:
+        if filename not in _job_timeouts:
+            _job_timeouts[filename] = JobTimeouts(settings)
+        return _job_timeouts[filename]
@@ -0,0 +1,38 @@
+"""Contains a stand-in for the modified todo[bot], which finds the TODO-comments in the diff of a commit (e.g. to benchmark the scan)"""
+
+import argparse
+import csv
+import os
+
+
+# File in the working directory to which the issues are appended (i.e. TODO_BOT_OUTPUT_FILENAME of the pre-bot issue finder).
+#   NB: Only the standard library is used, as the detector is started for every commit
+OUTPUT_FILENAME = "issues_pre_bot.csv"
+
+
+def detect_todos(diffs_path, owner, name, sha, commit_date):
+    """
+        Appends an issue for every TODO-comment in the (added lines) diff of a commit to the output file,
+        in the same format as the modified todo[bot]
+    """
+    diff_filename = os.path.join(diffs_path, owner, name, f"{sha}.diff")
+    with open(diff_filename, encoding="utf-8") as diff_file, \
+            open(OUTPUT_FILENAME, "a", newline='', encoding="utf-8") as output_file:
+        csv_writer = csv.writer(output_file)
+        for line in diff_file:
+            if line.startswith("+") and not line.startswith("+++") and "TODO" in line:
+                title = line.split("TODO", 1)[1].lstrip(":").strip()
+                csv_writer.writerow([owner, name, commit_date, title, f"Found in {sha}"])
+
+
+if __name__ == "__main__":
+    # Called in the same way as the modified todo[bot], after the folder that contains the diffs
+    parser = argparse.ArgumentParser(description="Finds the TODO-comments in the diff of a commit")
+    parser.add_argument('diffs_path', help="Folder that contains the diffs (i.e. 'diffs-output-path')")
+    parser.add_argument('-o', '--owner', required=True)
+    parser.add_argument('-r', '--repo', required=True)
+    parser.add_argument('-s', '--sha', required=True)
+    parser.add_argument('-e', '--extradata', help="Date of the commit")
+    args = parser.parse_args()
+
+    detect_todos(args.diffs_path, args.owner, args.repo, args.sha, args.extradata)
@@ -1,12 +1,21 @@
 """Contains Utility functions for the bot issue identifier"""
 
+import atexit
 import json
 import logging
+import os
+import queue
+import threading
 import time
+import tracemalloc
 
+from contextlib import contextmanager
 from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 from github import RateLimitExceededException
 
+import metrics
+
 
 LOGLEVEL_NAMES = ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"]
 
@@ -19,8 +28,19 @@ SETTING_ALLOWED_VALUES = {
     "state":    ["any", "open", "closed"],
 }
 
+# Defaults of the sampling of frequent DEBUG messages (see LogSampler)
+DEFAULT_LOG_SAMPLE_EVERY = 100
+DEFAULT_LOG_SUMMARY_SECONDS = 30
+
 g_logger = None
 
+# All loggers put their records on a single queue, which a background thread writes to the (shared) handlers.
+#   Handlers are keyed by their output file (or None for the terminal), so loggers that share a file share its handler
+_log_queue = queue.SimpleQueue()
+_log_listener = None
+_log_handlers = {}
+_log_lock = threading.Lock()
+
 # Prints PyGithub API requests in a shorter form
 class ShortRequestPrinter(logging.Filter):
     def filter(self, record):
@@ -29,20 +49,104 @@ class ShortRequestPrinter(logging.Filter):
             print(f"> PYGITHUB API REQUEST: {short_msg}")
         return False
 
+# Tags the records of a logger with their output, so that the background thread only passes them to the handler of that output
+class _OutputQueueHandler(QueueHandler):
+    def __init__(self, output):
+        super().__init__(_log_queue)
+        self.output = output
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        record.log_output = self.output
+        return record
+
 # Creates a logger using a given name and level.
-# Outputs to the terminal if no output_file_path is given, otherwise outputs to said file
+# Outputs to the terminal if no output_file_path is given, otherwise outputs to said file.
+# Records are written by a background thread, so logging does not wait for the terminal or disk
 def create_logger(name, level, output_file_path=None):
+    global _log_listener
     logger = logging.getLogger(name)
     logger.setLevel(level)
-    handler = None
-    if output_file_path is None:
-        handler = logging.StreamHandler()
-    else:
-        handler = logging.FileHandler(output_file_path)
-    handler.setFormatter(logging.Formatter('%(asctime)s (%(name)-12s) [%(levelname)s] %(message)s'))
-    logger.addHandler(handler)
+    output = None if output_file_path is None else os.path.abspath(output_file_path)
+
+    with _log_lock:
+        if output not in _log_handlers:
+            handler = logging.StreamHandler() if output is None else logging.FileHandler(output)
+            handler.setFormatter(logging.Formatter('%(asctime)s (%(name)-12s) [%(levelname)s] %(message)s'))
+            handler.addFilter(lambda record, output=output: record.log_output == output)
+            _log_handlers[output] = handler
+            if _log_listener is not None:
+                # The handlers of a listener cannot be changed while it runs
+                _log_listener.stop()
+                _log_listener = None
+        if _log_listener is None:
+            _log_listener = QueueListener(_log_queue, *_log_handlers.values(), respect_handler_level=True)
+            _log_listener.start()
+
+        # Creating the same logger twice should not output its records twice
+        for handler in list(logger.handlers):
+            if isinstance(handler, _OutputQueueHandler):
+                logger.removeHandler(handler)
+        logger.addHandler(_OutputQueueHandler(output))
     return logger
 
+# Writes the records that are still queued, and stops the background thread (it is restarted by create_logger)
+@atexit.register
+def stop_logging():
+    global _log_listener
+    with _log_lock:
+        if _log_listener is not None:
+            _log_listener.stop()
+            _log_listener = None
+
+class LogSampler:
+    """
+        Logs frequent (DEBUG) messages of hot loops, such as one per commit, sparingly: only the first and every
+        every-th message of each kind is logged. A summary of the number of messages of each kind is logged
+        at most every summary_seconds, and by flush().
+    """
+    def __init__(self, logger, every=DEFAULT_LOG_SAMPLE_EVERY, summary_seconds=DEFAULT_LOG_SUMMARY_SECONDS, level=logging.DEBUG):
+        self.logger = logger
+        self.every = every
+        self.summary_seconds = summary_seconds
+        self.level = level
+        self.counts = {}
+        self.num_unsummarised = 0
+        self.last_summary = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, logger, settings):
+        sampling = settings.get('log-sampling') or {}
+        return cls(logger, sampling.get('every', DEFAULT_LOG_SAMPLE_EVERY),
+            sampling.get('summary-seconds', DEFAULT_LOG_SUMMARY_SECONDS))
+
+    def log(self, kind, msg, *args):
+        """
+            Counts a message of the given kind; msg is formatted (with args) only if it is logged
+        """
+        if not self.logger.isEnabledFor(self.level):
+            return
+
+        with self._lock:
+            count = self.counts[kind] = self.counts.get(kind, 0) + 1
+            self.num_unsummarised += 1
+            should_summarise = time.monotonic() - self.last_summary >= self.summary_seconds
+
+        if count % self.every == 1 or self.every == 1:
+            self.logger.log(self.level, msg + f" [{kind} #{count}]", *args)
+        if should_summarise:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self.num_unsummarised:
+                return
+            summary = ", ".join(f"{count} {kind}" for kind, count in self.counts.items())
+            self.num_unsummarised = 0
+            self.last_summary = time.monotonic()
+        self.logger.log(self.level, f"> So far: {summary}")
+
 # Loads the settings from a file with a given filename
 def load_settings(filename):
     # Load search settings
@@ -80,6 +184,24 @@ def load_gh_logger(shorten_log_output):
         g_logger.info("Extended PyGithub logging enabled")
         enable_console_debug_logging()
 
+@contextmanager
+def log_runtime_and_memory(logger, description):
+    """
+        Logs the runtime and peak (traced) memory usage of the code that is run in this context
+    """
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    start_time = datetime.now()
+    try:
+        yield
+    finally:
+        _, peak_memory = tracemalloc.get_traced_memory()
+        if not was_tracing:
+            tracemalloc.stop()
+        logger.info(f"{description} took {datetime.now() - start_time} h:mm:ss (peak memory: {peak_memory / 2**20:.1f} MiB)")
+
 def rate_limited_retry_search(github):
     """
     Abstracts away from the GitHub API rate limit
@@ -91,6 +213,8 @@ def rate_limited_retry_search(github):
                 try:
                     return func(*args, **kwargs)
                 except RateLimitExceededException:
+                    metrics.registry.inc("rate_limit_hits_total")
+                    metrics.registry.inc("github_api_requests_total", endpoint="rate_limit")
                     limits = github.get_rate_limit()
                     search_reset = limits.search.reset.replace(tzinfo=timezone.utc)
                     core_reset = limits.core.reset.replace(tzinfo=timezone.utc)
@@ -110,6 +234,7 @@ def rate_limited_retry_search(github):
 
                     if seconds > 0.0:
                         g_logger.debug(f"> Waiting for {seconds:.3g} seconds...")
+                        metrics.registry.observe("rate_limit_sleep_seconds", seconds)
                         time.sleep(seconds)
                         g_logger.debug("> Done waiting - resume!")
             raise Exception("Failed too many times")